@@ -1,20 +1,43 @@
 __author__ = 'bethard'
 
 import argparse
+import array
+import bisect
 import collections
 import copy
 import functools
-import glob
+import gzip
+import hashlib
+import heapq
+import json
 import logging
+import mmap
+import multiprocessing
 import os
+import pickle
+import random
 import re
+import sys
+import time
+import zlib
 
 import anafora
 import anafora.select
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 class Scores(object):
 
+    # the attributes that hold the counts from which all other statistics are calculated
+    _count_names = ("reference", "predicted", "correct")
+
+    # the scores only count annotations, so annotation keys can be replaced with integer ids (see _KeyInterner)
+    _internable = True
+
     def __init__(self):
         self.reference = 0
         self.predicted = 0
@@ -64,6 +87,10 @@ class Scores(object):
 
 
 class DebuggingScores(Scores):
+
+    # the errors include the annotation keys, so the keys must not be replaced with integer ids
+    _internable = False
+
     def __init__(self):
         Scores.__init__(self)
         self.errors = []
@@ -79,7 +106,9 @@ class DebuggingScores(Scores):
             errors.append((item, "not in predicted"))
         for item in predicted - reference:
             errors.append((item, "not in reference"))
-        errors.sort()
+
+        # sort by position in the text (keys of different annotation kinds are not comparable to each other)
+        errors.sort(key=lambda error: (tuple(_flatten_spans(error[0][0])), repr(error)))
         self.errors.extend(errors)
 
     def update(self, other):
@@ -90,12 +119,544 @@ class DebuggingScores(Scores):
         self.errors.extend(other.errors)
 
 
-class TemporalClosureScores(object):
+class CharacterScores(Scores):
+
+    # the characters are counted from the spans of the annotation keys, so the keys must not be replaced with ids
+    _internable = False
+
+    def add(self, reference, predicted):
+        """
+        Counts characters rather than annotations: the characters covered by the reference annotations, the
+        characters covered by the predicted annotations, and the characters covered by both a reference and a
+        predicted annotation with the same type and properties. (Characters covered by several annotations with the
+        same type and properties are counted once.)
+
+        :param set reference: the reference annotations
+        :param set predicted: the predicted annotations
+        """
+        label_ids = {}
+        starts = []
+        ends = []
+        labels = []
+        is_predicted = []
+        for in_predicted, keys in ((0, reference), (1, predicted)):
+            for spans, type_name, props in keys:
+                label_id = label_ids.setdefault((type_name, props), len(label_ids))
+                for start, end in _flatten_spans(spans):
+                    if start < end:
+                        starts.append(start)
+                        ends.append(end)
+                        labels.append(label_id)
+                        is_predicted.append(in_predicted)
+        reference_count, predicted_count, correct_count = _character_overlap(starts, ends, labels, is_predicted)
+        self.reference += reference_count
+        self.predicted += predicted_count
+        self.correct += correct_count
+
+
+# below this many spans, the overhead of creating numpy arrays outweighs the speed of the vectorized sweep
+_character_overlap_numpy_min_spans = 64
+
+
+def _character_overlap(starts, ends, labels, is_predicted):
+    """
+    Sweeps once over the sorted span endpoints (of all labels at once, with each label's offsets shifted past those
+    of the previous label), tracking how many reference and predicted spans cover each segment between endpoints.
+
+    :param list starts: the start offset of each span
+    :param list ends: the end offset of each span
+    :param list labels: the label (an integer id for the type and properties) of each span
+    :param list is_predicted: 1 for each predicted span, 0 for each reference span
+    :return tuple: the number of characters covered by reference spans, by predicted spans, and by both reference
+        and predicted spans of the same label
+    """
+    if not starts:
+        return 0, 0, 0
+    stride = max(ends) + 1
+    if numpy is not None and len(starts) >= _character_overlap_numpy_min_spans:
+        offsets = numpy.array(labels, dtype=numpy.int64) * stride
+        positions = numpy.concatenate([numpy.array(starts, dtype=numpy.int64) + offsets,
+                                       numpy.array(ends, dtype=numpy.int64) + offsets])
+        predicted_deltas = numpy.array(is_predicted, dtype=numpy.int64)
+        reference_deltas = 1 - predicted_deltas
+        order = numpy.argsort(positions, kind="stable")
+        lengths = numpy.diff(positions[order])
+        reference_depths = numpy.cumsum(numpy.concatenate([reference_deltas, -reference_deltas])[order])[:-1]
+        predicted_depths = numpy.cumsum(numpy.concatenate([predicted_deltas, -predicted_deltas])[order])[:-1]
+        in_reference = reference_depths > 0
+        in_predicted = predicted_depths > 0
+        return (int(lengths[in_reference].sum()), int(lengths[in_predicted].sum()),
+                int(lengths[in_reference & in_predicted].sum()))
+
+    # without numpy (or for only a few spans), sweep over the sorted endpoints one at a time
+    events = []
+    for start, end, label, predicted in zip(starts, ends, labels, is_predicted):
+        events.append((start + label * stride, 1 - predicted, predicted))
+        events.append((end + label * stride, predicted - 1, -predicted))
+    events.sort()
+    reference_count = predicted_count = correct_count = 0
+    reference_depth = predicted_depth = 0
+    last_position = events[0][0]
+    for position, reference_delta, predicted_delta in events:
+        length = position - last_position
+        if reference_depth > 0:
+            reference_count += length
+            if predicted_depth > 0:
+                correct_count += length
+        if predicted_depth > 0:
+            predicted_count += length
+        reference_depth += reference_delta
+        predicted_depth += predicted_delta
+        last_position = position
+    return reference_count, predicted_count, correct_count
+
+
+class SpanIoUScores(object):
+
+    # the span overlaps are calculated from the annotation keys, so the keys must not be replaced with ids
+    _internable = False
+
+    def __init__(self, thresholds=(0.0, 0.25, 0.5, 0.75, 1.0)):
+        """
+        Scores for several thresholds at once, where a predicted annotation is correct at a threshold if it can be
+        matched to a reference annotation with the same type and properties whose spans overlap it with an
+        intersection-over-union (of characters) of at least the threshold (and, for a threshold of 0.0, by at least
+        one character). Each annotation is matched at most once. For properties whose values are annotations (e.g.,
+        the arguments of relations), only the types and properties of the values must be the same, since their spans
+        are part of the spans of the annotation (one per argument) and so are compared by the IoU.
+
+        :param iterable thresholds: the IoU thresholds, each between 0.0 and 1.0
+        """
+        self.thresholds = tuple(sorted(thresholds))
+        self.reference = 0
+        self.predicted = 0
+        self.correct = [0] * len(self.thresholds)
+
+    def add(self, reference, predicted):
+        """
+        :param set reference: the reference annotations
+        :param set predicted: the predicted annotations
+        """
+        self.reference += len(reference)
+        self.predicted += len(predicted)
+
+        # a threshold's matches are those (of the single greedy matching) whose IoU is at least the threshold
+        ious = sorted(_matched_span_ious(reference, predicted))
+        for i, threshold in enumerate(self.thresholds):
+            self.correct[i] += len(ious) - bisect.bisect_left(ious, threshold)
+
+    def update(self, other):
+        """
+        :param SpanIoUScores other: scores (for the same thresholds) to merge into this one
+        """
+        if other.thresholds != self.thresholds:
+            raise ValueError("cannot merge scores for thresholds {0} and {1}".format(self.thresholds, other.thresholds))
+        self.reference += other.reference
+        self.predicted += other.predicted
+        self.correct = [correct + other_correct for correct, other_correct in zip(self.correct, other.correct)]
+
+    def scores(self, threshold):
+        """
+        :param float threshold: one of the thresholds
+        :return Scores: the counts (and precision, recall, etc.) at the threshold
+        """
+        scores = Scores()
+        scores.reference = self.reference
+        scores.predicted = self.predicted
+        scores.correct = self.correct[self.thresholds.index(threshold)]
+        return scores
+
+    def __repr__(self):
+        return "{0}(thresholds={1}, reference={2}, predicted={3}, correct={4})".format(
+            self.__class__.__name__, self.thresholds, self.reference, self.predicted, self.correct)
+
+
+def _merged_intervals(spans):
+    """
+    :param iterable spans: (start, end) offsets, possibly overlapping
+    :return list: the sorted, non-overlapping (start, end) offsets covering the same characters
+    """
+    merged = []
+    for start, end in sorted(spans):
+        if start >= end:
+            continue
+        if merged and start <= merged[-1][1]:
+            merged[-1] = merged[-1][0], max(end, merged[-1][1])
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _matched_span_ious(reference, predicted):
+    """
+    Matches the reference and predicted annotations (with the same type and properties) whose spans overlap. Since
+    the greedy matching only ever adds pairs with lower IoUs, the matching for any threshold is just the pairs whose
+    IoU is at least the threshold.
+
+    :param set reference: the reference annotation keys
+    :param set predicted: the predicted annotation keys
+    :return list: the IoU of each matched pair
+    """
+
+    # the annotations are put in a fixed order, so that ties in IoU are always broken the same way
+    sides = [[((type_name, _without_spans(props)), spans) for spans, type_name, props in sorted(keys, key=repr)]
+             for keys in (reference, predicted)]
+    return [iou for _, _, iou in _span_matching(*sides)]
+
+
+def _without_spans(props):
+    """
+    :param props: the properties of an annotation key (see ToSet.key), i.e., None, a (name, value) pair, or a tuple
+        of (name, value) pairs, where values that are annotations are themselves (spans, type, properties) keys
+    :return: the same properties, but with the spans removed from any (nested) annotation values
+    """
+    def _value(value):
+        if isinstance(value, tuple):
+            _, type_name, value_props = value
+            return type_name, _without_spans(value_props)
+        return value
+
+    if props is None:
+        return None
+    if props and isinstance(props[0], str):
+        name, value = props
+        return name, _value(value)
+    return tuple((name, _value(value)) for name, value in props)
+
+
+def _span_matching(reference, predicted):
+    """
+    Finds the pairs of reference and predicted items (with the same label) whose spans overlap, by sweeping over the
+    sorted span endpoints rather than comparing every pair, and then matches them greedily in order of decreasing
+    IoU (ties broken by position), so that each item is matched at most once.
+
+    :param list reference: (label, spans) of each reference item, where the spans of a relation are nested, one
+        entry per argument
+    :param list predicted: (label, spans) of each predicted item
+    :return list: (reference-index, predicted-index, IoU) of each matched pair, in order of decreasing IoU
+    """
+    sides = reference, predicted
+
+    # the spans of each argument of a relation are shifted past those of the previous argument, so that only
+    # characters of the same argument can overlap
+    slotted_spans = ([], [])
+    stride = 1
+    for side, items in enumerate(sides):
+        for _, spans in items:
+            if not spans or isinstance(spans[0][0], int):
+                slots = [list(_flatten_spans(spans))]
+            else:
+                slots = [list(_flatten_spans(argument_spans)) for argument_spans in spans]
+            stride = max([stride] + [end + 1 for slot in slots for _, end in slot])
+            slotted_spans[side].append(slots)
+    label_ids = {}
+    lengths = ([], [])
+    events = []
+    for side, items in enumerate(sides):
+        for index, (label, _) in enumerate(items):
+            label_id = label_ids.setdefault(label, len(label_ids))
+            intervals = _merged_intervals((start + slot * stride, end + slot * stride)
+                                          for slot, slot_spans in enumerate(slotted_spans[side][index])
+                                          for start, end in slot_spans)
+            lengths[side].append(sum(end - start for start, end in intervals))
+            events.extend((label_id, start, end, side, index) for start, end in intervals)
+
+    # sum the characters shared by each overlapping pair, where each interval is compared only to the (still open)
+    # intervals of the other side that started before it
+    overlaps = collections.Counter()
+    current_label_id = None
+    open_intervals = ([], [])
+    for label_id, start, end, side, index in sorted(events):
+        if label_id != current_label_id:
+            current_label_id = label_id
+            open_intervals = ([], [])
+        for other_side in (0, 1):
+            open_intervals[other_side][:] = [(e, i) for e, i in open_intervals[other_side] if e > start]
+        for other_end, other_index in open_intervals[1 - side]:
+            pair = (index, other_index) if side == 0 else (other_index, index)
+            overlaps[pair] += min(end, other_end) - start
+        open_intervals[side].append((end, index))
+
+    # identical items match perfectly, even if their spans are empty
+    ious = {}
+    predicted_indexes = {item: index for index, item in enumerate(predicted)}
+    for reference_index, item in enumerate(reference):
+        if item in predicted_indexes:
+            ious[reference_index, predicted_indexes[item]] = 1.0
+    for (reference_index, predicted_index), overlap in overlaps.items():
+        union = lengths[0][reference_index] + lengths[1][predicted_index] - overlap
+        ious.setdefault((reference_index, predicted_index), overlap / float(union))
+
+    # greedily match the pairs with the highest IoU first
+    matches = []
+    matched = (set(), set())
+    for (reference_index, predicted_index), iou in sorted(ious.items(), key=lambda item: (-item[1], item[0])):
+        if reference_index not in matched[0] and predicted_index not in matched[1]:
+            matched[0].add(reference_index)
+            matched[1].add(predicted_index)
+            matches.append((reference_index, predicted_index, iou))
+    return matches
+
+
+class ErrorReport(object):
+    def __init__(self, report_file, report_format="jsonl", first_errors_per_view=None):
+        """
+        Writes the errors of DebuggingScores to a file as they are found, rather than keeping them all in memory.
+
+        :param file report_file: the (text mode) file where errors should be written
+        :param string report_format: "jsonl" for one JSON object per error, or "tsv" for one tab-separated line
+            per error
+        :param int first_errors_per_view: the number of errors to write for each system and view; only the first
+            errors found (in the order in which documents are scored) are written, and further errors are counted
+            but not written; if None, all errors are written
+        """
+        if report_format not in ("jsonl", "tsv"):
+            raise ValueError("unsupported error report format: {0}".format(report_format))
+        self.report_file = report_file
+        self.report_format = report_format
+        self.first_errors_per_view = first_errors_per_view
+        self.written = collections.Counter()
+        self.omitted = collections.Counter()
+        if report_format == "tsv":
+            self.report_file.write("document\tsystem\tview\tmessage\ttext\tannotation\n")
+
+    def write(self, text_name, system_name, view_name, errors, span_text):
+        """
+        :param string text_name: the name of the document where the errors were found
+        :param string system_name: the name (e.g., the predicted directory) of the system that made the errors
+        :param view_name: the view, i.e., (annotation type[, property name[, property value]]), of the errors
+        :param list errors: the (annotation, message) errors, as in DebuggingScores.errors
+        :param function span_text: function from annotation spans to the text they cover, which is only called
+            for errors that are written
+        """
+        for annotation, message in errors:
+            key = system_name, view_name
+            if self.first_errors_per_view is not None and self.written[key] >= self.first_errors_per_view:
+                self.omitted[key] += 1
+                continue
+            self.written[key] += 1
+            spans, _, _ = annotation
+            text = span_text(spans)
+            if self.report_format == "jsonl":
+                error = {"document": text_name, "system": system_name, "view": _to_json(view_name),
+                         "message": message, "text": text, "annotation": repr(annotation)}
+                self.report_file.write(json.dumps(error, sort_keys=True) + "\n")
+            else:
+                fields = [text_name, system_name, _score_name(view_name), message, text, repr(annotation)]
+                fields = [re.sub(r"\s", " ", "" if field is None else field) for field in fields]
+                self.report_file.write("\t".join(fields) + "\n")
+
+    def close(self):
+        """
+        Logs the number of errors that were omitted because of first_errors_per_view.
+        """
+        for (system_name, view_name), count in sorted(self.omitted.items(), key=repr):
+            logging.warn("omitted %s further errors for %s %s", count, system_name, view_name)
+
+
+class PhaseProfile(object):
+
+    # the phases, in the order in which they are reported
+    phase_names = ("xml parsing", "self-reference check", "argument alignment", "view discovery", "key construction",
+                   "set intersection", "temporal closure")
+
     def __init__(self):
+        """
+        Records the wall-clock time, CPU time, number of calls and number of items processed in each phase of an
+        evaluation, both overall and for each document (see start_document).
+        """
+        self.totals = collections.OrderedDict()
+        self.documents = collections.OrderedDict()
+        self._document_phases = None
+
+    def start_document(self, document_name):
+        """
+        Starts a new document, to which the phases of subsequent calls are attributed (as well as to the totals).
+
+        :param string document_name: the name of the document
+        """
+        self._document_phases = self.documents[document_name] = collections.OrderedDict()
+
+    def phase(self, phase_name):
+        """
+        :param string phase_name: the name of the phase, typically one of phase_names
+        :return _PhaseTimer: a context manager that times the phase; its items attribute should be set to the
+            number of items (e.g., annotations or views) processed
+        """
+        return _PhaseTimer(self, phase_name)
+
+    def record(self, phase_name, wall_time, cpu_time, items):
+        """
+        :param string phase_name: the name of the phase
+        :param float wall_time: the wall-clock seconds spent in the phase
+        :param float cpu_time: the CPU seconds spent in the phase
+        :param int items: the number of items processed in the phase
+        """
+        counts_list = [self.totals]
+        if self._document_phases is not None:
+            counts_list.append(self._document_phases)
+        for phase_counts in counts_list:
+            if phase_name not in phase_counts:
+                phase_counts[phase_name] = [0.0, 0.0, 0, 0]
+            counts = phase_counts[phase_name]
+            counts[0] += wall_time
+            counts[1] += cpu_time
+            counts[2] += 1
+            counts[3] += items
+
+    def _sorted(self, phase_counts):
+        def _phase_index(phase_name):
+            if phase_name in self.phase_names:
+                return self.phase_names.index(phase_name), phase_name
+            return len(self.phase_names), phase_name
+
+        return [(phase_name, phase_counts[phase_name]) for phase_name in sorted(phase_counts, key=_phase_index)]
+
+    def to_json(self):
+        """
+        :return dict: a JSON-serializable summary, with the "wall", "cpu", "calls" and "items" of each phase, both
+            overall and for each document
+        """
+        def _phases_to_json(phase_counts):
+            return collections.OrderedDict(
+                (phase_name, collections.OrderedDict(zip(("wall", "cpu", "calls", "items"), counts)))
+                for phase_name, counts in self._sorted(phase_counts))
+
+        return collections.OrderedDict([
+            ("total", _phases_to_json(self.totals)),
+            ("documents", collections.OrderedDict(
+                (document_name, _phases_to_json(phase_counts))
+                for document_name, phase_counts in self.documents.items())),
+        ])
+
+    def print_table(self, output_file=None):
+        """
+        :param file output_file: where the table of the overall time of each phase should be printed; if None, it
+            is printed to standard error
+        """
+        if output_file is None:
+            output_file = sys.stderr
+        print("{0:25}\t{1:>9}\t{2:>9}\t{3:>9}\t{4:>11}".format("phase", "wall (s)", "cpu (s)", "calls", "items"),
+              file=output_file)
+        for phase_name, (wall_time, cpu_time, calls, items) in self._sorted(self.totals):
+            print("{0:25}\t{1:9.3f}\t{2:9.3f}\t{3:9d}\t{4:11d}".format(phase_name, wall_time, cpu_time, calls, items),
+                  file=output_file)
+
+
+class _PhaseTimer(object):
+    def __init__(self, profile, phase_name):
+        self.profile = profile
+        self.phase_name = phase_name
+        self.items = 0
+
+    def __enter__(self):
+        self._wall_start = time.perf_counter()
+        self._cpu_start = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profile.record(self.phase_name, time.perf_counter() - self._wall_start,
+                            time.process_time() - self._cpu_start, self.items)
+
+
+class _NoPhaseProfile(object):
+    """
+    Stands in for a PhaseProfile when nothing is being profiled, so that phases need not check for one.
+    """
+
+    def start_document(self, document_name):
+        pass
+
+    def phase(self, phase_name):
+        return _no_phase_timer
+
+
+class _NoPhaseTimer(object):
+    items = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_no_phase_profile = _NoPhaseProfile()
+_no_phase_timer = _NoPhaseTimer()
+
+
+class TemporalClosureCache(object):
+    def __init__(self, cache_dir=None, max_size=None):
+        """
+        :param str cache_dir: directory where closures are saved (under a hash of the annotations they were computed
+            from) so that they can be reused across runs; if None, closures are only cached in memory
+        :param int max_size: the maximum number of closures to keep in memory (if None, there is no limit)
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self._closures = collections.OrderedDict()
+
+    def closure(self, annotations, compute_closure):
+        """
+        :param set annotations: the annotations whose closure is needed
+        :param callable compute_closure: function that calculates the closure of the annotations when not cached
+        :return set: the closure of the annotations
+        """
+        key = frozenset(annotations)
+
+        # try the in-memory cache first, marking the closure as recently used
+        if key in self._closures:
+            closure = self._closures.pop(key)
+
+        # then try the on-disk cache, and finally compute the closure from scratch
+        else:
+            closure = None
+            if self.cache_dir is not None:
+                hash_text = "\n".join(sorted(repr(annotation) for annotation in key))
+                hash_text = "{0}\n{1}".format(self._version, hash_text)
+                path = os.path.join(self.cache_dir, hashlib.sha1(hash_text.encode("utf-8")).hexdigest() + ".pickle")
+                if os.path.exists(path):
+                    with open(path, "rb") as closure_file:
+                        closure = pickle.load(closure_file)
+            if closure is None:
+                closure = compute_closure(annotations)
+                if self.cache_dir is not None:
+                    if not os.path.exists(self.cache_dir):
+                        os.makedirs(self.cache_dir)
+                    temp_path = "{0}.{1}.tmp".format(path, os.getpid())
+                    with open(temp_path, "wb") as closure_file:
+                        pickle.dump(closure, closure_file, pickle.HIGHEST_PROTOCOL)
+                    os.replace(temp_path, path)
+
+        # add the closure as the most recently used, removing the least recently used if there are too many
+        self._closures[key] = closure
+        if self.max_size is not None and len(self._closures) > self.max_size:
+            self._closures.popitem(last=False)
+        return closure
+
+    # changing this invalidates closures saved by earlier versions of the closure algorithm
+    _version = 1
+
+
+class TemporalClosureScores(object):
+
+    # the attributes that hold the counts from which all other statistics are calculated
+    _count_names = ("reference", "predicted", "precision_correct", "recall_correct")
+
+    def __init__(self, closure_cache=None):
+        """
+        :param TemporalClosureCache closure_cache: where to cache the closures of the reference annotations, which
+            are typically the same across evaluations of many systems (if None, closures are not cached)
+        """
         self.reference = 0
         self.predicted = 0
         self.precision_correct = 0
         self.recall_correct = 0
+        self.closure_cache = closure_cache
+
+        # the relations found inconsistent while computing closures, which are not counts, but are collected so that
+        # they can be logged once per document (see _log_inconsistent_relations)
+        self.inconsistent_relations = set()
 
     @property
     def correct(self):
@@ -112,7 +673,11 @@ class TemporalClosureScores(object):
         predicted = self._remove_duplicate_relations(predicted)
         self.reference += len(reference)
         self.predicted += len(predicted)
-        self.precision_correct += len(self._closure(reference) & predicted)
+        if self.closure_cache is not None:
+            reference_closure = self.closure_cache.closure(reference, self._closure)
+        else:
+            reference_closure = self._closure(reference)
+        self.precision_correct += len(reference_closure & predicted)
         self.recall_correct += len(reference & self._closure(predicted))
 
     def update(self, other):
@@ -212,7 +777,7 @@ class TemporalClosureScores(object):
         # return the collected relations
         return point_relations
 
-    def _to_interval_relations(self, point_relations, annotations):
+    def _to_interval_relations(self, graph, annotations):
         # map intervals to names
         interval_names = collections.defaultdict(set)
         for spans, type_name, (prop_name, _) in annotations:
@@ -221,51 +786,81 @@ class TemporalClosureScores(object):
 
         # find all pairs of intervals that have some point relation between them (and whose names match)
         pair_names = {}
-        for ((interval1, _), _, (interval2, _)) in point_relations:
-            names = interval_names[interval1] & interval_names[interval2]
-            if names:
-                pair_names[(interval1, interval2)] = names
-                pair_names[(interval2, interval1)] = names
+        for points1, points2 in graph.related():
+            for interval1 in {interval for interval, _ in points1}:
+                for interval2 in {interval for interval, _ in points2}:
+                    if (interval1, interval2) not in pair_names:
+                        names = interval_names[interval1] & interval_names[interval2]
+                        pair_names[(interval1, interval2)] = names
+                        pair_names[(interval2, interval1)] = names
 
-        # for each interval pair, see if it satisfies the point-wise requirements for any interval relations
+        # for each interval pair, see which of the point-wise requirements of the interval relations it satisfies,
+        # and then look up (or calculate and cache) which interval relations are satisfied by those requirements
+        point_tests = {"<": graph.less, "=": graph.equal}
+        requirements = {r for rs in self._interval_to_point.values() for r in rs}
+        satisfied_to_relations = {}
         interval_relations = set()
-        for pair in pair_names:
-            names = pair_names[pair]
-            for relation, requirements in self._interval_to_point.items():
-                if all(((pair[i1], s1), r, (pair[i2], s2)) in point_relations
-                       for i1, s1, r, i2, s2 in requirements):
-                    for type_name, prop_name in names:
-                        interval_relations.add((pair, type_name, (prop_name, relation)))
+        for pair, names in pair_names.items():
+            if not names:
+                continue
+            satisfied = frozenset(
+                requirement for requirement in requirements
+                if point_tests[requirement[2]]((pair[requirement[0]], requirement[1]),
+                                               (pair[requirement[3]], requirement[4])))
+            if satisfied not in satisfied_to_relations:
+                satisfied_to_relations[satisfied] = [
+                    relation for relation, relation_requirements in self._interval_to_point.items()
+                    if satisfied.issuperset(relation_requirements)]
+            for relation in satisfied_to_relations[satisfied]:
+                for type_name, prop_name in names:
+                    interval_relations.add((pair, type_name, (prop_name, relation)))
 
         # return the collected relations
         return interval_relations
 
+    def contradictions(self, annotations):
+        """
+        :param set annotations: interval relations, i.e., ((interval1, interval2), type, (property, relation)) tuples
+        :return list: a list of sets of interval relations, where the relations in each set together imply that some
+            time point is before itself (e.g., A BEFORE B and B BEFORE A)
+        """
+        annotations = {a for a in annotations if self._is_valid(a)}
+
+        # only the strongly connected components are needed (not the reachability of the full closure)
+        graph = _PointGraph((r for a in annotations for r in self._to_point_relations(a)), reachability=False)
+        return self._contradictions(graph, annotations)
+
+    def _contradictions(self, graph, annotations):
+
+        # remember which interval relations produced each point relation (except for the start-before-end relation
+        # within each interval, for which no interval relation should be blamed)
+        point_relation_annotations = collections.defaultdict(set)
+        for annotation in annotations:
+            for point_relation in self._to_point_relations(annotation):
+                (interval1, side1), relation, (interval2, side2) = point_relation
+                if interval1 != interval2 or (side1, relation, side2) != (self._start, "<", self._end):
+                    point_relation_annotations[point_relation].add(annotation)
+
+        # every point relation within a contradictory component lies on a cycle, so blame its interval relations
+        contradiction_annotations = collections.defaultdict(set)
+        for (point1, _, point2), relation_annotations in point_relation_annotations.items():
+            contradiction = graph.contradiction(point1)
+            if contradiction is not None and contradiction == graph.contradiction(point2):
+                contradiction_annotations[contradiction].update(relation_annotations)
+        return list(contradiction_annotations.values())
+
     def _closure(self, annotations):
 
-        # convert interval relations to point relations
-        new_relations = {r for a in annotations for r in self._to_point_relations(a)}
+        # convert interval relations to point relations, and build a graph that can answer closure queries
+        graph = _PointGraph(r for a in annotations for r in self._to_point_relations(a))
 
-        # repeatedly apply point transitivity rules until no new relations can be inferred
-        point_relations = set()
-        point_relations_index = collections.defaultdict(set)
-        while new_relations:
-
-            # update the result and the index with any new relations found on the last iteration
-            point_relations.update(new_relations)
-            for point_relation in new_relations:
-                point_relations_index[point_relation[0]].add(point_relation)
-
-            # infer any new transitive relations, e.g., if A < B and B < C then A < C
-            new_relations = set()
-            for point1, relation12, point2 in point_relations:
-                for _, relation23, point3 in point_relations_index[point2]:
-                    relation13 = self._point_transitions[relation12][relation23]
-                    new_relation = (point1, relation13, point3)
-                    if new_relation not in point_relations:
-                        new_relations.add(new_relation)
+        # closure over inconsistent relations infers nonsense like A BEFORE A, so remember them to warn the user
+        if not graph.is_consistent():
+            for contradiction in self._contradictions(graph, annotations):
+                self.inconsistent_relations.update(contradiction)
 
         # convert the point relations back to interval relations
-        return self._to_interval_relations(point_relations, annotations)
+        return self._to_interval_relations(graph, annotations)
 
     # constants representing the start point and end point of an interval
     _start = 0
@@ -294,11 +889,186 @@ class TemporalClosureScores(object):
         "OVERLAP": [(0, _start, "<", 1, _end), (1, _start, "<", 0, _end)],
     }
 
-    # transitivity table for point relations
-    _point_transitions = {
-        "<": {"<": "<", "=": "<"},
-        "=": {"<": "<", "=": "="},
-    }
+
+class _PointGraph(object):
+    def __init__(self, point_relations, reachability=True):
+        """
+        Builds the transitive closure of a set of point relations. Points connected by "=" are merged into a single
+        node using union-find, and the nodes reachable from each node via "<" are found by walking the strongly
+        connected components of the "<" graph in reverse topological order, accumulating reachability as bitsets.
+
+        :param iterable point_relations: (point, relation, point) tuples, where the relation is "<" or "="
+        :param bool reachability: whether to accumulate reachability (needed by less(...) and related(...)); if
+            False, only the strongly connected components are found, in time linear in the number of relations
+        """
+        self._reachability = reachability
+        point_relations = list(point_relations)
+
+        # merge points connected by "=" using union-find (with path halving and union by size)
+        parent = {}
+        size = {}
+
+        def find(point):
+            while parent[point] != point:
+                parent[point] = parent[parent[point]]
+                point = parent[point]
+            return point
+
+        self._equal_points = set()
+        for point1, relation, point2 in point_relations:
+            for point in (point1, point2):
+                if point not in parent:
+                    parent[point] = point
+                    size[point] = 1
+            if relation == "=":
+                self._equal_points.add(point1)
+                self._equal_points.add(point2)
+                root1 = find(point1)
+                root2 = find(point2)
+                if root1 != root2:
+                    if size[root1] < size[root2]:
+                        root1, root2 = root2, root1
+                    parent[root2] = root1
+                    size[root1] += size[root2]
+
+        # assign each set of "=" points an integer node id
+        self._point_node = {}
+        self._node_points = []
+        root_nodes = {}
+        for point in parent:
+            root = find(point)
+            if root not in root_nodes:
+                root_nodes[root] = len(self._node_points)
+                self._node_points.append([])
+            node = root_nodes[root]
+            self._point_node[point] = node
+            self._node_points[node].append(point)
+
+        # collect the "<" edges between nodes
+        n_nodes = len(self._node_points)
+        successors = [set() for _ in range(n_nodes)]
+        for point1, relation, point2 in point_relations:
+            if relation == "<":
+                successors[self._point_node[point1]].add(self._point_node[point2])
+
+        # find strongly connected components (iterative Tarjan), which are produced in reverse topological order
+        self._node_component = [None] * n_nodes
+        self._component_reach = []
+        self._component_cyclic = []
+        index = [None] * n_nodes
+        lowlink = [None] * n_nodes
+        on_stack = [False] * n_nodes
+        stack = []
+        n_visited = 0
+        for root in range(n_nodes):
+            if index[root] is not None:
+                continue
+            index[root] = lowlink[root] = n_visited
+            n_visited += 1
+            stack.append(root)
+            on_stack[root] = True
+            work = [(root, iter(successors[root]))]
+            while work:
+                node, children = work[-1]
+                for child in children:
+                    if index[child] is None:
+                        index[child] = lowlink[child] = n_visited
+                        n_visited += 1
+                        stack.append(child)
+                        on_stack[child] = True
+                        work.append((child, iter(successors[child])))
+                        break
+                    elif on_stack[child]:
+                        lowlink[node] = min(lowlink[node], index[child])
+                else:
+                    work.pop()
+                    if work:
+                        parent_node = work[-1][0]
+                        lowlink[parent_node] = min(lowlink[parent_node], lowlink[node])
+                    if lowlink[node] == index[node]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack[member] = False
+                            component.append(member)
+                            if member == node:
+                                break
+                        self._add_component(component, successors)
+
+    def _add_component(self, component, successors):
+        component_index = len(self._component_cyclic)
+        for node in component:
+            self._node_component[node] = component_index
+
+        # a component is contradictory if it contains a "<" cycle (all edges between nodes are "<")
+        cyclic = len(component) > 1 or any(node in successors[node] for node in component)
+        self._component_cyclic.append(cyclic)
+
+        # all components reachable from this one have already been added, so their reachability is known, and a
+        # component reaches everything its successors reach, and itself if it contains a "<" cycle
+        if self._reachability:
+            reach = 0
+            for node in component:
+                for child in successors[node]:
+                    child_component = self._node_component[child]
+                    if child_component != component_index:
+                        reach |= self._component_reach[child_component]
+                        reach |= 1 << child
+            if cyclic:
+                for node in component:
+                    reach |= 1 << node
+            self._component_reach.append(reach)
+
+    def _reach(self, node):
+        return self._component_reach[self._node_component[node]]
+
+    def less(self, point1, point2):
+        """
+        :return bool: True if point1 < point2 can be inferred
+        """
+        node1 = self._point_node.get(point1)
+        node2 = self._point_node.get(point2)
+        return node1 is not None and node2 is not None and bool(self._reach(node1) >> node2 & 1)
+
+    def equal(self, point1, point2):
+        """
+        :return bool: True if point1 = point2 can be inferred
+        """
+        node1 = self._point_node.get(point1)
+        return node1 is not None and node1 == self._point_node.get(point2) and point1 in self._equal_points
+
+    def is_consistent(self):
+        """
+        :return bool: True if no point can be inferred to be before itself
+        """
+        return not any(self._component_cyclic)
+
+    def contradiction(self, point):
+        """
+        :return int: an identifier of the contradiction (a strongly connected component containing a "<" relation)
+            that the point is part of, or None if the point is not part of any contradiction
+        """
+        node = self._point_node.get(point)
+        if node is not None:
+            component = self._node_component[node]
+            if self._component_cyclic[component]:
+                return component
+        return None
+
+    def related(self):
+        """
+        :return iter: an iterator of (points, points) where every point in the first list has an inferable relation
+            to every point in the second list, covering all inferable point relations
+        """
+        for node, points in enumerate(self._node_points):
+            equal_points = [point for point in points if point in self._equal_points]
+            if equal_points:
+                yield equal_points, equal_points
+            reach = self._reach(node)
+            while reach:
+                lowest_bit = reach & -reach
+                yield points, self._node_points[lowest_bit.bit_length() - 1]
+                reach ^= lowest_bit
 
 
 @functools.total_ordering
@@ -355,8 +1125,14 @@ class ToSet(object):
         return False
 
     def key(self, annotation):
+        return self._key(annotation, {})
+
+    def _key(self, annotation, memo):
+        # annotations nested in several relations have their keys calculated only once (per memo)
         if not isinstance(annotation, anafora.AnaforaAnnotation):
             return annotation
+        if id(annotation) in memo:
+            return memo[id(annotation)]
         spans = self._spans(annotation)
         props = None
         if self.prop_name == "*":
@@ -371,14 +1147,15 @@ class ToSet(object):
                 if isinstance(value, anafora.AnaforaAnnotation):
                     if self.select.is_excluded(value.type):
                         continue
-                props.append((name, self.key(value)))
+                props.append((name, self._key(value, memo)))
             props = tuple(props)
         elif self.prop_name is not None and annotation.type == self.type_name:
             if self.select(annotation.type, self.prop_name, self.prop_value):
                 if self.prop_name in annotation.properties:
-                    value = self.key(annotation.properties[self.prop_name])
+                    value = self._key(annotation.properties[self.prop_name], memo)
                     props = self.prop_name, value
-        return spans, annotation.type, props
+        key = memo[id(annotation)] = spans, annotation.type, props
+        return key
 
     def _spans(self, annotation):
         if isinstance(annotation, anafora.AnaforaEntity):
@@ -397,108 +1174,1616 @@ class ToSet(object):
         return spans
 
     def __call__(self, iterable):
-        return {self.key(x) for x in iterable if self.accept(x)}
+        memo = {}
+        return {self._key(x, memo) for x in iterable if self.accept(x)}
 
+    def interned(self, iterable, interner):
+        """
+        :param iterable iterable: the annotations
+        :param _KeyInterner interner: the interner that assigns integer ids to keys
+        :return set: the integer ids of the keys of the accepted annotations
+        """
+        memo = {}
+        return {interner(self._key(x, memo)) for x in iterable if self.accept(x)}
 
-def score_data(reference_data, predicted_data, include=None, exclude=None,
-               scores_type=Scores, spans_type=None):
-    """
-    :param AnaforaData reference_data: reference ("gold standard") Anafora data
-    :param AnaforaData predicted_data: predicted (system-generated) Anafora data
-    :param set include: types of annotations to include (others will be excluded); may be type names,
-        (type-name, property-name) tuples, (type-name, property-name, property-value) tuples
-    :param set exclude: types of annotations to exclude; may be type names, (type-name, property-name) tuples,
-        (type-name, property-name, property-value) tuples
-    :param type scores_type: type for calculating matches between predictions and reference
-    :param type spans_type: wrapper object to apply to annotation spans
-    :return dict: mapping from (annotation type[, property name[, property value]]) to Scores object
-    """
 
-    # returns true if this type:property:value is accepted by includes= and excludes=
-    select = anafora.select.Select(include, exclude)
+class _KeyInterner(object):
+    def __init__(self):
+        """
+        Assigns an integer id to each distinct annotation key of a document, so that the (deeply nested) keys are
+        hashed only once, and the reference and predicted annotations can be compared as sets of integers. The same
+        interner must be used for all the annotation sets that are compared to each other.
+        """
+        self._ids = {}
 
-    # get reference and predicted annotations
-    reference_annotations = reference_data.annotations
-    predicted_annotations = [] if predicted_data is None else predicted_data.annotations
+    def __call__(self, key):
+        """
+        :param key: the key of an annotation, as produced by ToSet.key
+        :return int: the id of the key
+        """
+        return self._ids.setdefault(key, len(self._ids))
 
-    # determines available views by examining all the annotations
-    span = "<span>"
-    views = {}
-    if select("*"):
-        views["*"] = ToSet(select=select,
-                           spans_type=spans_type)
-    if select("*", span):
-        views["*", span] = ToSet(select=select,
-                                 spans_type=spans_type,
-                                 prop_name=None)
-    for annotations in [reference_annotations, predicted_annotations]:
-        for ann in annotations:
-            if ann.type not in views:
-                if select(ann.type):
-                    views[ann.type] = ToSet(select=select,
-                                            spans_type=spans_type,
-                                            type_name=ann.type)
-            if (ann.type, span) not in views:
-                if select(ann.type, span):
-                    views[ann.type, span] = ToSet(select=select,
-                                                  spans_type=spans_type,
-                                                  type_name=ann.type,
-                                                  prop_name=None)
-            for prop_name, prop_value in ann.properties.items():
-                if (ann.type, prop_name) not in views:
-                    if select(ann.type, prop_name):
-                        views[ann.type, prop_name] = ToSet(
-                            select=select,
-                            spans_type=spans_type,
-                            type_name=ann.type,
-                            prop_name=prop_name)
-                if not isinstance(prop_value, anafora.AnaforaAnnotation):
-                    if (ann.type, prop_name, prop_value) not in views:
-                        if select(ann.type, prop_name, prop_value):
-                            if prop_value is not None:
-                                views[ann.type, prop_name, prop_value] = ToSet(
-                                    select=select,
-                                    spans_type=spans_type,
-                                    type_name=ann.type,
-                                    prop_name=prop_name,
-                                    prop_value=prop_value)
+    def lookup(self, key):
+        """
+        :param key: the key of an annotation, as produced by ToSet.key
+        :return int: the id of the key, or None if the key has never been seen (no id is assigned to it)
+        """
+        return self._ids.get(key)
 
-    # fill a mapping from a name (type, type:property or type:property:value) to the corresponding scores
-    result = collections.defaultdict(lambda: scores_type())
-    for view_name in sorted(views, key=lambda x: x if isinstance(x, tuple) else (x,)):
-        to_set = views[view_name]
-        set1 = to_set(reference_annotations)
-        set2 = to_set(predicted_annotations)
-        result[view_name].add(set1, set2)
 
-    # return the collected scores
-    return result
+class _KeyLookup(object):
+    def __init__(self, interner):
+        """
+        Looks up the ids of keys in an interner without adding to it. Keys that the interner has never seen are
+        given negative ids local to this lookup; such keys cannot match anything the interner has seen, so the
+        comparisons are the same as with the interner itself, but a long-lived interner (e.g., of a reference that
+        is scored again and again) does not grow with the keys of each new prediction.
 
+        :param _KeyInterner interner: the interner whose ids are looked up
+        """
+        self.interner = interner
+        self._ids = {}
 
-def _load(xml_path):
-    """
-    Tries to load data from an Anafora XML file, issuing errors on failure.
+    def __call__(self, key):
+        """
+        :param key: the key of an annotation, as produced by ToSet.key
+        :return int: the id of the key
+        """
+        result = self.interner.lookup(key)
+        if result is None:
+            result = self._ids.setdefault(key, -1 - len(self._ids))
+        return result
 
-    :param xml_path: the path to an Anafora XML file
-    :return AnaforaData: the data loaded from the XML, or None if there was a failure
+
+def _to_set(view_name, select, spans_type=None):
     """
-    if not os.path.exists(xml_path):
-        logging.warn("%s: no such file", xml_path)
-        return None
-    try:
-        data = anafora.AnaforaData.from_file(xml_path)
-    except anafora.ElementTree.ParseError:
-        logging.warn("%s: ignoring invalid XML", xml_path)
-        return None
+    :param view_name: the name of the view, e.g., (annotation type[, property name[, property value]])
+    :param Select select: returns true if a type:property:value is accepted by includes= and excludes=
+    :param type spans_type: wrapper object to apply to annotation spans
+    :return ToSet: the ToSet that selects the annotations of the view
+    """
+    if not isinstance(view_name, tuple):
+        view_name = view_name,
+    type_name = view_name[0]
+    if len(view_name) == 1:
+        return ToSet(select=select, spans_type=spans_type, type_name=type_name)
+    elif view_name[1] == "<span>":
+        return ToSet(select=select, spans_type=spans_type, type_name=type_name, prop_name=None)
+    elif len(view_name) == 2:
+        return ToSet(select=select, spans_type=spans_type, type_name=type_name, prop_name=view_name[1])
     else:
-        return data
+        return ToSet(select=select, spans_type=spans_type, type_name=type_name, prop_name=view_name[1],
+                     prop_value=view_name[2])
 
 
-def score_dirs(reference_dir, predicted_dir, xml_name_regex="[.]xml$", text_dir=None,
-               include=None, exclude=None, scores_type=Scores, spans_type=None):
+class _ViewFilter(object):
+    def __init__(self, schema=None, view_names=None):
+        """
+        Restricts the views that are scored, either to an explicit list of views, or (given a schema) to the
+        (type, property, value) views of only those properties whose values are chosen from a fixed list (so that
+        free-text properties, e.g., comments, do not create a view for each distinct value).
+
+        :param Schema schema: the Anafora schema (see anafora.validate.Schema) of the annotations
+        :param list view_names: the names of the only views to be scored, e.g., (annotation type[, property
+            name[, property value]]); if None, views are discovered from the annotations
+        """
+        self.schema = schema
+        self.view_names = view_names
+
+    def __call__(self, view_name):
+        """
+        :param view_name: the name of the view, e.g., (annotation type[, property name[, property value]])
+        :return bool: True if the view should be scored
+        """
+        if self.view_names is not None:
+            return view_name in self.view_names
+        if self.schema is not None and isinstance(view_name, tuple) and len(view_name) == 3:
+            type_name, prop_name, _ = view_name
+            schema_property = self.schema.type_to_properties.get(type_name, {}).get(prop_name)
+            return schema_property is not None and schema_property.choices is not None
+        return True
+
+    def settings(self):
+        """
+        :return list: a summary of the restrictions, which is the same whenever the same views would be scored
+        """
+        choice_properties = None
+        if self.schema is not None:
+            choice_properties = sorted((type_name, prop_name)
+                                       for type_name, properties in self.schema.type_to_properties.items()
+                                       for prop_name, schema_property in properties.items()
+                                       if schema_property.choices is not None)
+        view_names = None if self.view_names is None else _normalize_select_items(self.view_names)
+        return [choice_properties, view_names]
+
+
+def _views(annotations, select, spans_type=None, view_filter=None):
+    """
+    :param iterable annotations: the annotations to be examined
+    :param Select select: returns true if a type:property:value is accepted by includes= and excludes=
+    :param type spans_type: wrapper object to apply to annotation spans
+    :param _ViewFilter view_filter: restricts the views that are returned; if None, all views are returned
+    :return dict: mapping from (annotation type[, property name[, property value]]) to the ToSet for that view
+    """
+
+    # if the views are listed explicitly, there is no need to look for them in the annotations
+    if view_filter is not None and view_filter.view_names is not None:
+        return {view_name: _to_set(view_name, select, spans_type) for view_name in view_filter.view_names}
+
+    span = "<span>"
+    views = {}
+    if select("*"):
+        views["*"] = _to_set("*", select, spans_type)
+    if select("*", span):
+        views["*", span] = _to_set(("*", span), select, spans_type)
+    for ann in annotations:
+        if ann.type not in views:
+            if select(ann.type):
+                views[ann.type] = _to_set(ann.type, select, spans_type)
+        if (ann.type, span) not in views:
+            if select(ann.type, span):
+                views[ann.type, span] = _to_set((ann.type, span), select, spans_type)
+        for prop_name, prop_value in ann.properties.items():
+            if (ann.type, prop_name) not in views:
+                if select(ann.type, prop_name):
+                    views[ann.type, prop_name] = _to_set((ann.type, prop_name), select, spans_type)
+            if not isinstance(prop_value, anafora.AnaforaAnnotation):
+                if (ann.type, prop_name, prop_value) not in views:
+                    if select(ann.type, prop_name, prop_value):
+                        if prop_value is not None and (
+                                view_filter is None or view_filter((ann.type, prop_name, prop_value))):
+                            views[ann.type, prop_name, prop_value] = _to_set(
+                                (ann.type, prop_name, prop_value), select, spans_type)
+    return views
+
+
+class _AnnotationSets(object):
+    def __init__(self, annotations, select, spans_type=None, view_filter=None, interner=None, profile=None):
+        """
+        The views found in a single document's annotations, and the set of annotations for each view, calculated on
+        demand and then cached, so that they can be reused across comparisons (e.g., with many predicted documents).
+
+        :param iterable annotations: the annotations of a single document
+        :param Select select: returns true if a type:property:value is accepted by includes= and excludes=
+        :param type spans_type: wrapper object to apply to annotation spans
+        :param _ViewFilter view_filter: restricts the views that are scored; if None, all views are scored
+        :param _KeyInterner interner: the interner that assigns integer ids to keys when these annotations are the
+            reference (e.g., to share ids among several annotators); if None, a new interner is created
+        :param PhaseProfile profile: where the time spent discovering views and constructing keys is recorded; if
+            None, nothing is recorded
+        """
+        self.annotations = annotations
+        self.select = select
+        self.spans_type = spans_type
+        self.view_filter = view_filter
+        self.profile = _no_phase_profile if profile is None else profile
+        with self.profile.phase("view discovery") as timer:
+            self.views = _views(annotations, select, spans_type, view_filter)
+            timer.items = len(self.views)
+        self.interner = _KeyInterner() if interner is None else interner
+        self._view_sets = {}
+        self._interned_view_sets = {}
+        self._interned_view_sets_interner = None
+
+    def get(self, view_name, to_set):
+        """
+        :param view_name: the name of the view, e.g., (annotation type[, property name[, property value]])
+        :param ToSet to_set: the ToSet for the view, used if the set has not already been calculated
+        :return set: the annotations in the view
+        """
+        if view_name not in self._view_sets:
+            with self.profile.phase("key construction") as timer:
+                self._view_sets[view_name] = to_set(self.annotations)
+                timer.items = len(self._view_sets[view_name])
+        return self._view_sets[view_name]
+
+    def get_interned(self, view_name, to_set, interner):
+        """
+        :param view_name: the name of the view, e.g., (annotation type[, property name[, property value]])
+        :param ToSet to_set: the ToSet for the view, used if the set has not already been calculated
+        :param _KeyInterner interner: the interner that assigns integer ids to keys
+        :return set: the integer ids of the annotations in the view
+        """
+
+        # ids from one interner are meaningless to another, so a different interner means starting over
+        if interner is not self._interned_view_sets_interner:
+            self._interned_view_sets = {}
+            self._interned_view_sets_interner = interner
+        if view_name not in self._interned_view_sets:
+            with self.profile.phase("key construction") as timer:
+                if view_name in self._view_sets:
+                    interned_set = {interner(key) for key in self._view_sets[view_name]}
+                else:
+                    interned_set = to_set.interned(self.annotations, interner)
+                timer.items = len(interned_set)
+            self._interned_view_sets[view_name] = interned_set
+        return self._interned_view_sets[view_name]
+
+
+def _view_set_pairs(reference_sets, predicted_sets, scores_type=Scores, predicted_interner=None):
+    """
+    :param _AnnotationSets reference_sets: reference ("gold standard") annotation sets
+    :param _AnnotationSets predicted_sets: predicted (system-generated) annotation sets
+    :param type scores_type: type for calculating matches between predictions and reference
+    :param predicted_interner: the interner for the predicted keys (e.g., a _KeyLookup of the reference interner);
+        if None, the reference interner is used
+    :return iter: an iterator of (view-name, reference-set, predicted-set) for each view, in sorted order
+    """
+
+    # the available views are all those found in either the reference or the predicted annotations
+    views = dict(reference_sets.views)
+    views.update(predicted_sets.views)
+
+    # if the scores only count annotations, compare integer ids instead of annotation keys, where the ids are
+    # assigned by the reference (so that they are shared by all predictions compared to that reference); keys with
+    # wrapped spans (e.g., _OverlappingSpans) may be equal without being the same, so they cannot be interned
+    interner = None
+    if getattr(scores_type, "_internable", False) and reference_sets.spans_type is None:
+        interner = reference_sets.interner
+    if predicted_interner is None:
+        predicted_interner = interner
+
+    for view_name in sorted(views, key=lambda x: x if isinstance(x, tuple) else (x,)):
+        to_set = views[view_name]
+        if interner is not None:
+            set1 = reference_sets.get_interned(view_name, to_set, interner)
+            set2 = predicted_sets.get_interned(view_name, to_set, predicted_interner)
+        else:
+            set1 = reference_sets.get(view_name, to_set)
+            set2 = predicted_sets.get(view_name, to_set)
+        yield view_name, set1, set2
+
+
+def _score_sets(reference_sets, predicted_sets, scores_type=Scores, predicted_interner=None, profile=None,
+                document_name=None):
+    """
+    :param _AnnotationSets reference_sets: reference ("gold standard") annotation sets
+    :param _AnnotationSets predicted_sets: predicted (system-generated) annotation sets
+    :param type scores_type: type for calculating matches between predictions and reference
+    :param predicted_interner: the interner for the predicted keys (e.g., a _KeyLookup of the reference interner);
+        if None, the reference interner is used
+    :param PhaseProfile profile: where the time spent comparing the sets is recorded; if None, nothing is recorded
+    :param string document_name: the name of the document, used in warnings; if None, warnings name no document
+    :return dict: mapping from (annotation type[, property name[, property value]]) to Scores object
+    """
+    if profile is None:
+        profile = _no_phase_profile
+
+    # fill a mapping from a name (type, type:property or type:property:value) to the corresponding scores
+    result = collections.defaultdict(lambda: scores_type())
+    for view_name, set1, set2 in _view_set_pairs(reference_sets, predicted_sets, scores_type, predicted_interner):
+        scores = result[view_name]
+
+        # temporal closure scores spend their time on closure, not on set intersection
+        phase_name = "temporal closure" if isinstance(scores, TemporalClosureScores) else "set intersection"
+        with profile.phase(phase_name) as timer:
+            scores.add(set1, set2)
+            timer.items = len(set1) + len(set2)
+
+    # warn once about any relations that were inconsistent for temporal closure in any of the views
+    _log_inconsistent_relations(document_name, result.values())
+
+    # return the collected scores
+    return result
+
+
+def _log_inconsistent_relations(document_name, scores_list):
+    """
+    Logs a single warning for the relations of a document that were inconsistent for temporal closure, and clears
+    them from the scores, so that a document scored over many views (or many systems) does not flood the log.
+
+    :param string document_name: the name of the document; if None, the warning names no document
+    :param iter scores_list: the scores objects of the document; only TemporalClosureScores are considered
+    """
+    relations = set()
+    for scores in scores_list:
+        if isinstance(scores, TemporalClosureScores):
+            relations.update(scores.inconsistent_relations)
+            scores.inconsistent_relations.clear()
+    if relations:
+        sample = sorted(relations, key=repr)[:_inconsistent_relations_sample_size]
+        prefix = "" if document_name is None else "{0}: ".format(document_name)
+        logging.warning("{0}{1} relations are inconsistent for temporal closure, e.g., {2}; run python -m "
+                        "anafora.validate --temporal-contradictions for the full list".format(
+                            prefix, len(relations), sample))
+
+
+# the number of inconsistent relations shown in the warning for each document
+_inconsistent_relations_sample_size = 3
+
+
+class CorpusScores(object):
+    def __init__(self, scores_type=Scores, keep_documents=True):
+        """
+        Accumulates the scores of many documents. Each view is assigned an integer id, and the counts of each
+        document (and of the whole corpus) are kept in arrays indexed by view id, rather than in a Scores object
+        per view per document. Scores objects are only created when the merged scores are requested.
+
+        :param type scores_type: type for calculating matches between predictions and reference; must keep only
+            counts (i.e., not the errors of DebuggingScores)
+        :param bool keep_documents: whether the counts of each document should be kept (as needed by macro(...)
+            and matrix(...)); if False, only the counts of the whole corpus are kept
+        """
+        self.scores_type = scores_type
+        self._scores = scores_type()
+        if not hasattr(self._scores, "_count_names") or hasattr(self._scores, "errors"):
+            raise ValueError("{0} scores cannot be accumulated as counts".format(type(self._scores).__name__))
+        self.count_names = self._scores._count_names
+        self.keep_documents = keep_documents
+        self.view_names = []
+        self.document_names = []
+        self._view_ids = {}
+        self._totals = array.array("q")
+        self._document_counts = []
+
+    def _view_offset(self, view_name):
+        view_id = self._view_ids.get(view_name)
+        if view_id is None:
+            view_id = self._view_ids[view_name] = len(self.view_names)
+            self.view_names.append(view_name)
+            self._totals.extend([0] * len(self.count_names))
+        return view_id * len(self.count_names)
+
+    def _add_counts(self, view_name, counts):
+        offset = self._view_offset(view_name)
+        for i, count in enumerate(counts):
+            self._totals[offset + i] += count
+        if self.keep_documents:
+            document_counts = self._document_counts[-1]
+            if len(document_counts) <= offset:
+                document_counts.extend([0] * (offset + len(self.count_names) - len(document_counts)))
+            for i, count in enumerate(counts):
+                document_counts[offset + i] += count
+
+    def _check_documents(self):
+        if not self.keep_documents:
+            raise ValueError("the counts of each document were not kept")
+
+    def add_document(self, document_name):
+        """
+        Starts a new document, to which the counts of subsequent add(...) and update(...) calls are added.
+
+        :param string document_name: the name of the document
+        """
+        if self.keep_documents:
+            self.document_names.append(document_name)
+            self._document_counts.append(array.array("q"))
+
+    def add(self, view_name, reference, predicted):
+        """
+        :param view_name: the name of the view, e.g., (annotation type[, property name[, property value]])
+        :param set reference: the reference annotations of the view in the current document
+        :param set predicted: the predicted annotations of the view in the current document
+        """
+
+        # a single scores object is reset and reused to calculate the counts for each view
+        for count_name in self.count_names:
+            setattr(self._scores, count_name, 0)
+        self._scores.add(reference, predicted)
+        self._add_counts(view_name, [getattr(self._scores, count_name) for count_name in self.count_names])
+
+    def add_sets(self, document_name, reference_sets, predicted_sets, predicted_interner=None, profile=None):
+        """
+        :param string document_name: the name of the document
+        :param _AnnotationSets reference_sets: reference ("gold standard") annotation sets of the document
+        :param _AnnotationSets predicted_sets: predicted (system-generated) annotation sets of the document
+        :param predicted_interner: the interner for the predicted keys (e.g., a _KeyLookup of the reference interner);
+            if None, the reference interner is used
+        :param PhaseProfile profile: where the time spent comparing the sets is recorded; if None, nothing is recorded
+        """
+        if profile is None:
+            profile = _no_phase_profile
+        self.add_document(document_name)
+
+        # temporal closure scores spend their time on closure, not on set intersection
+        phase_name = "temporal closure" if isinstance(self._scores, TemporalClosureScores) else "set intersection"
+        for view_name, reference, predicted in _view_set_pairs(
+                reference_sets, predicted_sets, self.scores_type, predicted_interner):
+            with profile.phase(phase_name) as timer:
+                self.add(view_name, reference, predicted)
+                timer.items = len(reference) + len(predicted)
+
+        # warn once about any relations that were inconsistent for temporal closure in any of the views
+        _log_inconsistent_relations(document_name, [self._scores])
+
+    def update(self, document_name, named_scores):
+        """
+        :param string document_name: the name of the document
+        :param dict named_scores: mapping from (annotation type[, property name[, property value]]) to the Scores
+            object of the document (as produced by score_data, score_dirs, etc.)
+        """
+        self.add_document(document_name)
+        for view_name, scores in named_scores.items():
+            self._add_counts(view_name, [getattr(scores, count_name) for count_name in self.count_names])
+
+    def _to_scores(self, counts, offset):
+        scores = self.scores_type()
+        for i, count_name in enumerate(self.count_names):
+            setattr(scores, count_name, counts[offset + i] if offset + i < len(counts) else 0)
+        return scores
+
+    def micro(self):
+        """
+        :return dict: mapping from (annotation type[, property name[, property value]]) to a Scores object with
+            the counts of all documents (i.e., micro-averaged scores)
+        """
+        return {view_name: self._to_scores(self._totals, view_id * len(self.count_names))
+                for view_name, view_id in self._view_ids.items()}
+
+    def macro(self):
+        """
+        :return dict: mapping from (annotation type[, property name[, property value]]) to a (precision, recall,
+            F1) tuple averaged over all documents with reference or predicted annotations in the view (i.e.,
+            macro-averaged scores)
+        """
+        self._check_documents()
+        result = {}
+        for view_name, view_id in self._view_ids.items():
+            offset = view_id * len(self.count_names)
+            metrics = []
+            for document_counts in self._document_counts:
+                scores = self._to_scores(document_counts, offset)
+                if scores.reference or scores.predicted:
+                    metrics.append((scores.precision(), scores.recall(), scores.f1()))
+            result[view_name] = tuple(sum(values) / max(len(values), 1) for values in zip(*metrics)) or (1.0,) * 3
+        return result
+
+    def matrix(self, count_name):
+        """
+        :param string count_name: the count, e.g., "reference", "predicted" or "correct"
+        :return list: a row for each document (in the order of document_names) of the count for each view (in the
+            order of view_names)
+        """
+        self._check_documents()
+        i = self.count_names.index(count_name)
+        step = len(self.count_names)
+        return [[counts[offset + i] if offset + i < len(counts) else 0
+                 for offset in range(0, len(self.view_names) * step, step)]
+                for counts in self._document_counts]
+
+
+def score_data(reference_data, predicted_data, include=None, exclude=None,
+               scores_type=Scores, spans_type=None, schema=None, views=None, profile=None, align_arguments=False):
+    """
+    :param AnaforaData reference_data: reference ("gold standard") Anafora data
+    :param AnaforaData predicted_data: predicted (system-generated) Anafora data
+    :param set include: types of annotations to include (others will be excluded); may be type names,
+        (type-name, property-name) tuples, (type-name, property-name, property-value) tuples
+    :param set exclude: types of annotations to exclude; may be type names, (type-name, property-name) tuples,
+        (type-name, property-name, property-value) tuples
+    :param type scores_type: type for calculating matches between predictions and reference
+    :param type spans_type: wrapper object to apply to annotation spans
+    :param Schema schema: the Anafora schema (see anafora.validate.Schema) of the annotations; if given,
+        (type, property, value) views are only scored for properties whose values are chosen from a fixed list
+    :param list views: the names of the only views to be scored, e.g., (annotation type[, property name[, property
+        value]]); if None, all views found in the annotations are scored
+    :param PhaseProfile profile: where the time spent in each phase (view discovery, key construction, etc.) is
+        recorded; if None, nothing is recorded
+    :param bool align_arguments: whether the arguments of predicted relations should be replaced by the overlapping
+        reference entities they are aligned to, so that relations are not penalized for slightly misaligned arguments
+    :return dict: mapping from (annotation type[, property name[, property value]]) to Scores object
+    """
+
+    # returns true if this type:property:value is accepted by includes= and excludes=
+    select = anafora.select.Select(include, exclude)
+    view_filter = None if schema is None and views is None else _ViewFilter(schema, views)
+
+    # get reference and predicted annotations
+    reference_annotations = reference_data.annotations
+    predicted_annotations = [] if predicted_data is None else predicted_data.annotations
+    if align_arguments:
+        predicted_annotations = _align_arguments(reference_annotations, predicted_annotations)
+
+    # determine the available views and score the annotations in each
+    return _score_sets(_AnnotationSets(reference_annotations, select, spans_type, view_filter, profile=profile),
+                       _AnnotationSets(predicted_annotations, select, spans_type, view_filter, profile=profile),
+                       scores_type=scores_type, profile=profile)
+
+
+class _RecordEntity(anafora.AnaforaEntity):
+
+    # the XML-backed attributes of AnaforaEntity are replaced by plain attributes (there is no XML, and no id)
+    id = None
+    spans = None
+    type = None
+    properties = None
+
+    # records are compared by identity, as their (dict) properties are not hashable
+    __eq__ = object.__eq__
+    __ne__ = object.__ne__
+    __hash__ = object.__hash__
+
+    def __init__(self, spans, type_name):
+        """
+        :param tuple spans: the (start, end) character offsets of the entity
+        :param str type_name: the type of the entity
+        """
+        self.xml = None
+        self._annotations = None
+        self.spans = spans
+        self.type = type_name
+        self.properties = {}
+
+
+class _RecordRelation(anafora.AnaforaRelation):
+
+    # the XML-backed attributes of AnaforaRelation are replaced by plain attributes (there is no XML, and no id)
+    id = None
+    type = None
+    properties = None
+
+    # records are compared by identity, as their (dict) properties are not hashable
+    __eq__ = object.__eq__
+    __ne__ = object.__ne__
+    __hash__ = object.__hash__
+
+    def __init__(self, type_name):
+        """
+        :param str type_name: the type of the relation
+        """
+        self.xml = None
+        self._annotations = None
+        self.type = type_name
+        self.properties = {}
+
+
+def _from_records(records):
+    """
+    :param iterable records: (spans, type, properties) records, one per annotation, where spans is a sequence of
+        (start, end) character offsets (or None for a relation), and properties is a mapping from property name to
+        either a value or another record (to refer to another annotation)
+    :return list: the annotations of the top-level records, without any of the overhead of Anafora XML
+    """
+
+    # records nested in several others are converted only once, so they are the same annotation everywhere
+    memo = {}
+
+    def convert(record):
+        if id(record) in memo:
+            return memo[id(record)]
+        spans, type_name, properties = record
+        if spans is None:
+            annotation = _RecordRelation(type_name)
+        else:
+            annotation = _RecordEntity(tuple(tuple(span) for span in spans), type_name)
+        memo[id(record)] = annotation
+        for name, value in (properties or {}).items():
+            if isinstance(value, (tuple, list)):
+                value = convert(value)
+            annotation.properties[name] = value
+        return annotation
+
+    return [convert(record) for record in records]
+
+
+class _RecordsData(object):
+    def __init__(self, annotations):
+        """
+        Stands in for the AnaforaData of annotations that were not loaded from Anafora XML.
+
+        :param list annotations: the annotations (e.g., from _from_records)
+        """
+        self.annotations = annotations
+
+
+def _align_arguments(reference_annotations, predicted_annotations):
+    """
+    Aligns each predicted entity to (at most) one overlapping reference entity of the same type, and rewrites the
+    predicted relations so that their arguments have the spans of the aligned reference entities. Predicted entities
+    themselves are left unchanged, so only the scores of relations are affected.
+
+    :param iterable reference_annotations: the reference annotations of a single document
+    :param iterable predicted_annotations: the predicted annotations of the same document
+    :return list: the predicted annotations, with each relation replaced by a rewritten copy
+    """
+
+    # match the entities one-to-one by the IoU of their spans
+    sides = [[annotation for annotation in annotations if isinstance(annotation, anafora.AnaforaEntity)]
+             for annotations in (reference_annotations, predicted_annotations)]
+    reference_entities, predicted_entities = sides
+    matches = _span_matching(*[[(entity.type, entity.spans) for entity in entities] for entities in sides])
+    aligned_spans = {id(predicted_entities[predicted_index]): reference_entities[reference_index].spans
+                     for reference_index, predicted_index, _ in matches}
+
+    # annotations nested in several relations are rewritten only once, so they are the same annotation everywhere
+    memo = {}
+
+    def rewrite(annotation):
+        if id(annotation) in memo:
+            return memo[id(annotation)]
+        if isinstance(annotation, anafora.AnaforaEntity):
+            if id(annotation) not in aligned_spans:
+                memo[id(annotation)] = annotation
+                return annotation
+            result = _RecordEntity(aligned_spans[id(annotation)], annotation.type)
+        else:
+            result = _RecordRelation(annotation.type)
+        memo[id(annotation)] = result
+        for name, value in annotation.properties.items():
+            if isinstance(value, anafora.AnaforaAnnotation):
+                value = rewrite(value)
+            result.properties[name] = value
+        return result
+
+    return [rewrite(annotation) if isinstance(annotation, anafora.AnaforaRelation) else annotation
+            for annotation in predicted_annotations]
+
+
+class CorpusScorer(object):
+    def __init__(self, include=None, exclude=None, scores_type=Scores, spans_type=None, schema=None, views=None):
+        """
+        Scores predicted annotations against reference annotations in memory (e.g., on a development set after each
+        epoch of training a model). The views and annotation keys of each reference are calculated the first time
+        it is scored and then reused, so scoring the same references again only costs the predictions.
+
+        References are identified by object identity (not content), so the same AnaforaData objects or record
+        lists must be passed in each call, and must not be modified in between. The scorer keeps each reference
+        alive for as long as the scorer itself, unless clear() is called.
+
+        :param set include: types of annotations to include (others will be excluded); may be type names,
+            (type-name, property-name) tuples, (type-name, property-name, property-value) tuples
+        :param set exclude: types of annotations to exclude; may be type names, (type-name, property-name) tuples,
+            (type-name, property-name, property-value) tuples
+        :param type scores_type: type for calculating matches between predictions and reference
+        :param type spans_type: wrapper object to apply to annotation spans
+        :param Schema schema: the Anafora schema (see anafora.validate.Schema) of the annotations; if given,
+            (type, property, value) views are only scored for properties whose values are chosen from a fixed list
+        :param list views: the names of the only views to be scored, e.g., (annotation type[, property name[,
+            property value]]); if None, all views found in the annotations are scored
+        """
+        self.select = anafora.select.Select(include, exclude)
+        self.scores_type = scores_type
+        self.spans_type = spans_type
+        self.view_filter = None if schema is None and views is None else _ViewFilter(schema, views)
+        self._reference_sets = {}
+
+    def _sets(self, data):
+        if data is None:
+            annotations = []
+        elif isinstance(data, anafora.AnaforaData):
+            annotations = data.annotations
+        else:
+            annotations = _from_records(data)
+        return _AnnotationSets(annotations, self.select, self.spans_type, self.view_filter)
+
+    def reference_sets(self, reference):
+        """
+        :param reference: the reference annotations of a document, as an AnaforaData or a list of (spans, type,
+            properties) records
+        :return _AnnotationSets: the (cached) annotation sets of the reference
+        """
+
+        # the reference object is kept with its sets, so that its id cannot be reused by another object
+        entry = self._reference_sets.get(id(reference))
+        if entry is None:
+            entry = self._reference_sets[id(reference)] = reference, self._sets(reference)
+        return entry[1]
+
+    def score(self, pairs):
+        """
+        :param iterable pairs: (reference, predicted) pairs, one per document, where each is an AnaforaData or a
+            list of (spans, type, properties) records (see _from_records), and predicted may be None
+        :return dict: mapping from (annotation type[, property name[, property value]]) to Scores object, merged
+            over all the documents
+        """
+        internable = getattr(self.scores_type, "_internable", False) and self.spans_type is None
+        result = collections.defaultdict(lambda: self.scores_type())
+        for reference, predicted in pairs:
+            reference_sets = self.reference_sets(reference)
+
+            # predicted keys are looked up in (but not added to) the reference interner, so it stays the same size
+            predicted_interner = _KeyLookup(reference_sets.interner) if internable else None
+            for view_name, set1, set2 in _view_set_pairs(
+                    reference_sets, self._sets(predicted), self.scores_type, predicted_interner):
+                result[view_name].add(set1, set2)
+        return result
+
+    def clear(self):
+        """
+        Forgets all the cached references.
+        """
+        self._reference_sets.clear()
+
+
+def score_corpus(pairs, include=None, exclude=None, scores_type=Scores, spans_type=None, schema=None, views=None,
+                 scorer=None):
+    """
+    :param iterable pairs: (reference, predicted) pairs, one per document, where each is an AnaforaData or a list
+        of (spans, type, properties) records (see _from_records), and predicted may be None
+    :param set include: types of annotations to include (others will be excluded); may be type names,
+        (type-name, property-name) tuples, (type-name, property-name, property-value) tuples
+    :param set exclude: types of annotations to exclude; may be type names, (type-name, property-name) tuples,
+        (type-name, property-name, property-value) tuples
+    :param type scores_type: type for calculating matches between predictions and reference
+    :param type spans_type: wrapper object to apply to annotation spans
+    :param Schema schema: the Anafora schema (see anafora.validate.Schema) of the annotations; if given,
+        (type, property, value) views are only scored for properties whose values are chosen from a fixed list
+    :param list views: the names of the only views to be scored, e.g., (annotation type[, property name[, property
+        value]]); if None, all views found in the annotations are scored
+    :param CorpusScorer scorer: the scorer to use (ignoring all the other settings), so that the references cached
+        in earlier calls are reused; if None, a new scorer is created for this call only
+    :return dict: mapping from (annotation type[, property name[, property value]]) to Scores object, merged over
+        all the documents
+    """
+    if scorer is None:
+        scorer = CorpusScorer(include, exclude, scores_type, spans_type, schema, views)
+    return scorer.score(pairs)
+
+
+class ConfusionMatrices(object):
+    def __init__(self):
+        """
+        For each (annotation type, property name), counts how often each reference property value was paired with
+        each predicted property value, where reference and predicted annotations are aligned by their spans and
+        type. A value of None means that the annotation has no value for the property. (Properties whose values are
+        other annotations are not counted.)
+        """
+        self.matrices = collections.defaultdict(collections.Counter)
+        self.unaligned = collections.Counter()
+
+    def add(self, reference_annotations, predicted_annotations, select=None, spans_type=None):
+        """
+        :param iterable reference_annotations: the reference annotations of a document
+        :param iterable predicted_annotations: the predicted annotations of the same document
+        :param Select select: returns true if a type:property is accepted by includes= and excludes=; if None, all
+            types and properties are accepted
+        :param type spans_type: not supported (must be None), since annotations are aligned by grouping them under
+            their spans, which e.g. overlapping spans (where overlap is not transitive) cannot do consistently
+        """
+        if spans_type is not None:
+            raise ValueError("confusion matrices do not support spans_type {0}".format(
+                getattr(spans_type, "__name__", spans_type)))
+        if select is None:
+            select = anafora.select.Select()
+        to_set = ToSet(select=select)
+
+        # group the annotations by span and type in a single scan, so that aligning them needs no further search
+        # (annotations are included if their type, or any of their properties, is selected)
+        aligned = collections.OrderedDict()
+        for side, annotations in enumerate((reference_annotations, predicted_annotations)):
+            for annotation in annotations:
+                values = self._values(annotation, select)
+                if values or select(annotation.type):
+                    key = to_set._spans(annotation), annotation.type
+                    aligned.setdefault(key, ([], []))[side].append(values)
+
+        # pair up the property values of each aligned reference and predicted annotation
+        for (_, type_name), (reference_values, predicted_values) in aligned.items():
+            if len(reference_values) > 1 or len(predicted_values) > 1:
+                reference_values.sort(key=lambda values: sorted(values.items(), key=repr))
+                predicted_values.sort(key=lambda values: sorted(values.items(), key=repr))
+            for values1, values2 in zip(reference_values, predicted_values):
+                for prop_name in sorted(set(values1) | set(values2)):
+                    self.matrices[type_name, prop_name][values1.get(prop_name), values2.get(prop_name)] += 1
+            if len(reference_values) > len(predicted_values):
+                self.unaligned[type_name, "reference"] += len(reference_values) - len(predicted_values)
+            elif len(predicted_values) > len(reference_values):
+                self.unaligned[type_name, "predicted"] += len(predicted_values) - len(reference_values)
+
+    @staticmethod
+    def _values(annotation, select):
+        return {name: value for name, value in annotation.properties.items()
+                if value is not None and not isinstance(value, anafora.AnaforaAnnotation)
+                and select(annotation.type, name)}
+
+    def update(self, other):
+        """
+        :param ConfusionMatrices other: confusion matrices to merge into these
+        """
+        for name, matrix in other.matrices.items():
+            self.matrices[name].update(matrix)
+        self.unaligned.update(other.unaligned)
+
+    def values(self, type_name, prop_name):
+        """
+        :param string type_name: the annotation type
+        :param string prop_name: the property name
+        :return tuple: the sorted reference values and the sorted predicted values of the property
+        """
+        matrix = self.matrices.get((type_name, prop_name), {})
+        return tuple(sorted({pair[i] for pair in matrix}, key=lambda value: (value is None, value)) for i in (0, 1))
+
+    def __repr__(self):
+        return "{0}(matrices={1}, unaligned={2})".format(
+            self.__class__.__name__, dict(self.matrices), dict(self.unaligned))
+
+
+def confusion_data(reference_data, predicted_data, include=None, exclude=None, spans_type=None):
+    """
+    :param AnaforaData reference_data: reference ("gold standard") Anafora data
+    :param AnaforaData predicted_data: predicted (system-generated) Anafora data
+    :param set include: types of annotations to include (others will be excluded); may be type names,
+        (type-name, property-name) tuples, (type-name, property-name, property-value) tuples
+    :param set exclude: types of annotations to exclude; may be type names, (type-name, property-name) tuples,
+        (type-name, property-name, property-value) tuples
+    :param type spans_type: not supported (must be None); see ConfusionMatrices.add
+    :return ConfusionMatrices: the confusion matrices of the property values of the aligned annotations
+    """
+    confusion_matrices = ConfusionMatrices()
+    confusion_matrices.add(reference_data.annotations, [] if predicted_data is None else predicted_data.annotations,
+                           anafora.select.Select(include, exclude), spans_type)
+    return confusion_matrices
+
+
+def find_temporal_contradictions(data, type_name="TLINK", prop_name="Type"):
+    """
+    :param AnaforaData data: the Anafora data to be checked
+    :param str type_name: the type of the binary temporal relation annotations
+    :param str prop_name: the property holding the temporal relation (BEFORE, AFTER, INCLUDES, etc.)
+    :return iter: an iterator of lists of relation annotations, where the relations in each list together imply that
+        some time point is before itself (e.g., A BEFORE B and B BEFORE A)
+    """
+    select = anafora.select.Select(include={(type_name, prop_name)})
+    to_set = ToSet(select=select, type_name=type_name, prop_name=prop_name)
+    scores = TemporalClosureScores()
+
+    # convert each relation to the same form used for temporal closure scoring, skipping any that are not valid
+    key_annotations = collections.defaultdict(list)
+    for annotation in data.annotations.select_type(type_name):
+        key = to_set.key(annotation)
+        try:
+            (_, _), _, (_, value) = key
+        except (TypeError, ValueError):
+            continue
+        if value in scores._interval_to_point:
+            key_annotations[key].append(annotation)
+
+    # map each contradiction back to the relation annotations
+    for contradiction in scores.contradictions(key_annotations):
+        yield sorted(annotation for key in contradiction for annotation in key_annotations[key])
+
+
+def _flatten_spans(spans):
+    """
+    :param tuple spans: the spans of an annotation, which for relations may be nested, e.g., (((1, 2),), ((3, 4),))
+    :return iter: an iterator over the (start, end) offsets within the spans
+    """
+    if isinstance(spans, tuple) and spans and isinstance(spans[0], int):
+        yield spans
+    else:
+        for item in spans:
+            for flattened_spans in _flatten_spans(item):
+                yield flattened_spans
+
+
+class _LazyText(object):
+    def __init__(self, text_path, text=None):
+        """
+        The raw text of a document, which is not read until the text of some span is requested. ASCII texts are
+        memory-mapped (since their character offsets are byte offsets) so that only the requested spans are read.
+
+        :param string text_path: the path of the raw text file
+        :param string text: the raw text, if it is already known (the file is then never read)
+        """
+        self.text_path = text_path
+        self._file = None
+        self._mmap = None
+        self._text = text
+
+    def _open(self):
+        if not os.path.isfile(self.text_path):
+            raise RuntimeError("no text file found at {0}".format(self.text_path))
+        self._file = open(self.text_path, "rb")
+        if os.fstat(self._file.fileno()).st_size > 0:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+            # character offsets are only byte offsets if there are no multi-byte characters and no "\r\n" that would
+            # be translated to "\n" when reading in text mode
+            block_size = 1 << 20
+            for start in range(0, len(self._mmap), block_size):
+                block = self._mmap[start:start + block_size]
+                if re.search(br"[\x80-\xff\r]", block) is not None:
+                    self.close()
+                    break
+
+        # otherwise, fall back to reading the whole text
+        if self._mmap is None:
+            with open(self.text_path) as text_file:
+                self._text = text_file.read()
+
+    def span_text(self, spans):
+        """
+        :param tuple spans: the spans of an annotation, which for relations may be nested
+        :return string: the text covered by the spans, with discontinuous spans joined by "..."
+        """
+        if self._mmap is None and self._text is None:
+            self._open()
+        if self._mmap is not None:
+            return "...".join(self._mmap[start:end].decode("ascii") for start, end in _flatten_spans(spans))
+        else:
+            return "...".join(self._text[start:end] for start, end in _flatten_spans(spans))
+
+    def close(self):
+        """
+        Releases the memory-mapped text file (if any).
+        """
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def _load(xml_path, profile=None):
+    """
+    Tries to load data from an Anafora XML file, issuing errors on failure.
+
+    :param xml_path: the path to an Anafora XML file
+    :param PhaseProfile profile: where the time spent parsing the XML is recorded; if None, nothing is recorded
+    :return AnaforaData: the data loaded from the XML, or None if there was a failure
+    """
+    if not os.path.exists(xml_path):
+        logging.warn("%s: no such file", xml_path)
+        return None
+    try:
+        with (_no_phase_profile if profile is None else profile).phase("xml parsing") as timer:
+            data = anafora.AnaforaData.from_file(xml_path)
+            timer.items = len(data.annotations._id_to_annotation)
+    except anafora.ElementTree.ParseError:
+        logging.warn("%s: ignoring invalid XML", xml_path)
+        return None
+    else:
+        return data
+
+
+def _find_self_referential(data, profile=None):
+    """
+    :param AnaforaData data: the Anafora data to be checked
+    :param PhaseProfile profile: where the time spent checking is recorded; if None, nothing is recorded
+    :return AnaforaAnnotation: an annotation that refers (directly or indirectly) to itself, or None
+    """
+    with (_no_phase_profile if profile is None else profile).phase("self-reference check") as timer:
+        if isinstance(data.annotations, anafora.AnaforaAnnotations):
+            timer.items = len(data.annotations._id_to_annotation)
+            return data.annotations.find_self_referential()
+
+        # annotations that were not loaded from Anafora XML are a plain list
+        timer.items = len(data.annotations)
+        for annotation in data.annotations:
+            if annotation.is_self_referential():
+                return annotation
+
+
+def _file_hash(path):
+    """
+    :param string path: the path of a file
+    :return string: a hexadecimal hash of the file's contents
+    """
+    file_hash = hashlib.sha1()
+    with open(path, "rb") as hash_file:
+        for block in iter(functools.partial(hash_file.read, 1 << 16), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def _in_shard(sub_dir, shard):
+    """
+    :param string sub_dir: the path to the Anafora directory, relative to the root
+    :param tuple shard: (index, count) of the shard, where 0 <= index < count; or None for all documents
+    :return bool: True if the documents in the sub-dir belong to the shard
+    """
+    if shard is None:
+        return True
+    index, count = shard
+
+    # use a hash that is stable across processes and machines (unlike the built-in hash)
+    sub_dir_hash = zlib.crc32(sub_dir.replace(os.sep, "/").encode("utf-8")) & 0xffffffff
+    return sub_dir_hash % count == index
+
+
+def sample_documents(reference_dir, xml_name_regex="[.]xml$", size=None, fraction=None, seed=0):
+    """
+    Chooses a random sample of the reference documents, e.g., to quickly estimate the scores of a large corpus. Each
+    document is given a pseudo-random priority from a hash of the seed and its sub-dir, and the documents with the
+    lowest priorities are kept while walking the directories (a reservoir of the given size), so the sample does not
+    depend on the order in which the directories are listed.
+
+    :param string reference_dir: directory containing reference ("gold standard") Anafora XML directories
+    :param xml_name_regex: regular expression matching the reference files
+    :param int size: the number of documents to sample
+    :param float fraction: the fraction of the documents to sample (if size is None)
+    :param int seed: the seed of the priorities, so that the same documents are sampled every time
+    :return set: the sub-dirs of the sampled documents
+    """
+    if size is None and fraction is None:
+        raise ValueError("either size or fraction must be given")
+
+    def priority(sub_dir):
+        text = "{0}/{1}".format(seed, sub_dir.replace(os.sep, "/"))
+        return int(hashlib.sha1(text.encode("utf-8")).hexdigest()[:15], 16) / float(16 ** 15)
+
+    sub_dirs = (sub_dir for sub_dir, _, _ in anafora.walk(reference_dir, xml_name_regex))
+    if size is not None:
+        return set(heapq.nsmallest(size, sub_dirs, key=priority))
+    return {sub_dir for sub_dir in sub_dirs if priority(sub_dir) < fraction}
+
+
+class _ReferenceFile(object):
+    def __init__(self, xml_path, select, spans_type=None, view_filter=None, profile=None):
+        """
+        A reference document in an Anafora XML file, which is only loaded when its annotation sets are needed.
+
+        :param string xml_path: the path to the Anafora XML file
+        :param Select select: returns true if a type:property:value is accepted by includes= and excludes=
+        :param type spans_type: wrapper object to apply to annotation spans
+        :param _ViewFilter view_filter: restricts the views that are scored; if None, all views are scored
+        :param PhaseProfile profile: where the time spent loading the document is recorded; if None, nothing is
+            recorded
+        """
+        self.xml_path = xml_path
+        self.select = select
+        self.spans_type = spans_type
+        self.view_filter = view_filter
+        self.profile = profile
+        self._loaded = False
+        self._sets = None
+
+    def content_hash(self):
+        """
+        :return string: a hexadecimal hash of the reference document
+        """
+        return _file_hash(self.xml_path)
+
+    def sets(self):
+        """
+        :return _AnnotationSets: the annotation sets of the reference document, or None if it cannot be evaluated
+        """
+        if not self._loaded:
+            self._loaded = True
+            reference_data = _load(self.xml_path, self.profile)
+
+            # check for self-references in the annotations, which cause equality and hashing to fail
+            self_reference = _find_self_referential(reference_data, self.profile)
+            if self_reference is not None:
+                msg = "skipping reference file %s with self-referential annotation %s"
+                logging.warn(msg, self.xml_path, self_reference.id)
+            else:
+                self._sets = _AnnotationSets(reference_data.annotations, self.select, self.spans_type,
+                                             self.view_filter, profile=self.profile)
+        return self._sets
+
+
+class _PredictedIndex(object):
+    def __init__(self, predicted_dir, xml_name_regex="[.]xml$"):
+        """
+        Scans a directory of predicted Anafora XML files once, so that the predicted files for each reference
+        document can be found without listing a directory per document.
+
+        :param string predicted_dir: directory containing predicted (system-generated) Anafora XML directories
+        :param xml_name_regex: regular expression matching the files to be compared
+        """
+        self.predicted_dir = predicted_dir
+        self._sub_dir_paths = collections.defaultdict(list)
+        self._matched_paths = set()
+        for dir_path, _, file_names in os.walk(predicted_dir):
+            sub_dir = os.path.relpath(dir_path, predicted_dir) if dir_path != predicted_dir else ''
+            for file_name in sorted(file_names):
+                if file_name.endswith(".xml"):
+                    path = os.path.join(dir_path, file_name)
+                    if re.search(xml_name_regex, path) is not None:
+                        self._sub_dir_paths[sub_dir].append(path)
+
+    def paths(self, sub_dir, text_name):
+        """
+        :param string sub_dir: the path to the Anafora directory, relative to the root
+        :param string text_name: the name of the Anafora text file
+        :return list: the paths of the predicted files in the sub-dir whose names start with the text name
+        """
+        paths = [path for path in self._sub_dir_paths.get(sub_dir, [])
+                 if os.path.basename(path).startswith(text_name)]
+        self._matched_paths.update(paths)
+        return paths
+
+    def unmatched_paths(self, shard=None, sample=None):
+        """
+        :param tuple shard: (index, count) of the shard whose sub-dirs should be considered; or None for all
+        :param set sample: the only sub-dirs that should be considered; or None for all
+        :return list: the paths of all predicted files that have not been returned by paths(...)
+        """
+        return [path for sub_dir, paths in self._sub_dir_paths.items()
+                if _in_shard(sub_dir, shard) and (sample is None or sub_dir in sample)
+                for path in paths if path not in self._matched_paths]
+
+    def load(self, path, profile=None):
+        """
+        :param string path: a path returned by paths(...)
+        :param PhaseProfile profile: where the time spent parsing the XML is recorded; if None, nothing is recorded
+        :return AnaforaData: the data loaded from the XML, or None if there was a failure
+        """
+        return _load(path, profile)
+
+    def content_hash(self, path):
+        """
+        :param string path: a path returned by paths(...)
+        :return string: a hexadecimal hash of the predicted file
+        """
+        return _file_hash(path)
+
+
+class _LabelStudioPredictedIndex(object):
+    def __init__(self, labelstudio_path, results_key="annotations"):
+        """
+        Reads the predicted documents of a Label Studio JSON export (see anafora.labelstudio) once, keeping only the
+        annotation records of each document. Documents are identified by their text names, so the paths of this
+        index are the export path followed by "#" and the text name.
+
+        :param string labelstudio_path: the path of the Label Studio JSON export
+        :param string results_key: the key of the task's results, "annotations" or "predictions"
+        """
+        import anafora.labelstudio
+        self.predicted_dir = labelstudio_path
+        self._text_name_documents = collections.OrderedDict()
+        self._matched_text_names = set()
+        for task in anafora.labelstudio.iter_labelstudio_tasks(labelstudio_path):
+            text_name, records = anafora.labelstudio.labelstudio_annotations_to_anafora_records(task, results_key)
+            if text_name in self._text_name_documents:
+                logging.warn("%s: ignoring duplicate predicted document %s", labelstudio_path, text_name)
+                continue
+            task_hash = hashlib.sha1(json.dumps(task, sort_keys=True).encode("utf-8")).hexdigest()
+            self._text_name_documents[text_name] = task_hash, records
+
+    def _path(self, text_name):
+        return "{0}#{1}".format(self.predicted_dir, text_name)
+
+    def paths(self, sub_dir, text_name):
+        """
+        :param string sub_dir: the path to the Anafora directory, relative to the root (ignored)
+        :param string text_name: the name of the Anafora text file
+        :return list: the path of the predicted document with the text name, if there is one
+        """
+        if text_name not in self._text_name_documents:
+            return []
+        self._matched_text_names.add(text_name)
+        return [self._path(text_name)]
+
+    def unmatched_paths(self, shard=None, sample=None):
+        """
+        :param tuple shard: (index, count) of the shard whose text names should be considered; or None for all
+        :param set sample: the only text names that should be considered; or None for all
+        :return list: the paths of all predicted documents that have not been returned by paths(...)
+        """
+        return [self._path(text_name) for text_name in self._text_name_documents
+                if _in_shard(text_name, shard) and (sample is None or text_name in sample)
+                and text_name not in self._matched_text_names]
+
+    def load(self, path, profile=None):
+        """
+        :param string path: a path returned by paths(...)
+        :param PhaseProfile profile: not used, since the export was already read
+        :return _RecordsData: the annotations of the predicted document
+        """
+        _, records = self._text_name_documents[path.rsplit("#", 1)[1]]
+        return _RecordsData(_from_records(records))
+
+    def content_hash(self, path):
+        """
+        :param string path: a path returned by paths(...)
+        :return string: a hexadecimal hash of the predicted document's task
+        """
+        task_hash, _ = self._text_name_documents[path.rsplit("#", 1)[1]]
+        return task_hash
+
+
+def _iter_references(reference_dir, xml_name_regex, select, spans_type=None, view_filter=None, profile=None):
+    """
+    :param string reference_dir: directory containing reference ("gold standard") Anafora XML directories
+    :param xml_name_regex: regular expression matching the reference files
+    :param Select select: returns true if a type:property:value is accepted by includes= and excludes=
+    :param type spans_type: wrapper object to apply to annotation spans
+    :param _ViewFilter view_filter: restricts the views that are scored; if None, all views are scored
+    :param PhaseProfile profile: where the time spent loading the documents is recorded; if None, nothing is
+        recorded
+    :return iter: an iterator of (sub-dir, text-file-name, reference) for each reference document, where the
+        reference has a content_hash() method and a sets() method that returns its annotation sets (or None)
+    """
+    for sub_dir, text_name, reference_xml_names in anafora.walk(reference_dir, xml_name_regex):
+        try:
+            [reference_xml_name] = reference_xml_names
+        except ValueError:
+            logging.warn("expected one reference file for %s, found %s", text_name, reference_xml_names)
+            if not reference_xml_names:
+                continue
+            reference_xml_name = reference_xml_names[0]
+        reference_xml_path = os.path.join(reference_dir, sub_dir, reference_xml_name)
+        yield sub_dir, text_name, _ReferenceFile(reference_xml_path, select, spans_type, view_filter, profile)
+
+
+class _LabelStudioDocument(object):
+    def __init__(self, task, select, spans_type=None, view_filter=None, profile=None, results_key="annotations"):
+        """
+        A reference document in a Label Studio JSON export, whose annotation sets are only calculated when needed.
+
+        :param dict task: the Label Studio task of the document
+        :param Select select: returns true if a type:property:value is accepted by includes= and excludes=
+        :param type spans_type: wrapper object to apply to annotation spans
+        :param _ViewFilter view_filter: restricts the views that are scored; if None, all views are scored
+        :param PhaseProfile profile: where the time spent checking the document is recorded; if None, nothing is
+            recorded
+        :param string results_key: the key of the task's results, "annotations" or "predictions"
+        """
+        import anafora.labelstudio
+        self.task = task
+        self.text_name, self.records = anafora.labelstudio.labelstudio_annotations_to_anafora_records(
+            task, results_key)
+        self.text = (task.get("data") or {}).get("text")
+        self.select = select
+        self.spans_type = spans_type
+        self.view_filter = view_filter
+        self.profile = profile
+
+    def content_hash(self):
+        """
+        :return string: a hexadecimal hash of the reference document's task
+        """
+        return hashlib.sha1(json.dumps(self.task, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def sets(self):
+        """
+        :return _AnnotationSets: the annotation sets of the reference document, or None if it cannot be evaluated
+        """
+        reference_data = _RecordsData(_from_records(self.records))
+
+        # check for self-references in the annotations, which cause equality and hashing to fail
+        self_reference = _find_self_referential(reference_data, self.profile)
+        if self_reference is not None:
+            logging.warn("skipping reference document %s with a self-referential annotation", self.text_name)
+            return None
+        return _AnnotationSets(reference_data.annotations, self.select, self.spans_type, self.view_filter,
+                               profile=self.profile)
+
+
+def _iter_labelstudio_references(labelstudio_path, select, spans_type=None, view_filter=None, profile=None):
+    """
+    :param string labelstudio_path: the path of a Label Studio JSON export of the reference documents
+    :param Select select: returns true if a type:property:value is accepted by includes= and excludes=
+    :param type spans_type: wrapper object to apply to annotation spans
+    :param _ViewFilter view_filter: restricts the views that are scored; if None, all views are scored
+    :param PhaseProfile profile: where the time spent checking the documents is recorded; if None, nothing is
+        recorded
+    :return iter: an iterator of (sub-dir, text-file-name, reference) for each reference document, where the sub-dir
+        is the text name (as for Anafora directories that are not nested)
+    """
+    import anafora.labelstudio
+    for task in anafora.labelstudio.iter_labelstudio_tasks(labelstudio_path):
+        reference = _LabelStudioDocument(task, select, spans_type, view_filter, profile)
+        yield reference.text_name, reference.text_name, reference
+
+
+class _AnswerKeyDocument(object):
+    def __init__(self, line, select, view_filter=None):
+        """
+        A reference document in an answer key file, whose annotation sets are only decoded when needed.
+
+        :param string line: the JSON line for the document in the answer key
+        :param Select select: returns true if a type:property:value is accepted by the answer key's include= and
+            exclude=
+        :param _ViewFilter view_filter: restricts the views that are scored; if None, all views are scored
+        """
+        self.line = line
+        self.document = json.loads(line)
+        self.select = select
+        self.view_filter = view_filter
+
+    def content_hash(self):
+        """
+        :return string: a hexadecimal hash of the reference document
+        """
+        return hashlib.sha1(self.line.encode("utf-8")).hexdigest()
+
+    def sets(self):
+        """
+        :return _AnswerKeySets: the annotation sets of the reference document
+        """
+        keys = [_from_json(key) for key in self.document["keys"]]
+        view_sets = {_from_json(view_name): {keys[i] for i in indexes}
+                     for view_name, indexes in self.document["views"]}
+        type_sets = {type_name: {keys[i] for i in indexes}
+                     for type_name, indexes in self.document["types"]}
+        return _AnswerKeySets(view_sets, type_sets, self.select, self.view_filter)
+
+
+class _AnswerKeySets(object):
+    def __init__(self, view_sets, type_sets, select, view_filter=None):
+        """
+        The annotation sets of a single reference document, as loaded from an answer key file.
+
+        :param dict view_sets: mapping from each view found in the reference to its annotation set
+        :param dict type_sets: mapping from each annotation type found in the reference to the annotation set of a
+            (type, property) view where none of the annotations have the property
+        :param Select select: returns true if a type:property:value is accepted by includes= and excludes=
+        :param _ViewFilter view_filter: restricts the views that are scored; if None, all views are scored
+        """
+        self._view_sets = view_sets
+        self._type_sets = type_sets
+        self.select = select
+        self.spans_type = None
+        self.view_filter = view_filter
+        if view_filter is not None and view_filter.view_names is not None:
+            view_names = view_filter.view_names
+        else:
+            view_names = [view_name for view_name in view_sets if view_filter is None or view_filter(view_name)]
+        self.views = {view_name: _to_set(view_name, select) for view_name in view_names}
+        self.interner = _KeyInterner()
+        self._interned_view_sets = {}
+
+    def get(self, view_name, _):
+        """
+        :param view_name: the name of the view, e.g., (annotation type[, property name[, property value]])
+        :return set: the annotations in the view
+        """
+        if view_name in self._view_sets:
+            return self._view_sets[view_name]
+
+        # the only views not found in the reference that may still contain reference annotations are
+        # (type, property) views where none of the reference annotations of that type had that property
+        if isinstance(view_name, tuple) and len(view_name) == 2:
+            type_name, prop_name = view_name
+            if type_name in self._type_sets:
+                if self.select(type_name, prop_name, "*") or self.select(type_name, "<span>"):
+                    return self._type_sets[type_name]
+        return set()
+
+    def get_interned(self, view_name, _, interner):
+        """
+        :param view_name: the name of the view, e.g., (annotation type[, property name[, property value]])
+        :param _KeyInterner interner: the interner that assigns integer ids to keys (must be the same every call)
+        :return set: the integer ids of the annotations in the view
+        """
+        if view_name not in self._interned_view_sets:
+            self._interned_view_sets[view_name] = {interner(key) for key in self.get(view_name, _)}
+        return self._interned_view_sets[view_name]
+
+
+_answer_key_format = "anafora-answer-key"
+_answer_key_version = 1
+
+
+def _normalize_select_items(items):
+    if items is None:
+        return None
+    return tuple(sorted({item if isinstance(item, tuple) else (item,) for item in items}))
+
+
+def _to_json(value):
+    return [_to_json(item) for item in value] if isinstance(value, tuple) else value
+
+
+def _from_json(value):
+    return tuple(_from_json(item) for item in value) if isinstance(value, list) else value
+
+
+def _named_scores_to_json(named_scores):
+    """
+    :param dict named_scores: mapping from (annotation type[, property name[, property value]]) to Scores objects
+    :return list: a JSON-serializable list of [name, counts] pairs
+    """
+    return [[_to_json(name), [getattr(scores, count_name) for count_name in scores._count_names]]
+            for name, scores in named_scores.items()]
+
+
+def _named_scores_from_json(items, scores_type):
+    """
+    :param list items: a list of [name, counts] pairs, as produced by _named_scores_to_json
+    :param type scores_type: type of the Scores objects that produced the counts
+    :return dict: mapping from (annotation type[, property name[, property value]]) to Scores objects
+    """
+    named_scores = collections.defaultdict(lambda: scores_type())
+    for name, counts in items:
+        scores = named_scores[_from_json(name)]
+        for count_name, count in zip(scores._count_names, counts):
+            setattr(scores, count_name, count)
+    return named_scores
+
+
+# changing this invalidates scores cached by score_systems with earlier versions of the scoring code
+_cache_version = 1
+
+
+def compile_answer_key(reference_dir, answer_key_path, xml_name_regex="[.]xml$", include=None, exclude=None):
+    """
+    Compiles the reference annotations into an answer key file, which can be passed to score_dirs (or score_systems)
+    in place of the reference directory, so that repeated evaluations need not parse the reference XML.
+
+    :param string reference_dir: directory containing reference ("gold standard") Anafora XML directories
+    :param string answer_key_path: the path where the (gzipped) answer key should be written
+    :param xml_name_regex: regular expression matching the reference files
+    :param set include: types of annotations to include (others will be excluded); may be type names,
+        (type-name, property-name) tuples, (type-name, property-name, property-value) tuples
+    :param set exclude: types of annotations to exclude; may be type names, (type-name, property-name) tuples,
+        (type-name, property-name, property-value) tuples
+    """
+    select = anafora.select.Select(include, exclude)
+    with gzip.open(answer_key_path, "wt", encoding="utf-8") as answer_key_file:
+
+        # the header records the settings that the annotation sets depend on
+        header = {
+            "format": _answer_key_format,
+            "version": _answer_key_version,
+            "xml_name_regex": xml_name_regex,
+            "include": _to_json(_normalize_select_items(include)),
+            "exclude": _to_json(_normalize_select_items(exclude)),
+        }
+        answer_key_file.write(json.dumps(header) + "\n")
+
+        for sub_dir, text_name, reference in _iter_references(reference_dir, xml_name_regex, select):
+            reference_sets = reference.sets()
+            if reference_sets is None:
+                continue
+
+            # the annotation sets for each type whose annotations all lack some property
+            type_sets = collections.defaultdict(set)
+            for annotation in reference_sets.annotations:
+                to_set = ToSet(select=select, type_name=annotation.type, prop_name=None)
+                type_sets[annotation.type].add(to_set.key(annotation))
+
+            # encode each distinct annotation key as an integer
+            key_indexes = {}
+            keys = []
+
+            def encode(annotation_set):
+                indexes = []
+                for key in annotation_set:
+                    if key not in key_indexes:
+                        key_indexes[key] = len(keys)
+                        keys.append(_to_json(key))
+                    indexes.append(key_indexes[key])
+                return sorted(indexes)
+
+            views = [[_to_json(view_name), encode(reference_sets.get(view_name, to_set))]
+                     for view_name, to_set in reference_sets.views.items()]
+            types = [[type_name, encode(type_set)] for type_name, type_set in type_sets.items()]
+            document = {"sub_dir": sub_dir, "text_name": text_name, "keys": keys, "views": views, "types": types}
+            answer_key_file.write(json.dumps(document) + "\n")
+
+
+def _iter_answer_key_documents(answer_key_path, include=None, exclude=None, view_filter=None, xml_name_regex=None):
+    """
+    :param string answer_key_path: the path of an answer key file written by compile_answer_key
+    :param set include: types of annotations to include; if not None, must match the answer key
+    :param set exclude: types of annotations to exclude; if not None, must match the answer key
+    :param _ViewFilter view_filter: restricts the views that are scored; if None, all views are scored
+    :param xml_name_regex: regular expression matching the predicted files; if not None and different from the one
+        the answer key was compiled with, a warning is logged
+    :return iter: an iterator of (sub-dir, text-file-name, reference) for each reference document, where the
+        reference has a content_hash() method and a sets() method that returns its annotation sets
+    """
+    with gzip.open(answer_key_path, "rt", encoding="utf-8") as answer_key_file:
+        header = json.loads(next(answer_key_file))
+        if header.get("format") != _answer_key_format or header.get("version") != _answer_key_version:
+            raise ValueError("{0} is not a version {1} answer key".format(answer_key_path, _answer_key_version))
+
+        # the annotation sets were calculated with the include= and exclude= of the header
+        key_include = _from_json(header["include"])
+        key_exclude = _from_json(header["exclude"])
+        select = anafora.select.Select(key_include, key_exclude)
+        for name, items, key_items in [("include", include, key_include), ("exclude", exclude, key_exclude)]:
+            if items is not None and _normalize_select_items(items) != key_items:
+                msg = "{0}={1} does not match {0}={2} of answer key {3}"
+                raise ValueError(msg.format(name, items, key_items, answer_key_path))
+
+        # the reference files may have been selected by a different regular expression than the predicted files,
+        # which is allowed (since the two may be named differently) but is more likely a mistake
+        if xml_name_regex is not None and xml_name_regex != header["xml_name_regex"]:
+            logging.warn("xml_name_regex=%s does not match xml_name_regex=%s of answer key %s",
+                         xml_name_regex, header["xml_name_regex"], answer_key_path)
+
+        for line in answer_key_file:
+            reference = _AnswerKeyDocument(line, select, view_filter)
+            yield reference.document["sub_dir"], reference.document["text_name"], reference
+
+
+def _reference_documents(reference_dir, xml_name_regex="[.]xml$", include=None, exclude=None, spans_type=None,
+                         view_filter=None, profile=None, reference_format="anafora"):
+    """
+    :param string reference_dir: directory containing reference ("gold standard") Anafora XML directories, an
+        answer key file (see compile_answer_key), or a Label Studio JSON export
+    :param xml_name_regex: regular expression matching the reference files
+    :param set include: types of annotations to include (others will be excluded)
+    :param set exclude: types of annotations to exclude
+    :param type spans_type: wrapper object to apply to annotation spans; not supported with an answer key
+    :param _ViewFilter view_filter: restricts the views that are scored; if None, all views are scored
+    :param PhaseProfile profile: where the time spent loading the documents is recorded; if None, nothing is
+        recorded
+    :param string reference_format: "anafora" for Anafora XML directories (or an answer key file), or
+        "labelstudio" for a Label Studio JSON export
+    :return iter: an iterator of (sub-dir, text-file-name, reference) for each reference document
+    """
+    if reference_format == "labelstudio":
+        select = anafora.select.Select(include, exclude)
+        return _iter_labelstudio_references(reference_dir, select, spans_type, view_filter, profile)
+    elif reference_format != "anafora":
+        raise ValueError("unknown format {0!r}".format(reference_format))
+    elif os.path.isfile(reference_dir):
+        if spans_type is not None:
+            raise ValueError("spans_type is not supported with answer key {0}".format(reference_dir))
+        return _iter_answer_key_documents(reference_dir, include, exclude, view_filter, xml_name_regex)
+    else:
+        select = anafora.select.Select(include, exclude)
+        return _iter_references(reference_dir, xml_name_regex, select, spans_type, view_filter, profile)
+
+
+def _predicted_index(predicted_dir, xml_name_regex="[.]xml$", predicted_format="anafora"):
+    """
+    :param string predicted_dir: directory containing predicted (system-generated) Anafora XML directories, or a
+        Label Studio JSON export
+    :param xml_name_regex: regular expression matching the predicted files
+    :param string predicted_format: "anafora" for Anafora XML directories, or "labelstudio" for a Label Studio
+        JSON export
+    :return: a _PredictedIndex or _LabelStudioPredictedIndex of the predicted documents
+    """
+    if predicted_format == "labelstudio":
+        return _LabelStudioPredictedIndex(predicted_dir)
+    elif predicted_format != "anafora":
+        raise ValueError("unknown format {0!r}".format(predicted_format))
+    return _PredictedIndex(predicted_dir, xml_name_regex)
+
+
+def score_dirs(reference_dir, predicted_dir, xml_name_regex="[.]xml$", text_dir=None,
+               include=None, exclude=None, scores_type=Scores, spans_type=None, cache_dir=None, shard=None,
+               error_report=None, schema=None, views=None, profile=None, align_arguments=False, sample=None,
+               reference_format="anafora", predicted_format="anafora", corpus_scores=None):
+    """
+    :param string reference_dir: directory containing reference ("gold standard") Anafora XML directories, or an
+        answer key file written by compile_answer_key
+    :param string predicted_dir: directory containing predicted (system-generated) Anafora XML directories
+    :param xml_name_regex: regular expression matching the files to be compared
+    :param string text_dir: directory containing the raw texts corresponding to the Anafora XML
+        (if None, texts are assumed to be in the reference dir)
+    :param set include: types of annotations to include (others will be excluded); may be type names,
+        (type-name, property-name) tuples, (type-name, property-name, property-value) tuples
+    :param set exclude: types of annotations to exclude; may be type names, (type-name, property-name) tuples,
+        (type-name, property-name, property-value) tuples
+    :param type scores_type: type for calculating matches between predictions and reference
+    :param type spans_type: wrapper object to apply to annotation spans
+    :param string cache_dir: directory where the scores of each document are saved (under a hash of the reference
+        and predicted files and the settings above) so that documents whose files have not changed need not be
+        re-scored; if None, nothing is cached
+    :param tuple shard: (index, count) to score only the documents whose sub-dirs hash to the index-th of count
+        shards (see write_partial_results and merge_partial_results); if None, all documents are scored
+    :param ErrorReport error_report: where the errors of DebuggingScores should be written (the errors are then
+        discarded from the scores, so that they are not kept in memory); if None, errors are logged at DEBUG level
+    :param Schema schema: the Anafora schema (see anafora.validate.Schema) of the annotations; if given,
+        (type, property, value) views are only scored for properties whose values are chosen from a fixed list
+    :param list views: the names of the only views to be scored, e.g., (annotation type[, property name[, property
+        value]]); if None, all views found in the annotations are scored
+    :param PhaseProfile profile: where the time spent in each phase (XML parsing, key construction, etc.) of
+        scoring each document is recorded; if None, nothing is recorded
+    :param bool align_arguments: whether the arguments of predicted relations should be replaced by the overlapping
+        reference entities they are aligned to (see score_data); not supported with an answer key
+    :param set sample: the sub-dirs of the only documents to be scored (see sample_documents); if None, all documents
+        are scored
+    :param string reference_format: "anafora" if the reference is Anafora XML directories (or an answer key file),
+        or "labelstudio" if it is a Label Studio JSON export (see anafora.labelstudio), whose documents are
+        identified by their sources
+    :param string predicted_format: "anafora" if the predictions are Anafora XML directories, or "labelstudio" if
+        they are Label Studio JSON exports
+    :param CorpusScores corpus_scores: where the counts of each document are added directly (see score_systems);
+        the yielded scores are then None
+    :return iter: an iterator of (file-name, name-to-scores) where name-to-scores is a mapping from
+        (annotation type[, property name[, property value]]) to a Scores object
     """
-    :param string reference_dir: directory containing reference ("gold standard") Anafora XML directories
-    :param string predicted_dir: directory containing predicted (system-generated) Anafora XML directories
+    for text_name, system_named_scores in score_systems(
+            reference_dir, [predicted_dir], xml_name_regex=xml_name_regex, text_dir=text_dir,
+            include=include, exclude=exclude, scores_type=scores_type, spans_type=spans_type, cache_dir=cache_dir,
+            shard=shard, error_report=error_report, schema=schema, views=views, profile=profile,
+            align_arguments=align_arguments, sample=sample, reference_format=reference_format,
+            predicted_format=predicted_format,
+            corpus_scores=None if corpus_scores is None else {predicted_dir: corpus_scores}):
+        yield text_name, system_named_scores[predicted_dir]
+
+
+def score_systems(reference_dir, predicted_dirs, xml_name_regex="[.]xml$", text_dir=None,
+                  include=None, exclude=None, scores_type=Scores, spans_type=None, cache_dir=None, shard=None,
+                  error_report=None, schema=None, views=None, profile=None, align_arguments=False,
+                  sample=None, reference_format="anafora", predicted_format="anafora", corpus_scores=None):
+    """
+    Scores several systems against the same reference, loading each reference document (and calculating the
+    annotation sets for each of its views) only once.
+
+    :param string reference_dir: directory containing reference ("gold standard") Anafora XML directories, or an
+        answer key file written by compile_answer_key
+    :param list predicted_dirs: directories containing predicted (system-generated) Anafora XML directories
     :param xml_name_regex: regular expression matching the files to be compared
     :param string text_dir: directory containing the raw texts corresponding to the Anafora XML
         (if None, texts are assumed to be in the reference dir)
@@ -508,97 +2793,261 @@ def score_dirs(reference_dir, predicted_dir, xml_name_regex="[.]xml$", text_dir=
         (type-name, property-name, property-value) tuples
     :param type scores_type: type for calculating matches between predictions and reference
     :param type spans_type: wrapper object to apply to annotation spans
-    :return iter: an iterator of (file-name, name-to-scores) where name-to-scores is a mapping from
-        (annotation type[, property name[, property value]]) to a Scores object
+    :param string cache_dir: directory where the scores of each document are saved (under a hash of the reference
+        and predicted files and the settings above) so that documents whose files have not changed need not be
+        re-scored; if None, nothing is cached
+    :param tuple shard: (index, count) to score only the documents whose sub-dirs hash to the index-th of count
+        shards (see write_partial_results and merge_partial_results); if None, all documents are scored
+    :param ErrorReport error_report: where the errors of DebuggingScores should be written (the errors are then
+        discarded from the scores, so that they are not kept in memory); if None, errors are logged at DEBUG level
+    :param Schema schema: the Anafora schema (see anafora.validate.Schema) of the annotations; if given,
+        (type, property, value) views are only scored for properties whose values are chosen from a fixed list
+    :param list views: the names of the only views to be scored, e.g., (annotation type[, property name[, property
+        value]]); if None, all views found in the annotations are scored
+    :param PhaseProfile profile: where the time spent in each phase (XML parsing, key construction, etc.) of
+        scoring each document is recorded; if None, nothing is recorded
+    :param bool align_arguments: whether the arguments of predicted relations should be replaced by the overlapping
+        reference entities they are aligned to (see score_data); not supported with an answer key
+    :param set sample: the sub-dirs of the only documents to be scored (see sample_documents); if None, all documents
+        are scored
+    :param string reference_format: "anafora" if the reference is Anafora XML directories (or an answer key file),
+        or "labelstudio" if it is a Label Studio JSON export (see anafora.labelstudio), whose documents are
+        identified by their sources
+    :param string predicted_format: "anafora" if the predictions are Anafora XML directories, or "labelstudio" if
+        they are Label Studio JSON exports
+    :param dict corpus_scores: mapping from each predicted directory to a CorpusScores, to which the counts of each
+        document are added directly from the annotation sets (without creating Scores objects, unless they are to
+        be cached); the yielded scores of each system are then None
+    :return iter: an iterator of (file-name, system-to-name-to-scores) where system-to-name-to-scores is an ordered
+        mapping from each predicted directory to a mapping from (annotation type[, property name[, property value]])
+        to a Scores object
     """
 
-    # walks through the reference Anafora XML directories, scoring each and adding those to the overall scores
-    for sub_dir, text_name, reference_xml_names in anafora.walk(reference_dir, xml_name_regex):
+    # the views to be scored may be restricted by a schema or an explicit list
+    view_filter = None if schema is None and views is None else _ViewFilter(schema, views)
+    if align_arguments and reference_format == "anafora" and os.path.isfile(reference_dir):
+        raise ValueError("align_arguments is not supported with answer key {0}".format(reference_dir))
+    iter_references = _reference_documents(reference_dir, xml_name_regex, include, exclude, spans_type,
+                                           view_filter, profile, reference_format)
 
-        # load the reference data from its Anafora XML
-        try:
-            [reference_xml_name] = reference_xml_names
-        except ValueError:
-            logging.warn("expected one reference file for %s, found %s", text_name, reference_xml_names)
-            if not reference_xml_names:
-                continue
-            reference_xml_name = reference_xml_names[0]
-        reference_xml_path = os.path.join(reference_dir, sub_dir, reference_xml_name)
-        reference_data = _load(reference_xml_path)
+    # the phases of scoring are only timed if requested
+    if profile is None:
+        profile = _no_phase_profile
 
-        # check for self-references in the annotations, which cause equality and hashing to fail
-        self_reference = reference_data.annotations.find_self_referential()
-        if self_reference is not None:
-            msg = "skipping reference file %s with self-referential annotation %s"
-            logging.warn(msg, reference_xml_path, self_reference.id)
+    # scores can only be cached if they are simple counts
+    if cache_dir is not None:
+        scores = scores_type()
+        if not hasattr(scores, "_count_names") or hasattr(scores, "errors"):
+            raise ValueError("{0} scores cannot be cached".format(type(scores).__name__))
+        settings = [_normalize_select_items(include), _normalize_select_items(exclude),
+                    type(scores).__name__, getattr(spans_type, "__name__", spans_type), _cache_version]
+        if view_filter is not None:
+            settings.append(view_filter.settings())
+        if align_arguments:
+            settings.append("align_arguments")
+        settings = repr(settings)
+
+    # scan each of the predicted directories only once
+    predicted_indexes = collections.OrderedDict(
+        (predicted_dir, _predicted_index(predicted_dir, xml_name_regex, predicted_format))
+        for predicted_dir in predicted_dirs)
+
+    # walks through the reference documents, scoring each (with reference annotation sets shared across all the
+    # predicted directories) and adding those to the overall scores
+    for sub_dir, text_name, reference in iter_references:
+
+        # skip documents that belong to other shards or were not sampled
+        if not _in_shard(sub_dir, shard) or (sample is not None and sub_dir not in sample):
             continue
+        profile.start_document(text_name)
 
-        # find and load the corresponding predicted data from its Anafora XML
-        predicted_xml_glob = os.path.join(predicted_dir, sub_dir, text_name + "*.xml")
-        predicted_xml_paths = [f for f in glob.glob(predicted_xml_glob) if re.search(xml_name_regex, f) is not None]
-        try:
-            [predicted_xml_path] = predicted_xml_paths
-            predicted_data = _load(predicted_xml_path)
-        except ValueError:
-            logging.warn("expected one predicted file at %s, found %s", predicted_xml_glob, predicted_xml_paths)
-            if not predicted_xml_paths:
-                predicted_xml_path = None
-                predicted_data = anafora.AnaforaData()
+        # find the predicted Anafora XML for each system, and any cached scores for that system (the reference is
+        # hashed only once, however many systems there are)
+        system_predicted_xml_paths = collections.OrderedDict()
+        system_cache_paths = {}
+        system_named_scores = collections.OrderedDict()
+        reference_hash = reference.content_hash() if cache_dir is not None else None
+        for predicted_dir, predicted_index in predicted_indexes.items():
+            predicted_xml_paths = predicted_index.paths(sub_dir, text_name)
+            system_predicted_xml_paths[predicted_dir] = predicted_xml_paths
+            if cache_dir is not None:
+                cache_key = [settings, reference_hash] + [
+                    predicted_index.content_hash(f) for f in predicted_xml_paths]
+                cache_key = hashlib.sha1("\n".join(cache_key).encode("utf-8")).hexdigest()
+                cache_path = system_cache_paths[predicted_dir] = os.path.join(cache_dir, cache_key + ".json")
+                if os.path.exists(cache_path):
+                    with open(cache_path) as cache_file:
+                        system_named_scores[predicted_dir] = _named_scores_from_json(
+                            json.load(cache_file), scores_type)
+
+        # only load the reference if there are systems whose scores were not cached
+        text = None
+        if len(system_named_scores) < len(predicted_dirs):
+            reference_sets = reference.sets()
+            if reference_sets is None:
+                continue
+
+            # determine the path for the raw text source file (which is only read if the text of an annotation
+            # is requested, e.g., for logging errors)
+            if text_dir is None:
+                text_path = os.path.join(reference_dir, sub_dir, text_name)
             else:
-                predicted_xml_path = predicted_xml_paths[0]
-                predicted_data = _load(predicted_xml_path)
+                text_path = os.path.join(text_dir, text_name)
+            text = _LazyText(text_path, getattr(reference, "text", None))
 
-        # check for self-references in the annotations, which cause equality and hashing to fail
-        self_reference = predicted_data.annotations.find_self_referential()
-        if self_reference is not None:
-            msg = "skipping predicted file %s with self-referential annotation %s"
-            logging.warn(msg, predicted_xml_path, self_reference.id)
-            predicted_data = anafora.AnaforaData()
+        for predicted_dir, predicted_xml_paths in system_predicted_xml_paths.items():
+            if predicted_dir in system_named_scores:
+                continue
 
-        # determine the path for the raw text source file
-        if text_dir is None:
-            text_path = os.path.join(reference_dir, sub_dir, text_name)
-        else:
-            text_path = os.path.join(text_dir, text_name)
+            # load the corresponding predicted data from its Anafora XML (or Label Studio export)
+            predicted_index = predicted_indexes[predicted_dir]
+            try:
+                [predicted_xml_path] = predicted_xml_paths
+                predicted_data = predicted_index.load(predicted_xml_path, profile)
+            except ValueError:
+                predicted_xml_glob = os.path.join(predicted_dir, sub_dir, text_name + "*.xml")
+                logging.warn("expected one predicted file at %s, found %s", predicted_xml_glob, predicted_xml_paths)
+                if not predicted_xml_paths:
+                    predicted_xml_path = None
+                    predicted_data = anafora.AnaforaData()
+                else:
+                    predicted_xml_path = predicted_xml_paths[0]
+                    predicted_data = predicted_index.load(predicted_xml_path, profile)
 
-        # if no raw text was found, then asking for the text of an annotation is an error
-        if not os.path.exists(text_path) or not os.path.isfile(text_path):
-            def _span_text(_):
-                raise RuntimeError("no text file found at {0}".format(text_path))
+            # check for self-references in the annotations, which cause equality and hashing to fail
+            self_reference = _find_self_referential(predicted_data, profile)
+            if self_reference is not None:
+                msg = "skipping predicted file %s with self-referential annotation %s"
+                logging.warn(msg, predicted_xml_path, self_reference.id)
+                predicted_data = anafora.AnaforaData()
 
-        # otherwise, the text of an annotation can be extracted based on its spans
-        else:
-            with open(text_path) as text_file:
-                text = text_file.read()
+            # rewrite the arguments of the predicted relations through the alignment of the predicted entities
+            predicted_annotations = predicted_data.annotations
+            if align_arguments:
+                with profile.phase("argument alignment") as timer:
+                    predicted_annotations = _align_arguments(reference_sets.annotations, predicted_annotations)
+                    timer.items = len(predicted_annotations)
 
-            def _flatten(items):
-                if isinstance(items, tuple) and isinstance(items[0], int):
-                    yield items
-                else:
-                    for item in items:
-                        for flattened_items in _flatten(item):
-                            yield flattened_items
+            # score this data and update the overall scores, directly if no Scores objects are needed for the cache
+            predicted_sets = _AnnotationSets(predicted_annotations, reference_sets.select, spans_type,
+                                             reference_sets.view_filter, profile=profile)
+            if corpus_scores is not None and cache_dir is None:
+                corpus_scores[predicted_dir].add_sets(text_name, reference_sets, predicted_sets, profile=profile)
+                system_named_scores[predicted_dir] = None
+                continue
+            named_scores = _score_sets(reference_sets, predicted_sets, scores_type=scores_type, profile=profile,
+                                       document_name=text_name)
+            for name, scores in named_scores.items():
 
-            def _span_text(spans):
-                return "...".join(text[start:end] for start, end in _flatten(spans))
+                # if we're using scores that keep track of errors, write them to the report (discarding them from
+                # the scores) or, if there were some predictions, log them
+                errors = getattr(scores, "errors", [])
+                if error_report is not None:
+                    if predicted_xml_paths:
+                        error_report.write(text_name, predicted_dir, name, errors, text.span_text)
+                    del errors[:]
+                elif predicted_xml_paths and logging.getLogger().isEnabledFor(logging.DEBUG):
+                    for annotation, message in errors:
+                        spans, _, _ = annotation
+                        logging.debug('%s: %s: "%s" %s"', text_name, message, text.span_text(spans), annotation)
+            system_named_scores[predicted_dir] = named_scores
 
-        # score this data and update the overall scores
-        named_scores = score_data(reference_data, predicted_data, include, exclude,
-                                  scores_type=scores_type, spans_type=spans_type)
-        for name, scores in named_scores.items():
+            # save the scores so that they can be reused if neither the reference nor the predictions change
+            if cache_dir is not None:
+                if not os.path.exists(cache_dir):
+                    os.makedirs(cache_dir)
+                cache_path = system_cache_paths[predicted_dir]
+                temp_path = "{0}.{1}.tmp".format(cache_path, os.getpid())
+                with open(temp_path, "w") as cache_file:
+                    json.dump(_named_scores_to_json(named_scores), cache_file)
+                os.replace(temp_path, cache_path)
+
+        # release the raw text (if it was ever read)
+        if text is not None:
+            text.close()
+
+        # add any scores that were cached (or are being cached) to the corpus scores
+        if corpus_scores is not None:
+            for predicted_dir in predicted_dirs:
+                if system_named_scores[predicted_dir] is not None:
+                    corpus_scores[predicted_dir].update(text_name, system_named_scores[predicted_dir])
+                    system_named_scores[predicted_dir] = None
+
+        # generate the file name and the resulting scores (in the order of the predicted directories)
+        yield text_name, collections.OrderedDict(
+            (predicted_dir, system_named_scores[predicted_dir]) for predicted_dir in predicted_dirs)
+
+    # report any predictions that were never compared to a reference document
+    for predicted_index in predicted_indexes.values():
+        for predicted_xml_path in predicted_index.unmatched_paths(shard, sample):
+            logging.warn("%s: no matching reference document", predicted_xml_path)
+
+
+def confusion_dirs(reference_dir, predicted_dir, xml_name_regex="[.]xml$", include=None, exclude=None,
+                   spans_type=None, shard=None, sample=None, reference_format="anafora", predicted_format="anafora"):
+    """
+    :param string reference_dir: directory containing reference ("gold standard") Anafora XML directories
+    :param string predicted_dir: directory containing predicted (system-generated) Anafora XML directories
+    :param xml_name_regex: regular expression matching the files to be compared
+    :param set include: types of annotations to include (others will be excluded); may be type names,
+        (type-name, property-name) tuples, (type-name, property-name, property-value) tuples
+    :param set exclude: types of annotations to exclude; may be type names, (type-name, property-name) tuples,
+        (type-name, property-name, property-value) tuples
+    :param type spans_type: not supported (must be None); see ConfusionMatrices.add
+    :param tuple shard: (index, count) to process only the documents whose sub-dirs hash to the index-th of count
+        shards; if None, all documents are processed
+    :param set sample: the sub-dirs of the only documents to be processed (see sample_documents); if None, all
+        documents are processed
+    :param string reference_format: "anafora" if the reference is Anafora XML directories, or "labelstudio" if it is
+        a Label Studio JSON export
+    :param string predicted_format: "anafora" if the predictions are Anafora XML directories, or "labelstudio" if
+        they are a Label Studio JSON export
+    :return iter: an iterator of (file-name, ConfusionMatrices) for each reference document
+    """
+
+    # aligning annotations needs the annotations themselves (not just the sets of an answer key) and exact spans
+    if spans_type is not None:
+        raise ValueError("confusion matrices do not support spans_type {0}".format(
+            getattr(spans_type, "__name__", spans_type)))
+    if reference_format == "anafora" and os.path.isfile(reference_dir):
+        raise ValueError("confusion matrices are not supported with answer key {0}".format(reference_dir))
+
+    # the documents are selected and matched exactly as in score_dirs
+    iter_references = _reference_documents(reference_dir, xml_name_regex, include, exclude, spans_type,
+                                           reference_format=reference_format)
+    predicted_index = _predicted_index(predicted_dir, xml_name_regex, predicted_format)
+    for sub_dir, text_name, reference in iter_references:
+        if not _in_shard(sub_dir, shard) or (sample is not None and sub_dir not in sample):
+            continue
+        reference_sets = reference.sets()
+        if reference_sets is None:
+            continue
+
+        # load the predicted data, if there is any
+        predicted_xml_paths = predicted_index.paths(sub_dir, text_name)
+        if len(predicted_xml_paths) != 1:
+            logging.warn("expected one predicted file for %s, found %s", text_name, predicted_xml_paths)
+        predicted_data = predicted_index.load(predicted_xml_paths[0]) if predicted_xml_paths else None
 
-            # if there were some predictions, and if we're using scores that keep track of errors, log the errors
-            if predicted_xml_paths:
-                for annotation, message in getattr(scores, "errors", []):
-                    spans, _, _ = annotation
-                    logging.debug('%s: %s: "%s" %s"', text_name, message, _span_text(spans), annotation)
+        # check for self-references in the annotations, which would make aligning relations by span loop forever
+        if predicted_data is not None and _find_self_referential(predicted_data) is not None:
+            logging.warn("skipping predicted file %s with a self-referential annotation", predicted_xml_paths[0])
+            predicted_data = None
 
-        # generate the file name and the resulting scores
-        yield text_name, named_scores
+        # the confusion matrices of each document can be merged into corpus-level matrices with update(...)
+        confusion_matrices = ConfusionMatrices()
+        confusion_matrices.add(reference_sets.annotations,
+                               [] if predicted_data is None else predicted_data.annotations,
+                               reference_sets.select, spans_type)
+        yield text_name, confusion_matrices
+
+    # report any predictions that were never compared to a reference document
+    for predicted_xml_path in predicted_index.unmatched_paths(shard, sample):
+        logging.warn("%s: no matching reference document", predicted_xml_path)
 
 
 def score_annotators(anafora_dir, xml_name_regex, include=None, exclude=None,
-                     scores_type=Scores, spans_type=None):
+                     scores_type=Scores, spans_type=None, shard=None, schema=None, views=None, processes=None):
     """
     :param anafora_dir: directory containing Anafora XML directories
     :param xml_name_regex: regular expression matching the annotator files to be compared
@@ -608,76 +3057,546 @@ def score_annotators(anafora_dir, xml_name_regex, include=None, exclude=None,
         (type-name, property-name, property-value) tuples
     :param type scores_type: type for calculating matches between predictions and reference
     :param type spans_type: wrapper object to apply to annotation spans
+    :param tuple shard: (index, count) to score only the documents whose sub-dirs hash to the index-th of count
+        shards (see write_partial_results and merge_partial_results); if None, all documents are scored
+    :param Schema schema: the Anafora schema (see anafora.validate.Schema) of the annotations; if given,
+        (type, property, value) views are only scored for properties whose values are chosen from a fixed list
+    :param list views: the names of the only views to be scored, e.g., (annotation type[, property name[, property
+        value]]); if None, all views found in the annotations are scored
+    :param int processes: the number of worker processes that score documents in parallel; if None, documents are
+        scored in the current process
     :return iter: an iterator of (file-name, name-to-scores) where name-to-scores is a mapping from
         (annotation type[, property name[, property value]]) to a Scores object
     """
 
+    # walks through the Anafora XML directories, selecting those in the shard
+    documents = ((sub_dir, text_name, xml_names)
+                 for sub_dir, text_name, xml_names in anafora.walk(anafora_dir, xml_name_regex)
+                 if _in_shard(sub_dir, shard))
+
+    # scores each document, either here or in a pool of worker processes
+    score_document = functools.partial(
+        _score_annotators_document, anafora_dir, include=include, exclude=exclude, scores_type=scores_type,
+        spans_type=spans_type, schema=schema, views=views)
+    if processes is None:
+        results = map(score_document, documents)
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap(score_document, documents)
+
+    # generate the filename and the resulting scores
+    try:
+        for text_name, annotator_named_scores in results:
+            if annotator_named_scores is not None:
+                yield text_name, annotator_named_scores
+    finally:
+        if processes is not None:
+            pool.terminate()
+
+
+def _load_annotator_sets(anafora_dir, document, include=None, exclude=None, spans_type=None, schema=None,
+                         views=None):
+    """
+    :param anafora_dir: directory containing Anafora XML directories
+    :param tuple document: the (sub-dir, text-file-name, xml-file-names) of the document, as from anafora.walk
+    :return list: (annotator-name, annotation-sets) for each annotator of the document, where all annotation sets
+        share the same key interner; see score_annotators for the other parameters
+    """
+    sub_dir, text_name, xml_names = document
+
     # pattern for extracting the annotator name from the Anafora XML file name
     annotator_name_regex = "([^.]*)[.][^.]*[.]xml$"
 
+    # returns true if this type:property:value is accepted by includes= and excludes=
+    select = anafora.select.Select(include, exclude)
+    view_filter = None if schema is None and views is None else _ViewFilter(schema, views)
+
+    # all annotators share the integer ids of the annotation keys, so that any of them can be compared
+    interner = _KeyInterner()
+
+    # load the data from each Anafora XML file, and calculate its annotation sets
+    annotator_sets = []
+    for xml_name in xml_names:
+
+        # ignore in-progress annotations and automatic pre-annotations
+        if '.inprogress.' in xml_name or '.preannotation.' in xml_name:
+            continue
+
+        # ignore empty files
+        xml_path = os.path.join(anafora_dir, sub_dir, xml_name)
+        if os.stat(xml_path).st_size == 0:
+            continue
+
+        # load the data and add it to the list
+        data = _load(xml_path)
+        annotator_name = re.search(annotator_name_regex, xml_name).group(1)
+        sets = _AnnotationSets(data.annotations, select, spans_type, view_filter, interner)
+        annotator_sets.append((annotator_name, sets))
+    return annotator_sets
+
+
+def _score_annotators_document(anafora_dir, document, include=None, exclude=None,
+                               scores_type=Scores, spans_type=None, schema=None, views=None):
+    """
+    :param anafora_dir: directory containing Anafora XML directories
+    :param tuple document: the (sub-dir, text-file-name, xml-file-names) of the document, as from anafora.walk
+    :return tuple: (file-name, name-to-scores), where name-to-scores is None if there were not enough annotators;
+        see score_annotators for the other parameters and the return value
+    """
+    _, text_name, xml_names = document
+
     # function for getting a canonical prefix corresponding to a pair of annotators
     def make_prefix(annotators):
         return "{0}-vs-{1}".format(*sorted(annotators))
 
-    # walks through the Anafora XML directories, scoring each and adding those to the overall scores
-    for sub_dir, text_name, xml_names in anafora.walk(anafora_dir, xml_name_regex):
+    # load the annotation sets of each annotator (once for all pairs)
+    annotator_sets = _load_annotator_sets(
+        anafora_dir, document, include=include, exclude=exclude, spans_type=spans_type, schema=schema, views=views)
 
-        # load the data from each Anafora XML file
-        annotator_data = []
-        for xml_name in xml_names:
+    # at least 2 annotators are needed for annotator agreement
+    if len(annotator_sets) < 2:
+        logging.warn("%s: found fewer than 2 annotators: %s", text_name, xml_names)
+        return text_name, None
 
-            # ignore in-progress annotations and automatic pre-annotations
-            if '.inprogress.' in xml_name or '.preannotation.' in xml_name:
-                continue
+    # pair each annotator with each other annotator
+    annotator_named_scores = collections.defaultdict(scores_type)
+    for i in range(len(annotator_sets)):
+        annotator1, sets1 = annotator_sets[i]
+        for j in range(i + 1, len(annotator_sets)):
+            annotator2, sets2 = annotator_sets[j]
 
-            # ignore empty files
-            xml_path = os.path.join(anafora_dir, sub_dir, xml_name)
-            if os.stat(xml_path).st_size == 0:
-                continue
+            # make a prefix for this specific pair of annotators
+            prefix = make_prefix([annotator1, annotator2])
+
+            # make a prefix where non-gold annotators are just called "annotator"
+            general_prefix = make_prefix(
+                a if a == "gold" else "annotator" for a in [annotator1, annotator2])
+
+            # perform the comparison of the two annotation sets and update the overall scores
+            named_scores = _score_sets(sets1, sets2, scores_type=scores_type, document_name=text_name)
+
+            # add annotators as prefixes
+            for name, scores in named_scores.items():
+                if not isinstance(name, tuple):
+                    name = name,
+                annotator_named_scores[(prefix,) + name].update(scores)
+                annotator_named_scores[(general_prefix,) + name].update(scores)
+
+    return text_name, annotator_named_scores
+
+
+class AgreementScores(object):
+    def __init__(self):
+        """
+        Agreement among any number of annotators, where each item (an annotation key produced by any annotator) is
+        a unit that each annotator either did or did not annotate. Only the number of items with each (annotators,
+        votes) combination is kept, from which Fleiss-style and Krippendorff-style agreement can be calculated.
+        """
+        self.vote_counts = collections.Counter()
+
+    def add(self, annotator_sets):
+        """
+        :param list annotator_sets: the set of annotations (of one view in one document) of each annotator
+        """
+        annotators = len(annotator_sets)
+        item_votes = collections.Counter()
+        for annotations in annotator_sets:
+            item_votes.update(annotations)
+        self.vote_counts.update((annotators, votes) for votes in item_votes.values())
+
+    def update(self, other):
+        """
+        :param AgreementScores other: agreement to merge into this one
+        """
+        self.vote_counts.update(other.vote_counts)
+
+    @property
+    def items(self):
+        return sum(self.vote_counts.values())
+
+    def fleiss_kappa(self):
+        """
+        :return float: Fleiss's kappa, where the two categories are "annotated" and "not annotated"
+        """
+        if not self.vote_counts:
+            return 1.0
+        observed = 0.0
+        votes_total = 0
+        annotators_total = 0
+        for (annotators, votes), count in self.vote_counts.items():
+            pairs = votes * (votes - 1) + (annotators - votes) * (annotators - votes - 1)
+            observed += count * pairs / float(annotators * (annotators - 1))
+            votes_total += count * votes
+            annotators_total += count * annotators
+        observed /= self.items
+        p = votes_total / float(annotators_total)
+        expected = p * p + (1 - p) * (1 - p)
+        return 1.0 if expected == 1.0 else (observed - expected) / (1.0 - expected)
+
+    def krippendorff_alpha(self):
+        """
+        :return float: Krippendorff's alpha for nominal data, where the two values are "annotated" and "not
+            annotated"
+        """
+        disagreements = 0.0
+        annotated = 0
+        not_annotated = 0
+        for (annotators, votes), count in self.vote_counts.items():
+            disagreements += count * votes * (annotators - votes) / float(annotators - 1)
+            annotated += count * votes
+            not_annotated += count * (annotators - votes)
+        if annotated == 0 or not_annotated == 0:
+            return 1.0
+        return 1.0 - (annotated + not_annotated - 1) * disagreements / float(annotated * not_annotated)
+
+    def __repr__(self):
+        return "{0}(vote_counts={1})".format(self.__class__.__name__, dict(self.vote_counts))
 
-            # load the data and add it to the list
-            data = _load(xml_path)
-            annotator_name = re.search(annotator_name_regex, xml_name).group(1)
-            annotator_data.append((annotator_name, data))
+
+def score_agreement(anafora_dir, xml_name_regex, include=None, exclude=None, spans_type=None, shard=None,
+                    schema=None, views=None):
+    """
+    Measures the agreement of all the annotators of each document at once, in time linear in the total number of
+    annotations (rather than comparing each pair of annotators, as in score_annotators).
+
+    :param anafora_dir: directory containing Anafora XML directories
+    :param xml_name_regex: regular expression matching the annotator files to be compared
+    :param include: types of annotations to include (others will be excluded); may be type names,
+        (type-name, property-name) tuples, (type-name, property-name, property-value) tuples
+    :param set exclude: types of annotations to exclude; may be type names, (type-name, property-name) tuples,
+        (type-name, property-name, property-value) tuples
+    :param type spans_type: wrapper object to apply to annotation spans
+    :param tuple shard: (index, count) to score only the documents whose sub-dirs hash to the index-th of count
+        shards; if None, all documents are scored
+    :param Schema schema: the Anafora schema (see anafora.validate.Schema) of the annotations; if given,
+        (type, property, value) views are only scored for properties whose values are chosen from a fixed list
+    :param list views: the names of the only views to be scored, e.g., (annotation type[, property name[, property
+        value]]); if None, all views found in the annotations are scored
+    :return iter: an iterator of (file-name, name-to-agreement) where name-to-agreement is a mapping from
+        (annotation type[, property name[, property value]]) to an AgreementScores object
+    """
+    for document in anafora.walk(anafora_dir, xml_name_regex):
+        sub_dir, text_name, xml_names = document
+
+        # skip documents that belong to other shards
+        if not _in_shard(sub_dir, shard):
+            continue
+
+        # load the annotation sets of each annotator
+        annotator_sets = _load_annotator_sets(
+            anafora_dir, document, include=include, exclude=exclude, spans_type=spans_type, schema=schema,
+            views=views)
 
         # at least 2 annotators are needed for annotator agreement
-        if len(annotator_data) < 2:
+        if len(annotator_sets) < 2:
             logging.warn("%s: found fewer than 2 annotators: %s", text_name, xml_names)
             continue
 
-        # pair each annotator with each other annotator
-        annotator_named_scores = collections.defaultdict(lambda: scores_type())
-        for i in range(len(annotator_data)):
-            annotator1, data1 = annotator_data[i]
-            for j in range(i + 1, len(annotator_data)):
-                annotator2, data2 = annotator_data[j]
+        # the available views are all those found in any annotator's annotations
+        all_views = {}
+        for _, sets in annotator_sets:
+            all_views.update(sets.views)
+
+        # pool the (integer ids of the) annotations of all annotators in each view, where keys with wrapped spans
+        # cannot be interned (see _view_set_pairs)
+        named_agreement = collections.defaultdict(AgreementScores)
+        interner = annotator_sets[0][1].interner
+        for view_name in sorted(all_views, key=lambda x: x if isinstance(x, tuple) else (x,)):
+            to_set = all_views[view_name]
+            if spans_type is None:
+                annotations = [sets.get_interned(view_name, to_set, interner) for _, sets in annotator_sets]
+            else:
+                annotations = [sets.get(view_name, to_set) for _, sets in annotator_sets]
+            named_agreement[view_name].add(annotations)
+
+        # generate the filename and the resulting agreement
+        yield text_name, named_agreement
+
 
-                # make a prefix for this specific pair of annotators
-                prefix = make_prefix([annotator1, annotator2])
+_partial_results_format = "anafora-partial-results"
+_partial_results_version = 1
 
-                # make a prefix where non-gold annotators are just called "annotator"
-                general_prefix = make_prefix(
-                    a if a == "gold" else "annotator" for a in [annotator1, annotator2])
 
-                # perform the comparison of the two annotation sets and update the overall scores
-                named_scores = score_data(data1, data2, include, exclude,
-                                          scores_type=scores_type, spans_type=spans_type)
+def write_partial_results(partial_results_path, file_system_named_scores, scores_type=Scores, shard=None,
+                          settings=None):
+    """
+    Writes the scores of each document to a file, so that the scores of shards of a corpus that were evaluated
+    separately (e.g., on different machines) can be combined with merge_partial_results.
 
-                # add annotators as prefixes
-                for name, scores in named_scores.items():
-                    if not isinstance(name, tuple):
-                        name = name,
-                    annotator_named_scores[(prefix,) + name].update(scores)
-                    annotator_named_scores[(general_prefix,) + name].update(scores)
+    :param string partial_results_path: the path of the (JSON lines) file to write
+    :param iter file_system_named_scores: an iterator of (file-name, system-to-name-to-scores), as produced by
+        score_systems; for scores from score_dirs or score_annotators, the system may be None
+    :param type scores_type: type that was used for calculating matches between predictions and reference
+    :param tuple shard: (index, count) of the shard that was scored; or None if all documents were scored
+    :param dict settings: any other settings of the evaluation (include=, exclude=, etc.), which must be the same
+        for all partial results that are merged
+    """
+    scores = scores_type()
+    if not hasattr(scores, "_count_names"):
+        raise ValueError("{0} scores cannot be written as partial results".format(type(scores).__name__))
+    header = {
+        "format": _partial_results_format,
+        "version": _partial_results_version,
+        "scores_type": type(scores).__name__,
+        "shard": None if shard is None else list(shard),
+        "settings": settings,
+    }
+    temp_path = "{0}.{1}.tmp".format(partial_results_path, os.getpid())
+    with open(temp_path, "w") as partial_results_file:
+        partial_results_file.write(json.dumps(header, sort_keys=True) + "\n")
+        for text_name, system_named_scores in file_system_named_scores:
+            for system_name, named_scores in system_named_scores.items():
+                document = {
+                    "text_name": text_name,
+                    "system": system_name,
+                    "scores": _named_scores_to_json(named_scores),
+                }
+                partial_results_file.write(json.dumps(document, sort_keys=True) + "\n")
+    os.replace(temp_path, partial_results_path)
 
-        # generate the filename and the resulting scores
-        yield text_name, annotator_named_scores
 
+def merge_partial_results(partial_results_paths):
+    """
+    Combines the partial results of several shards of a corpus, as written by write_partial_results.
 
-def _print_document_scores(file_named_scores):
+    :param list partial_results_paths: the paths of the partial results files
+    :return tuple: (scores-type, file-system-named-scores), where file-system-named-scores is a list of
+        (file-name, system-to-name-to-scores) in the same form as produced by score_systems
+    """
+    # any scores type that keeps counts could have been written as partial results
+    scores_types = {value.__name__: value for value in globals().values()
+                    if isinstance(value, type) and hasattr(value, "_count_names")}
+    header_keys = ["scores_type", "settings"]
+    first_header = None
+    scores_type = Scores
+    shard_paths = {}
+    file_system_named_scores = []
+    for partial_results_path in partial_results_paths:
+        with open(partial_results_path) as partial_results_file:
+            header = json.loads(next(partial_results_file))
+            if (header.get("format") != _partial_results_format or
+                    header.get("version") != _partial_results_version):
+                msg = "{0} is not a version {1} partial results file"
+                raise ValueError(msg.format(partial_results_path, _partial_results_version))
+
+            # all partial results must come from the same kind of evaluation
+            if first_header is None:
+                first_header = header
+            for key in header_keys:
+                if header[key] != first_header[key]:
+                    msg = "{0}={1} of {2} does not match {0}={3} of {4}"
+                    raise ValueError(msg.format(key, header[key], partial_results_path,
+                                                first_header[key], partial_results_paths[0]))
+
+            # each shard must be given only once, and all shards must come from the same number of shards
+            shard = None if header["shard"] is None else tuple(header["shard"])
+            if shard in shard_paths:
+                msg = "{0} and {1} both contain shard {2}"
+                raise ValueError(msg.format(shard_paths[shard], partial_results_path, shard))
+            for other_shard, other_path in shard_paths.items():
+                if None in (shard, other_shard) or shard[1] != other_shard[1]:
+                    msg = "{0} contains shard {1} but {2} contains shard {3}"
+                    raise ValueError(msg.format(other_path, other_shard, partial_results_path, shard))
+            shard_paths[shard] = partial_results_path
+
+            # collect the scores of each document
+            if header["scores_type"] not in scores_types:
+                msg = "{0} contains scores of unknown type {1}"
+                raise ValueError(msg.format(partial_results_path, header["scores_type"]))
+            scores_type = scores_types[header["scores_type"]]
+            for line in partial_results_file:
+                document = json.loads(line)
+                if not file_system_named_scores or file_system_named_scores[-1][0] != document["text_name"]:
+                    file_system_named_scores.append((document["text_name"], collections.OrderedDict()))
+                file_system_named_scores[-1][1][document["system"]] = _named_scores_from_json(
+                    document["scores"], scores_type)
+
+    # warn about any shards that were not given
+    if shard_paths and None not in shard_paths:
+        count = next(iter(shard_paths))[1]
+        for index in range(count):
+            if (index, count) not in shard_paths:
+                logging.warn("no partial results for shard %s/%s", index, count)
+
+    return scores_type, file_system_named_scores
+
+
+def _bootstrap_counts(scores):
+    """
+    :param Scores scores: the scores of one document
+    :return list: [reference, predicted, precision-correct, recall-correct] counts of the scores
+    """
+    correct = getattr(scores, "precision_correct", None), getattr(scores, "recall_correct", None)
+    if correct == (None, None):
+        correct = scores.correct, scores.correct
+    return [scores.reference, scores.predicted, correct[0], correct[1]]
+
+
+def _bootstrap_metrics(reference, predicted, precision_correct, recall_correct):
+    """
+    :return tuple: (precision, recall, F1) calculated as in Scores, where the counts may be numbers or (if numpy is
+        available) arrays of numbers
+    """
+    if numpy is not None:
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            precision = numpy.where(predicted == 0, 1.0, precision_correct / numpy.maximum(predicted, 1))
+            recall = numpy.where(reference == 0, 1.0, recall_correct / numpy.maximum(reference, 1))
+            f1 = numpy.where(precision + recall == 0, 0.0, 2 * precision * recall / (precision + recall))
+        return precision, recall, f1
+    precision = 1.0 if predicted == 0 else precision_correct / float(predicted)
+    recall = 1.0 if reference == 0 else recall_correct / float(reference)
+    f1 = 0.0 if precision + recall == 0.0 else 2 * precision * recall / (precision + recall)
+    return precision, recall, f1
+
+
+def _percentile(values, percent):
+    """
+    :param list values: the values, which must already be sorted
+    :param float percent: the percentile, between 0 and 100
+    :return float: the value at the percentile, interpolating linearly between values (as numpy.percentile does)
+    """
+    position = (len(values) - 1) * percent / 100.0
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def bootstrap_scores(file_system_named_scores, n_samples=1000, confidence=0.95, seed=None):
+    """
+    Estimates confidence intervals for precision, recall and F1, and the significance of the differences between
+    systems, by resampling documents with replacement (a paired bootstrap, since all systems share the same
+    resampled documents). Uses numpy (if it is installed) to resample all views and systems at once.
+
+    :param iter file_system_named_scores: an iterator of (file-name, system-to-name-to-scores), as produced by
+        score_systems; for scores from score_dirs or score_annotators, the system may be None
+    :param int n_samples: the number of bootstrap samples
+    :param float confidence: the coverage of the confidence intervals, e.g., 0.95 for 95% confidence intervals
+    :param int seed: the seed for the random number generator; if None, the results will vary from run to run
+    :return tuple: (system-to-name-to-intervals, pair-to-name-to-differences), where intervals map each of
+        "precision", "recall" and "f1" to a (value, lower-bound, upper-bound) tuple, and differences map each of
+        "precision", "recall" and "f1" to a (second-minus-first-system, p-value) tuple, for each (first-system,
+        second-system) pair
+    """
+
+    # collect the counts of each view of each system as one row per document
+    document_system_named_scores = [system_named_scores for _, system_named_scores in file_system_named_scores]
+    systems = []
+    names = set()
+    for system_named_scores in document_system_named_scores:
+        for system_name, named_scores in system_named_scores.items():
+            if system_name not in systems:
+                systems.append(system_name)
+            names.update(named_scores)
+    if not document_system_named_scores:
+        raise ValueError("no documents to resample")
+
+    names = sorted(names, key=_score_name)
+    columns = [(system_name, name) for system_name in systems for name in names]
+    empty_counts = [0, 0, 0, 0]
+    rows = []
+    for system_named_scores in document_system_named_scores:
+        row = []
+        for system_name, name in columns:
+            named_scores = system_named_scores.get(system_name, {})
+            row.extend(_bootstrap_counts(named_scores[name]) if name in named_scores else empty_counts)
+        rows.append(row)
+    n_documents = len(rows)
+    totals = [sum(counts) for counts in zip(*rows)]
 
-    def _score_name(x):
-        return ":".join(x) if isinstance(x, tuple) else x
+    # sum the counts of the resampled documents, giving an array of samples x columns x counts
+    if numpy is not None:
+        random_state = numpy.random.RandomState(seed)
+        rows = numpy.array(rows, dtype=numpy.float64)
+        chunk_size = max(1, 10 ** 7 // n_documents)
+        sample_totals = []
+        for start in range(0, n_samples, chunk_size):
+            size = min(chunk_size, n_samples - start)
+
+            # count how often each document was drawn in each sample, then weight the document counts by that
+            indices = random_state.randint(n_documents, size=(size, n_documents))
+            indices += numpy.arange(size)[:, numpy.newaxis] * n_documents
+            weights = numpy.bincount(indices.ravel(), minlength=size * n_documents).reshape(size, n_documents)
+            sample_totals.append(weights.dot(rows))
+        sample_totals = numpy.concatenate(sample_totals).reshape(n_samples, len(columns), 4)
+        sample_metrics = _bootstrap_metrics(*numpy.moveaxis(sample_totals, 2, 0))
+
+        def _column_samples(metric_index, column_index):
+            return sample_metrics[metric_index][:, column_index]
+
+        def _sorted(values):
+            return numpy.sort(values)
+
+        def _count_outside(values, radius):
+            return int(numpy.count_nonzero(numpy.abs(values) >= radius))
+
+    # without numpy, resample one document at a time
+    else:
+        rng = random.Random(seed)
+        sample_metrics = ([], [], [])
+        for _ in range(n_samples):
+            sample_totals = [0] * len(totals)
+            for index, count in collections.Counter(rng.randrange(n_documents) for _ in range(n_documents)).items():
+                for i, value in enumerate(rows[index]):
+                    sample_totals[i] += count * value
+            metrics = [_bootstrap_metrics(*sample_totals[i:i + 4]) for i in range(0, len(sample_totals), 4)]
+            for metric_index, values in enumerate(sample_metrics):
+                values.append([column_metrics[metric_index] for column_metrics in metrics])
+
+        def _column_samples(metric_index, column_index):
+            return [column_values[column_index] for column_values in sample_metrics[metric_index]]
+
+        def _sorted(values):
+            return sorted(values)
+
+        def _count_outside(values, radius):
+            return sum(1 for value in values if abs(value) >= radius)
+
+    # calculate the observed scores and the percentile confidence intervals
+    metric_names = ["precision", "recall", "f1"]
+    alpha = 100.0 * (1.0 - confidence) / 2.0
+    observed = {}
+    system_named_intervals = collections.OrderedDict((system_name, {}) for system_name in systems)
+    for column_index, (system_name, name) in enumerate(columns):
+        observed[system_name, name] = _bootstrap_metrics(*totals[4 * column_index:4 * column_index + 4])
+        intervals = system_named_intervals[system_name][name] = {}
+        for metric_index, metric_name in enumerate(metric_names):
+            values = _sorted(_column_samples(metric_index, column_index))
+            intervals[metric_name] = (float(observed[system_name, name][metric_index]),
+                                      float(_percentile(values, alpha)), float(_percentile(values, 100.0 - alpha)))
+
+    # calculate the two-sided p-value of the difference between each pair of systems, i.e., how often the
+    # resampled differences are at least as far from the observed difference as the observed difference is from 0
+    pair_named_differences = collections.OrderedDict()
+    for i, system1 in enumerate(systems):
+        for system2 in systems[i + 1:]:
+            named_differences = pair_named_differences[system1, system2] = {}
+            for name in names:
+                differences = named_differences[name] = {}
+                index1 = columns.index((system1, name))
+                index2 = columns.index((system2, name))
+                for metric_index, metric_name in enumerate(metric_names):
+                    difference = observed[system2, name][metric_index] - observed[system1, name][metric_index]
+                    samples1 = _column_samples(metric_index, index1)
+                    samples2 = _column_samples(metric_index, index2)
+                    if numpy is not None:
+                        shifted = samples2 - samples1 - difference
+                    else:
+                        shifted = [value2 - value1 - difference for value1, value2 in zip(samples1, samples2)]
+                    n_outside = _count_outside(shifted, abs(difference) - 1e-12)
+                    differences[metric_name] = (float(difference), (n_outside + 1.0) / (n_samples + 1.0))
+
+    return system_named_intervals, pair_named_differences
+
+
+def _score_name(name):
+    """
+    :param name: a view name, e.g., an annotation type or an (annotation type, property name[, property value]) tuple
+    :return string: the view name as printed, e.g., "TLINK:Type:BEFORE"
+    """
+    return ":".join(name) if isinstance(name, tuple) else name
+
+
+def _print_document_scores(file_named_scores):
 
     print("{0:40}\t{1:40}\t{2:^5}\t{3:^5}\t{4:^5}\t{5:^5}\t{6:^5}\t{7:^5}".format(
         "", "", "ref", "pred", "corr", "P", "R", "F1"))
@@ -688,14 +3607,19 @@ def _print_document_scores(file_named_scores):
                 scores.precision(), scores.recall(), scores.f1()))
 
 
-def _print_merged_scores(file_named_scores, scores_type):
-    all_named_scores = collections.defaultdict(lambda: scores_type())
-    for _, named_scores in file_named_scores:
-        for name, scores in named_scores.items():
-            all_named_scores[name].update(scores)
+def _print_merged_scores(file_named_scores, scores_type, macro=False):
+    corpus_scores = CorpusScores(_counting_scores_type(scores_type), keep_documents=macro)
+    for file_name, named_scores in file_named_scores:
+        corpus_scores.update(file_name, named_scores)
+    _print_corpus_scores(corpus_scores, macro=macro)
 
-    def _score_name(x):
-        return ":".join(x) if isinstance(x, tuple) else x
+
+def _print_corpus_scores(corpus_scores, macro=False):
+    if macro:
+        print("{0:40}\t{1:^5}\t{2:^5}\t{3:^5}".format("", "P", "R", "F1"))
+        _print_macro_scores(corpus_scores)
+        return
+    all_named_scores = corpus_scores.micro()
 
     print("{0:40}\t{1:^5}\t{2:^5}\t{3:^5}\t{4:^5}\t{5:^5}\t{6:^5}".format(
         "", "ref", "pred", "corr", "P", "R", "F1"))
@@ -706,19 +3630,185 @@ def _print_merged_scores(file_named_scores, scores_type):
             scores.precision(), scores.recall(), scores.f1()))
 
 
+def _counting_scores_type(scores_type):
+    # the errors of DebuggingScores have already been logged, so only their counts need to be merged
+    if isinstance(scores_type, type) and issubclass(scores_type, DebuggingScores):
+        return Scores
+    return scores_type
+
+
+def _print_macro_scores(corpus_scores, system_name=None):
+
+    named_macro_scores = corpus_scores.macro()
+    for name in sorted(named_macro_scores, key=_score_name):
+        scores = named_macro_scores[name]
+        if system_name is None:
+            print("{0!s:40}\t{1:5.3f}\t{2:5.3f}\t{3:5.3f}".format(_score_name(name), *scores))
+        else:
+            print("{0!s:40}\t{1!s:40}\t{2:5.3f}\t{3:5.3f}\t{4:5.3f}".format(system_name, _score_name(name), *scores))
+
+
+def _print_iou_scores(file_named_scores, thresholds):
+    all_named_scores = collections.defaultdict(lambda: SpanIoUScores(thresholds))
+    for file_name, named_scores in file_named_scores:
+        for name, scores in named_scores.items():
+            all_named_scores[name].update(scores)
+
+    print("{0:^5}\t{1:40}\t{2:^5}\t{3:^5}\t{4:^5}\t{5:^5}\t{6:^5}\t{7:^5}".format(
+        "IoU", "", "ref", "pred", "corr", "P", "R", "F1"))
+    for threshold in sorted(thresholds):
+        for name in sorted(all_named_scores, key=_score_name):
+            scores = all_named_scores[name].scores(threshold)
+            print("{0:5.3f}\t{1!s:40}\t{2!s:5}\t{3!s:5}\t{4!s:5}\t{5:5.3f}\t{6:5.3f}\t{7:5.3f}".format(
+                threshold, _score_name(name), scores.reference, scores.predicted, scores.correct,
+                scores.precision(), scores.recall(), scores.f1()))
+
+
+def _print_confusion_matrices(file_confusion_matrices):
+    all_confusion_matrices = ConfusionMatrices()
+    for file_name, confusion_matrices in file_confusion_matrices:
+        all_confusion_matrices.update(confusion_matrices)
+
+    def _value_name(value):
+        return "<none>" if value is None else value
+
+    for type_name, prop_name in sorted(all_confusion_matrices.matrices):
+        matrix = all_confusion_matrices.matrices[type_name, prop_name]
+        reference_values, predicted_values = all_confusion_matrices.values(type_name, prop_name)
+        print("{0}:{1} (rows: reference, columns: predicted)".format(type_name, prop_name))
+        print("\t".join(["{0:20}".format("")] + ["{0!s:>10}".format(_value_name(v)) for v in predicted_values]))
+        for reference_value in reference_values:
+            counts = [matrix[reference_value, predicted_value] for predicted_value in predicted_values]
+            print("\t".join(["{0!s:20}".format(_value_name(reference_value))] +
+                            ["{0:10d}".format(count) for count in counts]))
+        print()
+    for (type_name, side), count in sorted(all_confusion_matrices.unaligned.items()):
+        print("{0!s:40}\t{1} {2} annotations not aligned by span".format(type_name, count, side))
+
+
+def _print_document_system_scores(file_system_named_scores):
+
+    print("{0:40}\t{1:40}\t{2:40}\t{3:^5}\t{4:^5}\t{5:^5}\t{6:^5}\t{7:^5}\t{8:^5}".format(
+        "", "", "", "ref", "pred", "corr", "P", "R", "F1"))
+    for file_name, system_named_scores in file_system_named_scores:
+        for system_name, named_scores in system_named_scores.items():
+            for name, scores in named_scores.items():
+                print("{0!s:40}\t{1!s:40}\t{2!s:40}\t{3!s:5}\t{4!s:5}\t{5!s:5}\t{6:5.3f}\t{7:5.3f}\t{8:5.3f}".format(
+                    file_name, system_name, _score_name(name), scores.reference, scores.predicted, scores.correct,
+                    scores.precision(), scores.recall(), scores.f1()))
+
+
+def _print_merged_system_scores(file_system_named_scores, scores_type, macro=False):
+    system_corpus_scores = collections.OrderedDict()
+    for file_name, system_named_scores in file_system_named_scores:
+        for system_name, named_scores in system_named_scores.items():
+            if system_name not in system_corpus_scores:
+                system_corpus_scores[system_name] = CorpusScores(
+                    _counting_scores_type(scores_type), keep_documents=macro)
+            system_corpus_scores[system_name].update(file_name, named_scores)
+    _print_system_corpus_scores(system_corpus_scores, macro=macro)
+
+
+def _print_system_corpus_scores(system_corpus_scores, macro=False):
+    if macro:
+        print("{0:40}\t{1:40}\t{2:^5}\t{3:^5}\t{4:^5}".format("", "", "P", "R", "F1"))
+        for system_name, corpus_scores in system_corpus_scores.items():
+            _print_macro_scores(corpus_scores, system_name)
+        return
+    system_all_named_scores = collections.OrderedDict(
+        (system_name, corpus_scores.micro()) for system_name, corpus_scores in system_corpus_scores.items())
+
+    print("{0:40}\t{1:40}\t{2:^5}\t{3:^5}\t{4:^5}\t{5:^5}\t{6:^5}\t{7:^5}".format(
+        "", "", "ref", "pred", "corr", "P", "R", "F1"))
+    for system_name, all_named_scores in system_all_named_scores.items():
+        for name in sorted(all_named_scores, key=_score_name):
+            scores = all_named_scores[name]
+            print("{0!s:40}\t{1!s:40}\t{2!s:5}\t{3!s:5}\t{4!s:5}\t{5:5.3f}\t{6:5.3f}\t{7:5.3f}".format(
+                system_name, _score_name(name), scores.reference, scores.predicted, scores.correct,
+                scores.precision(), scores.recall(), scores.f1()))
+
+
+def _print_bootstrap_scores(system_named_intervals, pair_named_differences):
+
+    metric_names = ["precision", "recall", "f1"]
+    print("{0:40}\t{1:40}\t{2:^20}\t{3:^20}\t{4:^20}".format("", "", "P", "R", "F1"))
+    for system_name, named_intervals in system_named_intervals.items():
+        for name in sorted(named_intervals, key=_score_name):
+            intervals = named_intervals[name]
+            print("{0!s:40}\t{1!s:40}\t{2}\t{3}\t{4}".format(
+                system_name or "", _score_name(name), *[
+                    "{0:5.3f} [{1:5.3f}, {2:5.3f}]".format(*intervals[metric_name]) for metric_name in metric_names]))
+
+    if pair_named_differences:
+        print("")
+        print("{0:40}\t{1:40}\t{2:40}\t{3:^16}\t{4:^16}\t{5:^16}".format("", "", "", "P", "R", "F1"))
+        for (system1, system2), named_differences in pair_named_differences.items():
+            for name in sorted(named_differences, key=_score_name):
+                differences = named_differences[name]
+                print("{0!s:40}\t{1!s:40}\t{2!s:40}\t{3}\t{4}\t{5}".format(
+                    system1, system2, _score_name(name), *[
+                        "{0:+6.3f} p={1:5.3f}".format(*differences[metric_name]) for metric_name in metric_names]))
+
+
+def _print_agreement(file_named_agreement, per_document=False):
+
+    def _votes(agreement):
+        return " ".join("{1}/{0}:{2}".format(annotators, votes, count)
+                        for (annotators, votes), count in sorted(agreement.vote_counts.items()))
+
+    if per_document:
+        print("{0:40}\t{1:40}\t{2:^6}\t{3:^6}\t{4:^6}\t{5}".format("", "", "items", "kappa", "alpha", "votes"))
+        for file_name, named_agreement in file_named_agreement:
+            for name in sorted(named_agreement, key=_score_name):
+                agreement = named_agreement[name]
+                print("{0!s:40}\t{1!s:40}\t{2!s:6}\t{3:6.3f}\t{4:6.3f}\t{5}".format(
+                    file_name, _score_name(name), agreement.items, agreement.fleiss_kappa(),
+                    agreement.krippendorff_alpha(), _votes(agreement)))
+    else:
+        all_named_agreement = collections.defaultdict(AgreementScores)
+        for _, named_agreement in file_named_agreement:
+            for name, agreement in named_agreement.items():
+                all_named_agreement[name].update(agreement)
+        print("{0:40}\t{1:^6}\t{2:^6}\t{3:^6}\t{4}".format("", "items", "kappa", "alpha", "votes"))
+        for name in sorted(all_named_agreement, key=_score_name):
+            agreement = all_named_agreement[name]
+            print("{0!s:40}\t{1!s:6}\t{2:6.3f}\t{3:6.3f}\t{4}".format(
+                _score_name(name), agreement.items, agreement.fleiss_kappa(), agreement.krippendorff_alpha(),
+                _votes(agreement)))
+
+
 if __name__ == "__main__":
     def split_tuple_on_colons(string):
         result = tuple(string.split(":"))
         return result[0] if len(result) == 1 else result
 
+    def parse_shard(string):
+        match = re.match(r"^(\d+)/(\d+)$", string)
+        if match is None or not 0 <= int(match.group(1)) < int(match.group(2)):
+            raise argparse.ArgumentTypeError("expected I/N with 0 <= I < N, found {0!r}".format(string))
+        return int(match.group(1)), int(match.group(2))
+
     parser = argparse.ArgumentParser(description="""%(prog)s compares one directory of Anafora XML annotations to
         another and prints statistics such as precision, recall and F-measure. It can also be used with a single
         Anafora XML directory to compute inter-annotator agreement.""")
     parser.set_defaults(scores_type=Scores)
-    parser.add_argument("-r", "--reference", metavar="DIR", dest="reference_dir", required=True,
-                        help="The root of a set of Anafora XML directories representing reference annotations.")
-    parser.add_argument("-p", "--predicted", metavar="DIR", dest="predicted_dir",
-                        help="The root of a set of Anafora XML directories representing system-predicted annotations.")
+    parser.add_argument("-r", "--reference", metavar="DIR", dest="reference_dir",
+                        help="The root of a set of Anafora XML directories representing reference annotations, or " +
+                             "an answer key file created with --compile-answer-key.")
+    parser.add_argument("-p", "--predicted", metavar="DIR", dest="predicted_dirs", nargs="+",
+                        help="The root of a set of Anafora XML directories representing system-predicted annotations. " +
+                             "If several directories are given, each reference document is loaded only once, and " +
+                             "the scores of each system are printed side by side.")
+    parser.add_argument("--reference-format", choices=["anafora", "labelstudio"], default="anafora",
+                        help="The format of --reference: Anafora XML directories, or a Label Studio JSON export " +
+                             "whose documents are named by the sources of the tasks (default: %(default)s)")
+    parser.add_argument("--predicted-format", choices=["anafora", "labelstudio"], default="anafora",
+                        help="The format of --predicted: Anafora XML directories, or Label Studio JSON exports " +
+                             "(default: %(default)s)")
+    parser.add_argument("--compile-answer-key", metavar="FILE",
+                        help="Instead of evaluating, compile the reference annotations (restricted by --include and " +
+                             "--exclude) into an answer key file, which can then be given to --reference in place of " +
+                             "the reference directory to avoid parsing the reference XML on every evaluation.")
     parser.add_argument("-t", "--text", metavar="DIR", dest="text_dir",
                         help="A flat directory containing the raw text. By default, the reference directory is " +
                              "assumed to contain the raw text. (Text is typically only needed with --verbose.)")
@@ -731,6 +3821,14 @@ if __name__ == "__main__":
     parser.add_argument("-e", "--exclude", metavar="EXPR", nargs="+", type=split_tuple_on_colons,
                         help="An expression identifying types of annotations to be excluded from the evaluation. " +
                              "The expression takes the form type[:property[:value] (see --include).")
+    parser.add_argument("--schema", metavar="FILE",
+                        help="An Anafora schema file for the annotations. Property values are only evaluated " +
+                             "separately (as type:property:value) for properties whose values are chosen from a " +
+                             "list in the schema, not for free-text properties such as comments.")
+    parser.add_argument("--views", metavar="EXPR", nargs="+", type=split_tuple_on_colons,
+                        help="The only views to evaluate, each of the form type[:property[:value]] or " +
+                             "type:<span>, where type may be * for all types. By default, all views found in the " +
+                             "annotations are evaluated.")
     parser.add_argument("-x", "--xml-name-regex", metavar="REGEX", default="[.]xml$",
                         help="A regular expression for matching XML files in the subdirectories, typically used to " +
                              "restrict the evaluation to a subset of the available files (default: %(default)r)")
@@ -739,41 +3837,375 @@ if __name__ == "__main__":
                              "apply temporal closure on the predicted annotations when calculating recall. " +
                              "This must be combined with --include to restrict the evaluation to a Type:Property " +
                              "whose values are valid temporal relations (BEFORE, AFTER, INCLUDES, etc.)")
+    parser.add_argument("--character", action="store_const", const=CharacterScores, dest="scores_type",
+                        help="Count characters instead of annotations, so that partial span matches get partial " +
+                             "credit: reference and predicted counts are the characters covered by reference and " +
+                             "predicted annotations, and correct counts are the characters covered by both a " +
+                             "reference and a predicted annotation of the same type (and properties).")
+    parser.add_argument("--iou-thresholds", metavar="T", nargs="+", type=float,
+                        help="Print a table of scores for each of these thresholds (between 0 and 1) on the " +
+                             "intersection-over-union of the characters of matched reference and predicted spans, " +
+                             "all calculated in a single pass. Annotations must have the same type (and properties) " +
+                             "to match, and each annotation is matched at most once.")
+    parser.add_argument("--confusion", action="store_true",
+                        help="Instead of the usual scores, align reference and predicted annotations by span and " +
+                             "type, and print for each type:property a confusion matrix of the reference and " +
+                             "predicted property values. Requires a single --predicted directory.")
+    parser.add_argument("--temporal-closure-cache", metavar="DIR",
+                        help="A directory where the temporal closures of the reference annotations should be saved, " +
+                             "so that they can be reused when evaluating other systems against the same reference " +
+                             "annotations. Only used with --temporal-closure.")
+    parser.add_argument("--cache", metavar="DIR", dest="cache_dir",
+                        help="A directory where the scores of each document are saved, so that when evaluating " +
+                             "again, only documents whose reference or predicted files (or evaluation settings) " +
+                             "have changed are re-scored. Cannot be combined with --verbose.")
+    parser.add_argument("--shard", metavar="I/N", type=parse_shard,
+                        help="Only evaluate the documents in the I-th of N shards (counting from 0), where documents " +
+                             "are assigned to shards by a hash of their directory names. Typically combined with " +
+                             "--partial-results, so that the shards can be evaluated on different machines.")
+    parser.add_argument("--partial-results", metavar="FILE",
+                        help="Instead of printing the scores, write the scores of each document to a file, which can " +
+                             "later be combined with the partial results of other shards using --merge.")
+    parser.add_argument("--merge", metavar="FILE", nargs="+",
+                        help="Instead of evaluating, combine partial results files (see --partial-results) and print " +
+                             "the scores as if all shards had been evaluated at once.")
+    parser.add_argument("--bootstrap", metavar="N", type=int,
+                        help="Instead of the usual scores, print 95%% confidence intervals for precision, recall and " +
+                             "F1 estimated from N bootstrap samples of the documents, and (if several --predicted " +
+                             "directories are given) the p-values of the differences between each pair of systems.")
+    parser.add_argument("--seed", metavar="INT", type=int,
+                        help="The seed for the random number generator used by --bootstrap and --sample.")
+    parser.add_argument("--sample", metavar="N", type=int, dest="sample_size",
+                        help="For a quick estimate, score only a random sample of N of the reference documents " +
+                             "(the same documents for the same --seed, 0 by default), and print the scores with " +
+                             "--bootstrap confidence intervals (from 1000 bootstrap samples by default).")
+    parser.add_argument("--sample-fraction", metavar="F", type=float,
+                        help="Like --sample, but score a random fraction F (between 0 and 1) of the reference " +
+                             "documents.")
+    parser.add_argument("--macro", action="store_true",
+                        help="Print precision, recall and F1 averaged over documents (macro-averaged), rather than " +
+                             "calculated from the counts of all documents together (micro-averaged)")
+    parser.add_argument("--agreement", action="store_true",
+                        help="When evaluating inter-annotator agreement (i.e., without --predicted), pool all " +
+                             "annotators of each document and print Fleiss's kappa, Krippendorff's alpha and the " +
+                             "distribution of votes (annotators who made an annotation / annotators of the " +
+                             "document), instead of comparing each pair of annotators.")
+    parser.add_argument("--processes", metavar="N", type=int,
+                        help="When evaluating inter-annotator agreement (i.e., without --predicted), score the " +
+                             "documents in N worker processes.")
+    parser.add_argument("--profile-phases", action="store_true",
+                        help="Record the wall-clock and CPU time spent in each phase of the evaluation (XML parsing, " +
+                             "view discovery, key construction, set intersection, etc.) and print a table of the " +
+                             "totals to standard error. Requires --predicted.")
+    parser.add_argument("--profile-phases-json", metavar="FILE",
+                        help="Write the times recorded by --profile-phases, both overall and for each document, to " +
+                             "a JSON file.")
     parser.add_argument("--per-document", action="store_true",
                         help="Print out scores for each document, rather than overall scores")
     parser.add_argument("--verbose", action="store_const", const=DebuggingScores, dest="scores_type",
                         help="Include more information in the output, such as the reference expressions that were " +
                              "and the predicted expressions that were not in the reference.")
+    parser.add_argument("--errors", metavar="FILE", dest="errors_path",
+                        help="Write the errors (the reference annotations that were not predicted and the predicted " +
+                             "annotations that were not in the reference) to a file as they are found. Unlike " +
+                             "--verbose, errors are not kept in memory or logged. Requires --predicted.")
+    parser.add_argument("--errors-format", choices=["jsonl", "tsv"], default="jsonl",
+                        help="The format of the --errors file (default: %(default)s)")
+    parser.add_argument("--first-errors-per-view", metavar="K", type=int,
+                        help="Write only the first K errors found for each system and view (in the order in which " +
+                             "documents are scored) to the --errors file. Further errors are counted, and their " +
+                             "number is logged at the end.")
     parser.add_argument("--overlap", dest="spans_type", action="store_const", const=_OverlappingSpans,
                         help="Count predicted annotation spans as correct if they overlap by one character or more " +
                              "with a reference annotation span. Not intended as a real evaluation method (since what " +
                              "to do with multiple matches is not well defined) but useful for debugging purposes.")
+    parser.add_argument("--align-arguments", action="store_true",
+                        help="Before scoring relations, align each predicted entity to the overlapping reference " +
+                             "entity of the same type (one-to-one, by the IoU of their spans), and replace the " +
+                             "arguments of the predicted relations by the aligned reference entities. Relations are " +
+                             "then not penalized for slightly misaligned arguments. Requires --predicted.")
     args = parser.parse_args()
+    if args.merge is None and args.reference_dir is None:
+        parser.error("--reference is required unless --merge is given")
+    if args.temporal_closure_cache is not None and args.scores_type is not TemporalClosureScores:
+        parser.error("--temporal-closure-cache requires --temporal-closure")
+
+    # the reference closures are shared by all the systems being evaluated, so they are cached in memory (and on disk,
+    # if requested)
+    if args.scores_type is TemporalClosureScores:
+        args.scores_type = functools.partial(TemporalClosureScores, closure_cache=TemporalClosureCache(
+            cache_dir=args.temporal_closure_cache, max_size=1000))
+    if args.cache_dir is not None:
+        if args.predicted_dirs is None:
+            parser.error("--cache requires --predicted")
+        if args.scores_type == DebuggingScores:
+            parser.error("--cache cannot be combined with --verbose")
+    if args.scores_type is CharacterScores and args.spans_type is not None:
+        parser.error("--character cannot be combined with --overlap")
+    if args.confusion and args.spans_type is not None:
+        parser.error("--confusion cannot be combined with --overlap")
+    if args.iou_thresholds is not None:
+        if not all(0.0 <= threshold <= 1.0 for threshold in args.iou_thresholds):
+            parser.error("--iou-thresholds must be between 0 and 1")
+        if args.scores_type is not Scores or args.spans_type is not None:
+            parser.error("--iou-thresholds cannot be combined with other scoring modes")
+        if args.predicted_dirs is not None and len(args.predicted_dirs) > 1:
+            parser.error("--iou-thresholds requires a single --predicted directory")
+        if args.per_document or args.macro or args.bootstrap is not None or args.partial_results is not None or \
+                args.cache_dir is not None:
+            parser.error("--iou-thresholds cannot be combined with --per-document, --macro, --bootstrap, " +
+                         "--partial-results or --cache")
+        args.scores_type = functools.partial(SpanIoUScores, thresholds=args.iou_thresholds)
+    if args.errors_path is not None:
+        if args.predicted_dirs is None:
+            parser.error("--errors requires --predicted")
+        if args.iou_thresholds is not None:
+            parser.error("--errors cannot be combined with --iou-thresholds")
+        if args.scores_type is CharacterScores:
+            parser.error("--errors cannot be combined with --character")
+        if args.scores_type not in (Scores, DebuggingScores):
+            parser.error("--errors cannot be combined with --temporal-closure")
+        if args.cache_dir is not None:
+            parser.error("--errors cannot be combined with --cache")
+    if args.sample_size is not None or args.sample_fraction is not None:
+        if args.sample_size is not None and args.sample_fraction is not None:
+            parser.error("--sample cannot be combined with --sample-fraction")
+        if args.sample_size is not None and args.sample_size < 1:
+            parser.error("--sample must be at least 1")
+        if args.sample_fraction is not None and not 0.0 < args.sample_fraction <= 1.0:
+            parser.error("--sample-fraction must be between 0 and 1")
+        if args.predicted_dirs is None:
+            parser.error("--sample requires --predicted")
+        if args.merge is not None or os.path.isfile(args.reference_dir) or args.reference_format != "anafora":
+            parser.error("--sample requires a --reference directory")
+        if args.confusion or args.iou_thresholds is not None or args.per_document or args.macro or \
+                args.partial_results is not None:
+            parser.error("--sample cannot be combined with --confusion, --iou-thresholds, --per-document, --macro " +
+                         "or --partial-results")
+        if args.bootstrap is None:
+            args.bootstrap = 1000
+    if args.reference_format != "anafora" or args.predicted_format != "anafora":
+        if args.predicted_dirs is None:
+            parser.error("--reference-format and --predicted-format require --predicted")
+        if args.merge is not None or args.compile_answer_key is not None or args.confusion:
+            parser.error("--reference-format and --predicted-format cannot be combined with --merge, " +
+                         "--compile-answer-key or --confusion")
+    if args.align_arguments:
+        if args.predicted_dirs is None:
+            parser.error("--align-arguments requires --predicted")
+        if args.confusion:
+            parser.error("--align-arguments cannot be combined with --confusion")
+    if args.profile_phases_json is not None:
+        args.profile_phases = True
+    if args.profile_phases and args.predicted_dirs is None:
+        parser.error("--profile-phases requires --predicted")
     basic_config_kwargs = {"format": "%(levelname)s:%(message)s"}
     if args.scores_type == DebuggingScores:
         basic_config_kwargs["level"] = logging.DEBUG
     logging.basicConfig(**basic_config_kwargs)
 
-    if args.predicted_dir is not None:
-        _file_named_scores = score_dirs(
+    # errors are written to a file as they are found (instead of being logged)
+    _error_report = None
+    if args.errors_path is not None:
+        _errors_file = open(args.errors_path, "w")
+        _error_report = ErrorReport(_errors_file, args.errors_format, args.first_errors_per_view)
+        args.scores_type = DebuggingScores
+
+    # the time spent in each phase of the evaluation is only recorded if requested
+    _profile = PhaseProfile() if args.profile_phases else None
+
+    # the schema restricts which property values are evaluated
+    _schema = None
+    if args.schema is not None:
+        import anafora.validate
+        _schema = anafora.validate.Schema.from_file(args.schema)
+
+    # settings that must be the same for all partial results that are merged
+    _partial_results_settings = {
+        "include": _normalize_select_items(args.include),
+        "exclude": _normalize_select_items(args.exclude),
+        "xml_name_regex": args.xml_name_regex,
+        "spans_type": getattr(args.spans_type, "__name__", args.spans_type),
+        "views": _ViewFilter(_schema, args.views).settings(),
+    }
+    if args.align_arguments:
+        _partial_results_settings["align_arguments"] = True
+
+    # a quick estimate may be made from a random sample of the reference documents
+    _sample = None
+    if args.sample_size is not None or args.sample_fraction is not None:
+        _sample = sample_documents(args.reference_dir, args.xml_name_regex, size=args.sample_size,
+                                   fraction=args.sample_fraction, seed=0 if args.seed is None else args.seed)
+
+    # micro-averaged scores can be counted directly from the annotation sets, without Scores for each document
+    _corpus_scores_type = None
+    if (args.partial_results is None and args.bootstrap is None and args.iou_thresholds is None and
+            not args.per_document and not args.macro and args.predicted_dirs is not None):
+        _scores = args.scores_type()
+        if hasattr(_scores, "_count_names") and not hasattr(_scores, "errors"):
+            _corpus_scores_type = args.scores_type
+
+    if args.merge is not None:
+        _scores_type, _file_system_named_scores = merge_partial_results(args.merge)
+
+        # partial results from a single predicted directory (or from annotator agreement) have no system names
+        if args.bootstrap is not None:
+            _print_bootstrap_scores(*bootstrap_scores(
+                _file_system_named_scores, n_samples=args.bootstrap, seed=args.seed))
+        elif all(list(system_named_scores) == [None] for _, system_named_scores in _file_system_named_scores):
+            _file_named_scores = [(file_name, system_named_scores[None])
+                                  for file_name, system_named_scores in _file_system_named_scores]
+            if args.per_document:
+                _print_document_scores(_file_named_scores)
+            else:
+                _print_merged_scores(_file_named_scores, scores_type=_scores_type, macro=args.macro)
+        else:
+            if args.per_document:
+                _print_document_system_scores(_file_system_named_scores)
+            else:
+                _print_merged_system_scores(_file_system_named_scores, scores_type=_scores_type, macro=args.macro)
+
+    elif args.compile_answer_key is not None:
+        compile_answer_key(
             reference_dir=args.reference_dir,
-            predicted_dir=args.predicted_dir,
+            answer_key_path=args.compile_answer_key,
+            xml_name_regex=args.xml_name_regex,
+            include=args.include,
+            exclude=args.exclude)
+
+    elif args.confusion:
+        if args.predicted_dirs is None or len(args.predicted_dirs) > 1:
+            parser.error("--confusion requires a single --predicted directory")
+        _print_confusion_matrices(confusion_dirs(
+            reference_dir=args.reference_dir,
+            predicted_dir=args.predicted_dirs[0],
             xml_name_regex=args.xml_name_regex,
-            text_dir=args.text_dir,
             include=args.include,
             exclude=args.exclude,
-            scores_type=args.scores_type,
-            spans_type=args.spans_type)
-    else:
-        _file_named_scores = score_annotators(
+            spans_type=args.spans_type,
+            shard=args.shard,
+            sample=_sample,
+            reference_format=args.reference_format,
+            predicted_format=args.predicted_format))
+
+    elif args.agreement:
+        if args.predicted_dirs is not None:
+            parser.error("--agreement cannot be combined with --predicted")
+        _print_agreement(score_agreement(
             anafora_dir=args.reference_dir,
             xml_name_regex=args.xml_name_regex,
             include=args.include,
             exclude=args.exclude,
+            spans_type=args.spans_type,
+            shard=args.shard,
+            schema=_schema,
+            views=args.views), per_document=args.per_document)
+
+    elif args.predicted_dirs is not None and len(args.predicted_dirs) > 1:
+        _system_corpus_scores = None
+        if _corpus_scores_type is not None:
+            _system_corpus_scores = collections.OrderedDict(
+                (predicted_dir, CorpusScores(_corpus_scores_type, keep_documents=False))
+                for predicted_dir in args.predicted_dirs)
+        _file_system_named_scores = score_systems(
+            reference_dir=args.reference_dir,
+            predicted_dirs=args.predicted_dirs,
+            xml_name_regex=args.xml_name_regex,
+            text_dir=args.text_dir,
+            include=args.include,
+            exclude=args.exclude,
             scores_type=args.scores_type,
-            spans_type=args.spans_type)
+            spans_type=args.spans_type,
+            cache_dir=args.cache_dir,
+            shard=args.shard,
+            error_report=_error_report,
+            schema=_schema,
+            views=args.views,
+            profile=_profile,
+            align_arguments=args.align_arguments,
+            sample=_sample,
+            reference_format=args.reference_format,
+            predicted_format=args.predicted_format,
+            corpus_scores=_system_corpus_scores)
+
+        if _system_corpus_scores is not None:
+            for _ in _file_system_named_scores:
+                pass
+            _print_system_corpus_scores(_system_corpus_scores)
+        elif args.partial_results is not None:
+            write_partial_results(args.partial_results, _file_system_named_scores, scores_type=args.scores_type,
+                                  shard=args.shard, settings=_partial_results_settings)
+        elif args.bootstrap is not None:
+            _print_bootstrap_scores(*bootstrap_scores(
+                _file_system_named_scores, n_samples=args.bootstrap, seed=args.seed))
+        elif args.per_document:
+            _print_document_system_scores(_file_system_named_scores)
+        else:
+            _print_merged_system_scores(_file_system_named_scores, scores_type=args.scores_type, macro=args.macro)
 
-    if args.per_document:
-        _print_document_scores(_file_named_scores)
     else:
-        _print_merged_scores(_file_named_scores, scores_type=args.scores_type)
+        _corpus_scores = None
+        if _corpus_scores_type is not None:
+            _corpus_scores = CorpusScores(_corpus_scores_type, keep_documents=False)
+        if args.predicted_dirs is not None:
+            _file_named_scores = score_dirs(
+                reference_dir=args.reference_dir,
+                predicted_dir=args.predicted_dirs[0],
+                xml_name_regex=args.xml_name_regex,
+                text_dir=args.text_dir,
+                include=args.include,
+                exclude=args.exclude,
+                scores_type=args.scores_type,
+                spans_type=args.spans_type,
+                cache_dir=args.cache_dir,
+                shard=args.shard,
+                error_report=_error_report,
+                schema=_schema,
+                views=args.views,
+                profile=_profile,
+                align_arguments=args.align_arguments,
+                sample=_sample,
+                reference_format=args.reference_format,
+                predicted_format=args.predicted_format,
+                corpus_scores=_corpus_scores)
+        else:
+            _file_named_scores = score_annotators(
+                anafora_dir=args.reference_dir,
+                xml_name_regex=args.xml_name_regex,
+                include=args.include,
+                exclude=args.exclude,
+                scores_type=args.scores_type,
+                spans_type=args.spans_type,
+                shard=args.shard,
+                schema=_schema,
+                views=args.views,
+                processes=args.processes)
+
+        if _corpus_scores is not None:
+            for _ in _file_named_scores:
+                pass
+            _print_corpus_scores(_corpus_scores)
+        elif args.partial_results is not None:
+            write_partial_results(args.partial_results,
+                                  ((file_name, {None: named_scores}) for file_name, named_scores in _file_named_scores),
+                                  scores_type=args.scores_type, shard=args.shard, settings=_partial_results_settings)
+        elif args.bootstrap is not None:
+            _print_bootstrap_scores(*bootstrap_scores(
+                ((file_name, {None: named_scores}) for file_name, named_scores in _file_named_scores),
+                n_samples=args.bootstrap, seed=args.seed))
+        elif args.iou_thresholds is not None:
+            _print_iou_scores(_file_named_scores, args.iou_thresholds)
+        elif args.per_document:
+            _print_document_scores(_file_named_scores)
+        else:
+            _print_merged_scores(_file_named_scores, scores_type=args.scores_type, macro=args.macro)
+
+    if _error_report is not None:
+        _error_report.close()
+        _errors_file.close()
+
+    if _profile is not None:
+        _profile.print_table()
+        if args.profile_phases_json is not None:
+            with open(args.profile_phases_json, "w") as _profile_file:
+                json.dump(_profile.to_json(), _profile_file, indent=2)
@@ -5,7 +5,7 @@ import json
 import logging
 import os
 import re
-from typing import Any, Text, Mapping
+from typing import Any, Iterator, Text, Mapping
 import xml.etree.cElementTree as ET
 
 
@@ -337,6 +337,172 @@ def anafora_annotations_to_labelstudio_annotations(
     }
 
 
+def iter_labelstudio_tasks(
+        labelstudio_path: Text,
+        chunk_size: int = 1 << 20) -> Iterator[Mapping[Text, Any]]:
+    # a Label Studio export is a JSON list of tasks, which is decoded one
+    # task at a time so that a large export is never entirely in memory
+    decoder = json.JSONDecoder()
+    whitespace = re.compile(r"\s*")
+    with open(labelstudio_path, encoding="utf-8") as labelstudio_file:
+        buffer = ""
+        index = 0
+
+        # finds the next non-whitespace character, reading more if needed
+        def peek():
+            nonlocal buffer, index
+            while True:
+                index = whitespace.match(buffer, index).end()
+                if index < len(buffer):
+                    return buffer[index]
+                more = labelstudio_file.read(chunk_size)
+                if not more:
+                    return ""
+                buffer = buffer[index:] + more
+                index = 0
+
+        if peek() != "[":
+            raise ValueError(f"expected a JSON list of tasks in "
+                             f"{labelstudio_path}")
+        index += 1
+        if peek() == "]":
+            return
+        while True:
+
+            # decode the next task, reading more until it is complete
+            while True:
+                try:
+                    task, index = decoder.raw_decode(buffer, index)
+                    break
+                except json.JSONDecodeError:
+                    more = labelstudio_file.read(
+                        max(chunk_size, len(buffer) - index))
+                    if not more:
+                        raise
+                    buffer = buffer[index:] + more
+                    index = 0
+            yield task
+
+            # tasks are separated by commas, and the list ends with "]"
+            delimiter = peek()
+            index += 1
+            if delimiter == "]":
+                return
+            if delimiter != ",":
+                raise ValueError(f"expected ',' or ']' after a task in "
+                                 f"{labelstudio_path}, found "
+                                 f"{delimiter or 'the end of the file'!r}")
+            peek()
+
+
+def labelstudio_annotations_to_anafora_records(
+        labelstudio_task: Mapping[Text, Any],
+        results_key: Text = "annotations") -> tuple[Text, list]:
+    # the document is named by its source (as written by
+    # anafora_annotations_to_labelstudio_annotations), or else its task id
+    ls_data = labelstudio_task.get("data") or {}
+    source = (ls_data.get("meta_info") or {}).get("source")
+    if source is None:
+        source = str(labelstudio_task.get("id"))
+
+    # use the results of the first annotation that was not cancelled
+    ls_results = []
+    for ls_annotation in labelstudio_task.get(results_key) or []:
+        if not ls_annotation.get("was_cancelled"):
+            ls_results = ls_annotation.get("result") or []
+            break
+
+    # each span of an entity is a separate region, where the regions of
+    # all but the first span have ids of the form "{id}-{i}"
+    ls_regions = {ls_result["id"]: ls_result for ls_result in ls_results
+                  if ls_result.get("type") == "labels"}
+    region_ids = {}
+    entities = {}
+    for ls_id, ls_result in ls_regions.items():
+        an_id, _, suffix = ls_id.rpartition("-")
+        if not (suffix.isdigit() and an_id in ls_regions):
+            an_id = ls_id
+        region_ids[ls_id] = an_id
+    for ls_id, an_id in region_ids.items():
+        ls_value = ls_regions[ls_id]["value"]
+        if an_id not in entities:
+            an_type = ls_regions[an_id]["value"]["labels"][0]
+            entities[an_id] = ([], an_type, {})
+        entities[an_id][0].append((ls_value["start"], ls_value["end"]))
+    for an_spans, _, _ in entities.values():
+        an_spans.sort()
+
+    ls_value_keys = {"textarea": "text", "choices": "choices"}
+    relations = []
+    previous_relation_key = None
+    for ls_result in ls_results:
+        ls_type = ls_result.get("type")
+
+        # properties of an entity are results on the same region
+        if ls_type in ls_value_keys:
+            if ls_result.get("id") not in region_ids:
+                logging.warning(f"{source}: skipping {ls_type} result for "
+                                f"unknown region {ls_result.get('id')}")
+                continue
+            _, an_type, an_properties = entities[region_ids[ls_result["id"]]]
+            an_prop_name = ls_result["from_name"]
+            if an_prop_name.startswith(f"{an_type}-"):
+                an_prop_name = an_prop_name[len(an_type) + 1:]
+            ls_values = ls_result["value"].get(ls_value_keys[ls_type]) or []
+            an_properties[an_prop_name] = ",".join(ls_values)
+
+        elif ls_type == "relation":
+            from_id = region_ids.get(ls_result.get("from_id"))
+            to_id = region_ids.get(ls_result.get("to_id"))
+            labels = ls_result.get("labels") or []
+            if from_id is None or to_id is None or len(labels) != 1:
+                logging.warning(f"{source}: skipping relation from "
+                                f"{ls_result.get('from_id')} to "
+                                f"{ls_result.get('to_id')} with labels "
+                                f"{labels}")
+                continue
+
+            # a label with no colons is an entity property that refers to
+            # another entity
+            parts = labels[0].split(":")
+            if len(parts) == 1:
+                entities[from_id][2][labels[0]] = entities[to_id]
+                continue
+            if len(parts) == 2:
+                logging.warning(f"{source}: skipping relation with "
+                                f"unexpected label {labels[0]}")
+                continue
+
+            # other labels are "{type}[:{name}={value}...]:{source}:{target}"
+            # with one result per argument after the source, so consecutive
+            # results with the same source are arguments of the same relation
+            an_type, *ls_choices, source_name, target_name = parts
+            relation_key = from_id, tuple(parts[:-1])
+            if relation_key == previous_relation_key and \
+                    target_name not in relations[-1][2]:
+                relations[-1][2][target_name] = entities[to_id]
+                continue
+            an_properties = {}
+            for ls_choice in ls_choices:
+                an_prop_name, _, an_prop_value = ls_choice.partition("=")
+                an_properties[an_prop_name] = an_prop_value
+            an_properties[source_name] = entities[from_id]
+            an_properties[target_name] = entities[to_id]
+            relations.append((None, an_type, an_properties))
+            previous_relation_key = relation_key
+
+    return source, list(entities.values()) + relations
+
+
+def labelstudio_to_anafora_records(
+        labelstudio_path: Text,
+        results_key: Text = "annotations") -> Iterator[tuple[Text, list]]:
+    for labelstudio_task in iter_labelstudio_tasks(labelstudio_path):
+        yield labelstudio_annotations_to_anafora_records(
+            labelstudio_task=labelstudio_task,
+            results_key=results_key)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="""%(prog)s converts Anafora schema XML and Anafora
@@ -0,0 +1,464 @@
+import argparse
+import collections
+import http.server
+import io
+import json
+import logging
+import multiprocessing
+import os
+import re
+import socketserver
+import tarfile
+import threading
+import urllib.parse
+import zipfile
+
+import anafora
+import anafora.evaluate
+import anafora.select
+
+
+class ReferenceCorpus(object):
+    def __init__(self, reference_dir, xml_name_regex="[.]xml$", include=None, exclude=None, spans_type=None,
+                 schema=None, views=None):
+        """
+        A reference corpus that is loaded (and the annotation sets of each of its documents calculated) only once,
+        against which any number of predictions can then be scored.
+
+        :param string reference_dir: directory containing reference ("gold standard") Anafora XML directories, or an
+            answer key file written by anafora.evaluate.compile_answer_key
+        :param xml_name_regex: regular expression matching the files to be compared
+        :param set include: types of annotations to include (others will be excluded); may be type names,
+            (type-name, property-name) tuples, (type-name, property-name, property-value) tuples
+        :param set exclude: types of annotations to exclude; may be type names, (type-name, property-name) tuples,
+            (type-name, property-name, property-value) tuples
+        :param type spans_type: wrapper object to apply to annotation spans
+        :param Schema schema: the Anafora schema (see anafora.validate.Schema) of the annotations; if given,
+            (type, property, value) views are only scored for properties whose values are chosen from a fixed list
+        :param list views: the names of the only views to be scored, e.g., (annotation type[, property name[,
+            property value]]); if None, all views found in the annotations are scored
+        """
+        self.xml_name_regex = xml_name_regex
+        self.spans_type = spans_type
+        self.select = anafora.select.Select(include, exclude)
+        self.view_filter = None if schema is None and views is None else anafora.evaluate._ViewFilter(schema, views)
+
+        # the reference may be an answer key file (see compile_answer_key) instead of a directory
+        if os.path.isfile(reference_dir):
+            if spans_type is not None:
+                raise ValueError("spans_type is not supported with answer key {0}".format(reference_dir))
+            references = anafora.evaluate._iter_answer_key_documents(
+                reference_dir, include, exclude, self.view_filter)
+        else:
+            references = anafora.evaluate._iter_references(
+                reference_dir, xml_name_regex, self.select, spans_type, self.view_filter)
+
+        # load all the reference documents, indexed both by sub-dir (for directories of predictions, which have
+        # the same layout as the reference) and by text name (for archives and JSON lines, which may not)
+        self.sub_dir_sets = collections.OrderedDict()
+        self.text_name_sub_dirs = {}
+        for sub_dir, text_name, reference in references:
+            reference_sets = reference.sets()
+            if reference_sets is not None:
+                self.sub_dir_sets[sub_dir, text_name] = reference_sets
+                if text_name in self.text_name_sub_dirs:
+                    logging.warn("%s: several reference documents with the same name", text_name)
+                else:
+                    self.text_name_sub_dirs[text_name] = sub_dir
+
+    def __len__(self):
+        return len(self.sub_dir_sets)
+
+    def _score(self, get_predicted_data, unmatched, per_document):
+        """
+        :param function get_predicted_data: returns the AnaforaData predicted for a (sub-dir, text-name), or None
+        :param list unmatched: the names of the predictions that match no reference document
+        :param bool per_document: include the scores of each document in the result
+        :return dict: a JSON-serializable result, with the merged scores of all the reference documents
+        """
+        corpus_scores = anafora.evaluate.CorpusScores(keep_documents=False)
+        document_scores = collections.OrderedDict()
+        for (sub_dir, text_name), reference_sets in self.sub_dir_sets.items():
+            predicted_data = get_predicted_data(sub_dir, text_name)
+            predicted_sets = anafora.evaluate._AnnotationSets(
+                [] if predicted_data is None else predicted_data.annotations,
+                self.select, self.spans_type, self.view_filter)
+
+            # predicted keys must not be added to the reference interner, or it would grow with every request
+            predicted_interner = anafora.evaluate._KeyLookup(reference_sets.interner)
+
+            # Scores objects are only needed for the per-document scores; otherwise, just count
+            if per_document:
+                named_scores = anafora.evaluate._score_sets(
+                    reference_sets, predicted_sets, predicted_interner=predicted_interner)
+                corpus_scores.update(text_name, named_scores)
+                document_scores[text_name] = _scores_to_json(named_scores)
+            else:
+                corpus_scores.add_sets(text_name, reference_sets, predicted_sets, predicted_interner=predicted_interner)
+        result = collections.OrderedDict()
+        result["documents"] = len(self.sub_dir_sets)
+        result["scores"] = _scores_to_json(corpus_scores.micro())
+        result["unmatched"] = sorted(unmatched)
+        if per_document:
+            result["per_document"] = document_scores
+        return result
+
+    def score_dir(self, predicted_dir, per_document=False):
+        """
+        :param string predicted_dir: directory containing predicted (system-generated) Anafora XML directories,
+            in the same layout as the reference directories
+        :param bool per_document: include the scores of each document in the result
+        :return dict: a JSON-serializable result, with the merged scores of all the reference documents
+        """
+        if not os.path.isdir(predicted_dir):
+            raise ValueError("{0} is not a directory".format(predicted_dir))
+        predicted_index = anafora.evaluate._PredictedIndex(predicted_dir, self.xml_name_regex)
+
+        def get_predicted_data(sub_dir, text_name):
+            paths = predicted_index.paths(sub_dir, text_name)
+            if len(paths) != 1:
+                logging.warn("expected one predicted file for %s, found %s", text_name, paths)
+            return _check_predicted(anafora.evaluate._load(paths[0]), paths[0]) if paths else None
+
+        result = self._score(get_predicted_data, [], per_document)
+        result["unmatched"] = sorted(predicted_index.unmatched_paths())
+        return result
+
+    def score_archive(self, archive_bytes, per_document=False):
+        """
+        :param bytes archive_bytes: the contents of a zip or tar (optionally compressed) archive of predicted
+            Anafora XML directories; files are matched to reference documents by the name of their directory
+        :param bool per_document: include the scores of each document in the result
+        :return dict: a JSON-serializable result, with the merged scores of all the reference documents
+        """
+
+        # read the XML files straight from the archive, so that nothing is ever extracted to disk
+        text_name_xml = collections.defaultdict(list)
+        archive_file = io.BytesIO(archive_bytes)
+        if zipfile.is_zipfile(archive_file):
+            with zipfile.ZipFile(archive_file) as archive:
+                for name in sorted(archive.namelist()):
+                    if self._is_predicted_name(name):
+                        text_name_xml[_text_name(name)].append((name, archive.read(name)))
+        else:
+            archive_file.seek(0)
+            try:
+                archive = tarfile.open(fileobj=archive_file, mode="r:*")
+            except tarfile.TarError:
+                raise ValueError("expected a zip or tar archive")
+            with archive:
+                for member in sorted(archive.getmembers(), key=lambda member: member.name):
+                    if member.isfile() and self._is_predicted_name(member.name):
+                        xml_bytes = archive.extractfile(member).read()
+                        text_name_xml[_text_name(member.name)].append((member.name, xml_bytes))
+        return self._score_named_xml(text_name_xml, per_document)
+
+    def score_jsonl(self, lines, per_document=False):
+        """
+        :param iterable lines: JSON lines, one per predicted document, each an object with a "text_name" and either
+            an "xml" string of Anafora XML or a list of "annotations", each a [spans, type, properties] record (see
+            anafora.evaluate._from_records) where spans is null for a relation, and a property value of the form
+            {"annotation": i} refers to the i-th annotation in the list
+        :param bool per_document: include the scores of each document in the result
+        :return dict: a JSON-serializable result, with the merged scores of all the reference documents
+        """
+        text_name_data = {}
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                document = json.loads(line)
+                text_name = document["text_name"]
+                if "xml" in document:
+                    data = _check_predicted(_parse_xml(document["xml"], text_name), text_name)
+                else:
+                    data = _records_data(document["annotations"])
+            except (KeyError, IndexError, TypeError, ValueError) as e:
+                raise ValueError("invalid JSON line {0!r}: {1}".format(line[:100], e))
+            if text_name in text_name_data:
+                logging.warn("%s: ignoring duplicate predicted document", text_name)
+            else:
+                text_name_data[text_name] = data
+
+        def get_predicted_data(_, text_name):
+            return text_name_data.get(text_name)
+
+        unmatched = [text_name for text_name in text_name_data if text_name not in self.text_name_sub_dirs]
+        return self._score(get_predicted_data, unmatched, per_document)
+
+    def _is_predicted_name(self, name):
+        return name.endswith(".xml") and re.search(self.xml_name_regex, name) is not None
+
+    def _score_named_xml(self, text_name_xml, per_document):
+        def get_predicted_data(_, text_name):
+            named_xml = text_name_xml.get(text_name, [])
+            if len(named_xml) != 1:
+                logging.warn("expected one predicted file for %s, found %s", text_name, [n for n, _ in named_xml])
+            if not named_xml:
+                return None
+            name, xml_bytes = named_xml[0]
+            return _check_predicted(_parse_xml(xml_bytes, name), name)
+
+        unmatched = [name for text_name, named_xml in text_name_xml.items()
+                     if text_name not in self.text_name_sub_dirs for name, _ in named_xml]
+        return self._score(get_predicted_data, unmatched, per_document)
+
+
+def _records_data(items):
+    """
+    :param list items: [spans, type, properties] records, where a property value {"annotation": i} refers to the
+        i-th record
+    :return anafora.evaluate._RecordsData: an object whose annotations are the annotations of the records
+    """
+    records = [(spans, type_name, dict(properties or {})) for spans, type_name, properties in items]
+    for _, _, properties in records:
+        for name, value in properties.items():
+            if isinstance(value, dict):
+                index = value["annotation"]
+                if not isinstance(index, int) or not 0 <= index < len(records):
+                    raise ValueError("no annotation {0!r} among {1} annotations".format(index, len(records)))
+                properties[name] = records[index]
+    data = anafora.evaluate._RecordsData(anafora.evaluate._from_records(records))
+
+    # annotations that refer to themselves cannot be scored (their keys would be infinitely nested)
+    if anafora.evaluate._find_self_referential(data) is not None:
+        raise ValueError("self-referential annotation among {0} annotations".format(len(records)))
+    return data
+
+
+def _text_name(name):
+    # as in anafora.walk, the text name is the name of the directory containing the XML
+    return name.rstrip("/").split("/")[-2] if "/" in name.rstrip("/") else ""
+
+
+def _parse_xml(xml, name):
+    try:
+        return anafora.AnaforaData(anafora.ElementTree.fromstring(xml))
+    except anafora.ElementTree.ParseError:
+        logging.warn("%s: ignoring invalid XML", name)
+        return None
+
+
+def _check_predicted(data, name):
+    # check for self-references in the annotations, which cause equality and hashing to fail
+    if data is not None:
+        self_reference = data.annotations.find_self_referential()
+        if self_reference is not None:
+            logging.warn("skipping predicted file %s with self-referential annotation %s", name, self_reference.id)
+            return None
+    return data
+
+
+def _scores_to_json(named_scores):
+    return [collections.OrderedDict([
+        ("view", anafora.evaluate._score_name(name)),
+        ("reference", scores.reference),
+        ("predicted", scores.predicted),
+        ("correct", scores.correct),
+        ("precision", scores.precision()),
+        ("recall", scores.recall()),
+        ("f1", scores.f1()),
+    ]) for name, scores in sorted(named_scores.items(), key=lambda item: anafora.evaluate._score_name(item[0]))]
+
+
+# the reference corpus of a worker process (see _init_worker)
+_worker_corpus = None
+
+
+def _init_worker(corpus_kwargs):
+    global _worker_corpus
+    _worker_corpus = ReferenceCorpus(**corpus_kwargs)
+
+
+def _call_worker(method_name, args):
+    return getattr(_worker_corpus, method_name)(*args)
+
+
+class EvaluationService(object):
+    def __init__(self, processes=None, **corpus_kwargs):
+        """
+        Scores requests against a reference corpus, either in the calling thread (one request at a time, since the
+        cached reference annotation sets are shared), or in a pool of worker processes that each load the
+        reference corpus once and then score requests in parallel.
+
+        :param int processes: the number of worker processes; if None, requests are scored in the calling thread
+        :param corpus_kwargs: the arguments to ReferenceCorpus
+        """
+        self._pool = None
+        self._corpus = None
+        self._lock = threading.Lock()
+        if processes is None:
+            self._corpus = ReferenceCorpus(**corpus_kwargs)
+            self.documents = len(self._corpus)
+        else:
+            self._pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(corpus_kwargs,))
+            self.documents = self._pool.apply(_call_worker, ("__len__", ()))
+
+    def __call__(self, method_name, *args):
+        """
+        :param string method_name: the ReferenceCorpus method to call, e.g., "score_dir"
+        :param args: the arguments to the method
+        :return: the result of the method
+        """
+        if self._pool is not None:
+            return self._pool.apply(_call_worker, (method_name, args))
+        with self._lock:
+            return getattr(self._corpus, method_name)(*args)
+
+    def close(self):
+        """
+        Stops the worker processes (if any).
+        """
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+
+class _RequestHandler(http.server.BaseHTTPRequestHandler):
+
+    # the EvaluationService that scores the requests, and the largest request body it accepts (both set on the
+    # handler class by make_server)
+    service = None
+    max_body_size = None
+
+    def address_string(self):
+        # Unix socket clients have no (host, port) address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+    def _send_json(self, status, result):
+        body = json.dumps(result).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urllib.parse.urlsplit(self.path).path == "/health":
+            self._send_json(200, {"documents": self.service.documents})
+        else:
+            self._send_json(404, {"error": "no such resource: {0}".format(self.path)})
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        per_document = query.get("per_document", ["0"])[-1].lower() in ("1", "true", "yes")
+        try:
+
+            # the whole body is read into memory (e.g., archives are read from memory), so its size is limited
+            content_length = int(self.headers.get("Content-Length", 0))
+            if content_length < 0:
+                raise ValueError("invalid Content-Length: {0}".format(content_length))
+            if self.max_body_size is not None and content_length > self.max_body_size:
+                self.close_connection = True
+                self._send_json(413, {"error": "request body of {0} bytes is larger than the limit of {1} bytes".format(
+                    content_length, self.max_body_size)})
+                return
+            body = self.rfile.read(content_length)
+            if url.path == "/score/directory":
+                result = self.service("score_dir", json.loads(body.decode("utf-8"))["path"], per_document)
+            elif url.path == "/score/archive":
+                result = self.service("score_archive", body, per_document)
+            elif url.path == "/score/jsonl":
+                result = self.service("score_jsonl", body.decode("utf-8").splitlines(), per_document)
+            else:
+                self._send_json(404, {"error": "no such resource: {0}".format(self.path)})
+                return
+        except (KeyError, TypeError, ValueError) as e:
+            self._send_json(400, {"error": str(e)})
+        else:
+            self._send_json(200, result)
+
+
+class _ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(service, host="127.0.0.1", port=8000, socket_path=None, max_body_size=1 << 30):
+    """
+    :param EvaluationService service: the service that scores the requests
+    :param string host: the host name or address on which to listen
+    :param int port: the port on which to listen (0 for any free port)
+    :param string socket_path: the path of a Unix socket on which to listen (instead of host and port)
+    :param int max_body_size: the largest request body (in bytes) that is accepted; larger requests are refused
+        with status 413; if None, there is no limit
+    :return socketserver.BaseServer: a server (not yet started) that handles each request in its own thread
+    """
+    handler_type = type("RequestHandler", (_RequestHandler,), {"service": service, "max_body_size": max_body_size})
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        return _ThreadingUnixHTTPServer(socket_path, handler_type)
+    return http.server.ThreadingHTTPServer((host, port), handler_type)
+
+
+if __name__ == "__main__":
+    def split_tuple_on_colons(string):
+        result = tuple(string.split(":"))
+        return result[0] if len(result) == 1 else result
+
+    parser = argparse.ArgumentParser(description="""%(prog)s loads a reference corpus of Anafora XML annotations
+        once, and then serves requests to score predicted annotations against it, returning precision, recall and
+        F-measure as JSON. Predictions may be POSTed as a directory path (/score/directory, with a JSON body
+        {"path": ...}), as a zip or tar archive (/score/archive), or as JSON lines (/score/jsonl). Add
+        ?per_document=1 to also return the scores of each document.""")
+    parser.add_argument("-r", "--reference", metavar="DIR", dest="reference_dir", required=True,
+                        help="The root of a set of Anafora XML directories representing reference annotations, or " +
+                             "an answer key file created with anafora.evaluate --compile-answer-key.")
+    parser.add_argument("-i", "--include", metavar="EXPR", nargs="+", type=split_tuple_on_colons,
+                        help="An expression identifying types of annotations to be included in the evaluation. " +
+                             "The expression takes the form type[:property[:value] (see anafora.evaluate).")
+    parser.add_argument("-e", "--exclude", metavar="EXPR", nargs="+", type=split_tuple_on_colons,
+                        help="An expression identifying types of annotations to be excluded from the evaluation. " +
+                             "The expression takes the form type[:property[:value] (see anafora.evaluate).")
+    parser.add_argument("--schema", metavar="FILE",
+                        help="An Anafora schema file for the annotations. Property values are only evaluated " +
+                             "separately (as type:property:value) for properties whose values are chosen from a " +
+                             "list in the schema.")
+    parser.add_argument("--views", metavar="EXPR", nargs="+", type=split_tuple_on_colons,
+                        help="The only views to evaluate, each of the form type[:property[:value]] or type:<span>.")
+    parser.add_argument("-x", "--xml-name-regex", metavar="REGEX", default="[.]xml$",
+                        help="A regular expression for matching XML files (default: %(default)r)")
+    parser.add_argument("--overlap", dest="spans_type", action="store_const",
+                        const=anafora.evaluate._OverlappingSpans,
+                        help="Count predicted annotation spans as correct if they overlap by one character or more " +
+                             "with a reference annotation span.")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="The address on which to listen (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=8000,
+                        help="The port on which to listen (default: %(default)s)")
+    parser.add_argument("--socket", metavar="PATH", dest="socket_path",
+                        help="Listen on a Unix socket at this path instead of on --host and --port.")
+    parser.add_argument("--processes", metavar="N", type=int,
+                        help="Score requests in N worker processes, each of which loads the reference corpus. By " +
+                             "default, requests are scored one at a time in the server process.")
+    parser.add_argument("--max-body-size", metavar="BYTES", type=int, default=1 << 30,
+                        help="Refuse requests whose bodies are larger than this (default: %(default)s).")
+    args = parser.parse_args()
+    logging.basicConfig(format="%(levelname)s:%(message)s")
+
+    # the schema restricts which property values are evaluated
+    _schema = None
+    if args.schema is not None:
+        import anafora.validate
+        _schema = anafora.validate.Schema.from_file(args.schema)
+
+    _service = EvaluationService(
+        processes=args.processes,
+        reference_dir=args.reference_dir,
+        xml_name_regex=args.xml_name_regex,
+        include=args.include,
+        exclude=args.exclude,
+        spans_type=args.spans_type,
+        schema=_schema,
+        views=args.views)
+    _server = make_server(_service, host=args.host, port=args.port, socket_path=args.socket_path,
+                          max_body_size=args.max_body_size)
+    logging.warning("serving %s documents from %s", _service.documents, args.reference_dir)
+    try:
+        _server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        _server.server_close()
+        _service.close()
@@ -1 +1,26 @@
 __author__ = 'bethard'
+
+
+def to_xml(entities, relations=()):
+    """
+    :param list entities: entities as "type:spans" strings, optionally followed by ":name=value" properties, e.g.,
+        "X:0,5" or "X:0,5;7,9:A=a"; the i-th entity has the id "i@e"
+    :param list relations: relations as "type" strings followed by ":name=value" properties, e.g.,
+        "R:Source=0@e:Target=1@e"; the i-th relation has the id "i@r"
+    :return string: the Anafora XML of the annotations
+    """
+    def to_properties(props):
+        return "".join("<{0}>{1}</{0}>".format(*prop.split("=")) for prop in props)
+
+    annotations = []
+    for i, entity in enumerate(entities):
+        type_name, spans = entity.split(":")[:2]
+        annotations.append(
+            "<entity><id>{0}@e</id><type>{1}</type><parentsType>E</parentsType><span>{2}</span>"
+            "<properties>{3}</properties></entity>".format(i, type_name, spans, to_properties(entity.split(":")[2:])))
+    for i, relation in enumerate(relations):
+        type_name = relation.split(":")[0]
+        annotations.append(
+            "<relation><id>{0}@r</id><type>{1}</type><parentsType>R</parentsType>"
+            "<properties>{2}</properties></relation>".format(i, type_name, to_properties(relation.split(":")[1:])))
+    return "<data><info/><annotations>{0}</annotations></data>".format("".join(annotations))
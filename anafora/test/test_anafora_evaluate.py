@@ -1,7 +1,17 @@
+import collections
+import functools
+import io
+import json
+import os
+import random
+
 import pytest
 
 import anafora
 import anafora.evaluate
+import anafora.select
+import anafora.validate
+from anafora.test import to_xml
 
 
 def test_score_data():
@@ -629,6 +639,45 @@ def test_temporal_closure_scores():
     assert scores.recall() ==  4.0 / 9.0
 
 
+def test_temporal_closure_matches_naive_closure():
+    scores = anafora.evaluate.TemporalClosureScores()
+
+    def naive_closure(annotations):
+        point_relations = {r for a in annotations for r in scores._to_point_relations(a)}
+        while True:
+            new_relations = {
+                (point1, "=" if relation12 == relation23 == "=" else "<", point3)
+                for point1, relation12, point2 in point_relations
+                for point2b, relation23, point3 in point_relations
+                if point2 == point2b} - point_relations
+            if not new_relations:
+                break
+            point_relations |= new_relations
+        interval_names = collections.defaultdict(set)
+        for spans, type_name, (prop_name, _) in annotations:
+            for span in spans:
+                interval_names[span].add((type_name, prop_name))
+        result = set()
+        for (interval1, _), _, (interval2, _) in point_relations:
+            for pair in [(interval1, interval2), (interval2, interval1)]:
+                for relation, requirements in scores._interval_to_point.items():
+                    if all(((pair[i1], s1), r, (pair[i2], s2)) in point_relations
+                           for i1, s1, r, i2, s2 in requirements):
+                        for type_name, prop_name in interval_names[pair[0]] & interval_names[pair[1]]:
+                            result.add((pair, type_name, (prop_name, relation)))
+        return result
+
+    # includes inconsistent relation sets, e.g., A BEFORE B and B BEFORE A
+    relations = sorted(scores._interval_to_point)
+    rng = random.Random(42)
+    for _ in range(200):
+        annotations = set()
+        for _ in range(rng.randint(1, 10)):
+            intervals = rng.randrange(6), rng.randrange(6)
+            annotations.add((intervals, rng.choice("XY"), ("Type", rng.choice(relations))))
+        assert scores._closure(annotations) == naive_closure(annotations)
+
+
 def test_temporal_closure_data():
     reference = anafora.AnaforaData(anafora.ElementTree.fromstring("""
         <data>
@@ -816,6 +865,120 @@ def test_temporal_closure_data():
     assert "single property" in str(exc_info.value)
 
 
+def test_temporal_closure_cache(tmpdir):
+
+    def annotation(source, target, value):
+        return (source, target), None, (None, value)
+
+    reference = {annotation("A", "B", "BEFORE"), annotation("B", "C", "BEFORE")}
+    predicted = {annotation("A", "C", "BEFORE")}
+    closures = []
+
+    def compute_closure(annotations):
+        closures.append(annotations)
+        return anafora.evaluate.TemporalClosureScores()._closure(annotations)
+
+    # the reference closure is computed once, and then found in memory
+    cache = anafora.evaluate.TemporalClosureCache(cache_dir=str(tmpdir))
+    for _ in range(3):
+        scores = anafora.evaluate.TemporalClosureScores(closure_cache=cache)
+        scores._closure = compute_closure
+        scores.add(reference, predicted)
+        assert scores.precision_correct == 1
+    assert closures.count(reference) == 1
+    assert closures.count(predicted) == 3
+
+    # a new cache finds the reference closure on disk
+    cache = anafora.evaluate.TemporalClosureCache(cache_dir=str(tmpdir))
+    scores = anafora.evaluate.TemporalClosureScores(closure_cache=cache)
+    scores._closure = compute_closure
+    scores.add(reference, predicted)
+    assert scores.precision_correct == 1
+    assert scores.recall_correct == 0
+    assert closures.count(reference) == 1
+    assert closures.count(predicted) == 4
+
+    # without a cache, nothing is shared between scores
+    for _ in range(2):
+        scores = anafora.evaluate.TemporalClosureScores()
+        scores._closure = compute_closure
+        scores.add(reference, predicted)
+    assert closures.count(reference) == 3
+
+
+def test_temporal_contradictions():
+
+    def annotation(source, target, value):
+        return (source, target), None, (None, value)
+
+    scores = anafora.evaluate.TemporalClosureScores()
+    contradictions = scores.contradictions({
+        annotation("A", "B", "BEFORE"),
+        annotation("B", "C", "CONTAINS"),
+        annotation("C", "A", "BEFORE"),
+        annotation("C", "D", "BEFORE"),
+        annotation("E", "F", "SIMULTANEOUS"),
+        annotation("F", "E", "ENDS"),
+        annotation("G", "H", "OVERLAP"),
+    })
+    assert sorted(map(sorted, contradictions)) == [
+        [annotation("A", "B", "BEFORE"), annotation("B", "C", "CONTAINS"), annotation("C", "A", "BEFORE")],
+        [annotation("E", "F", "SIMULTANEOUS"), annotation("F", "E", "ENDS")],
+    ]
+
+    data = anafora.AnaforaData(anafora.ElementTree.fromstring("""
+    <data>
+        <annotations>
+            <entity><id>1</id><span>0,5</span><type>EVENT</type></entity>
+            <entity><id>2</id><span>10,15</span><type>EVENT</type></entity>
+            <entity><id>3</id><span>20,25</span><type>TIMEX3</type></entity>
+            <relation>
+                <id>4</id>
+                <type>TLINK</type>
+                <properties><Source>1</Source><Target>2</Target><Type>BEFORE</Type></properties>
+            </relation>
+            <relation>
+                <id>5</id>
+                <type>TLINK</type>
+                <properties><Source>2</Source><Target>1</Target><Type>BEFORE</Type></properties>
+            </relation>
+            <relation>
+                <id>6</id>
+                <type>TLINK</type>
+                <properties><Source>3</Source><Target>1</Target><Type>CONTAINS</Type></properties>
+            </relation>
+        </annotations>
+    </data>
+    """))
+    contradictions = list(anafora.evaluate.find_temporal_contradictions(data))
+    assert [[a.id for a in annotations] for annotations in contradictions] == [["4", "5"]]
+
+
+def test_temporal_closure_inconsistent_warning(tmpdir, caplog):
+    reference_dir = tmpdir.mkdir("reference")
+    entities = ["EVENT:{0},{1}".format(i * 10, i * 10 + 5) for i in range(5)]
+    relations = ["TLINK:Source={0}@e:Target={1}@e:Type=BEFORE".format(i, (i + 1) % 5) for i in range(5)]
+    reference_dir.join("doc", "doc.gold.xml").write(to_xml(entities, relations), ensure=True)
+    predicted_dirs = []
+    for name in ["system1", "system2"]:
+        predicted_dir = tmpdir.mkdir(name)
+        predicted_dir.join("doc", "doc.system.xml").write(to_xml(entities, relations[:2]), ensure=True)
+        predicted_dirs.append(str(predicted_dir))
+
+    # the reference is inconsistent in several views and for two systems, but is only warned about once
+    scores_type = functools.partial(
+        anafora.evaluate.TemporalClosureScores, closure_cache=anafora.evaluate.TemporalClosureCache())
+    for _ in anafora.evaluate.score_systems(
+            str(reference_dir), predicted_dirs, include={("TLINK", "Type"), ("TLINK", "Type", "BEFORE")},
+            scores_type=scores_type):
+        pass
+    messages = [r.getMessage() for r in caplog.records]
+    assert len(messages) == 1
+    assert messages[0].startswith("doc: 5 relations are inconsistent for temporal closure, e.g., ")
+    assert messages[0].count("BEFORE") == 3
+    assert messages[0].endswith("anafora.validate --temporal-contradictions for the full list")
+
+
 def test_delete_excluded():
     reference = anafora.AnaforaData(anafora.ElementTree.fromstring("""
     <data>
@@ -960,3 +1123,874 @@ def test_delete_excluded():
     assert scores.correct == 1
     assert scores.reference == 1
     assert scores.predicted == 1
+
+
+def test_score_systems(tmpdir):
+    reference_dir = tmpdir.mkdir("reference")
+    predicted_dirs = [tmpdir.mkdir("predicted1"), tmpdir.mkdir("predicted2")]
+    for text_name, reference, predictions in [
+            ("doc1", ["X:0,5", "Y:5,10"], [["X:0,5"], ["X:0,5", "Y:5,10", "Y:10,15"]]),
+            ("doc2", ["X:1,2"], [["Z:1,2"], []])]:
+        reference_dir.join(text_name, text_name + ".gold.xml").write(to_xml(reference), ensure=True)
+        for predicted_dir, predicted in zip(predicted_dirs, predictions):
+            predicted_dir.join(text_name, text_name + ".system.xml").write(to_xml(predicted), ensure=True)
+
+    predicted_dirs = [str(d) for d in predicted_dirs]
+    file_system_named_scores = dict(anafora.evaluate.score_systems(str(reference_dir), predicted_dirs))
+    assert set(file_system_named_scores) == {"doc1", "doc2"}
+    for predicted_dir in predicted_dirs:
+        for file_name, named_scores in anafora.evaluate.score_dirs(str(reference_dir), predicted_dir):
+            system_named_scores = file_system_named_scores[file_name]
+            assert list(system_named_scores) == predicted_dirs
+            assert set(named_scores) == set(system_named_scores[predicted_dir])
+            for name, scores in named_scores.items():
+                assert repr(scores) == repr(system_named_scores[predicted_dir][name])
+
+    system_named_scores = file_system_named_scores["doc1"]
+    scores = system_named_scores[predicted_dirs[0]]["*"]
+    assert (scores.reference, scores.predicted, scores.correct) == (2, 1, 1)
+    scores = system_named_scores[predicted_dirs[1]]["*"]
+    assert (scores.reference, scores.predicted, scores.correct) == (2, 3, 2)
+    system_named_scores = file_system_named_scores["doc2"]
+    assert "Z" in system_named_scores[predicted_dirs[0]]
+    assert "Z" not in system_named_scores[predicted_dirs[1]]
+
+    # the counts can instead be added directly to the corpus scores of each system
+    system_corpus_scores = {d: anafora.evaluate.CorpusScores(keep_documents=False) for d in predicted_dirs}
+    for _, system_named_scores in anafora.evaluate.score_systems(
+            str(reference_dir), predicted_dirs, corpus_scores=system_corpus_scores):
+        assert list(system_named_scores.values()) == [None, None]
+    for predicted_dir in predicted_dirs:
+        expected = anafora.evaluate.CorpusScores()
+        for file_name, system_named_scores in file_system_named_scores.items():
+            expected.update(file_name, system_named_scores[predicted_dir])
+        actual = system_corpus_scores[predicted_dir].micro()
+        assert {name: repr(scores) for name, scores in actual.items()} == \
+               {name: repr(scores) for name, scores in expected.micro().items()}
+
+
+def test_answer_key(tmpdir, caplog):
+    reference_dir = tmpdir.mkdir("reference")
+    predicted_dir = tmpdir.mkdir("predicted")
+    reference_dir.join("doc", "doc.gold.xml").write("""
+    <data>
+        <annotations>
+            <entity><id>1</id><span>0,5</span><type>X</type></entity>
+            <entity><id>2</id><span>5,10</span><type>Y</type><properties><A>a</A></properties></entity>
+            <relation>
+                <id>3</id>
+                <type>Z</type>
+                <properties><Source>1</Source><Target>2</Target><B>b</B></properties>
+            </relation>
+        </annotations>
+    </data>
+    """, ensure=True)
+    predicted_dir.join("doc", "doc.system.xml").write("""
+    <data>
+        <annotations>
+            <entity><id>1</id><span>0,5</span><type>X</type><properties><A>a</A></properties></entity>
+            <entity><id>2</id><span>5,10</span><type>Y</type><properties><A>b</A></properties></entity>
+            <entity><id>4</id><span>15,20</span><type>W</type></entity>
+            <relation>
+                <id>3</id>
+                <type>Z</type>
+                <properties><Source>1</Source><Target>2</Target><B>b</B><C>c</C></properties>
+            </relation>
+        </annotations>
+    </data>
+    """, ensure=True)
+
+    for include, exclude in [(None, None), ({"X", "Z"}, None), (None, {("Y", "A", "a")}), ({"*"}, {"X"})]:
+        answer_key_path = str(tmpdir.join("answer-key.gz"))
+        anafora.evaluate.compile_answer_key(str(reference_dir), answer_key_path, include=include, exclude=exclude)
+        expected = dict(anafora.evaluate.score_dirs(str(reference_dir), str(predicted_dir),
+                                                    include=include, exclude=exclude))
+        actual = dict(anafora.evaluate.score_dirs(answer_key_path, str(predicted_dir)))
+        assert set(actual) == set(expected) == {"doc"}
+        assert set(actual["doc"]) == set(expected["doc"])
+        for name in expected["doc"]:
+            assert repr(actual["doc"][name]) == repr(expected["doc"][name])
+
+    with pytest.raises(ValueError) as exc_info:
+        list(anafora.evaluate.score_dirs(answer_key_path, str(predicted_dir), include={"X"}))
+    assert "does not match" in str(exc_info.value)
+
+    # a different regular expression for the files is only warned about
+    assert not caplog.records
+    list(anafora.evaluate.score_dirs(answer_key_path, str(predicted_dir), xml_name_regex="system"))
+    assert [r.getMessage() for r in caplog.records] == [
+        "xml_name_regex=system does not match xml_name_regex=[.]xml$ of answer key {0}".format(answer_key_path)]
+
+
+def test_score_dirs_cache(tmpdir, monkeypatch):
+    reference_dir = tmpdir.mkdir("reference")
+    predicted_dir = tmpdir.mkdir("predicted")
+    cache_dir = str(tmpdir.join("cache"))
+    for text_name, span in [("doc1", "0,5"), ("doc2", "5,10")]:
+        xml = to_xml(["X:" + span])
+        reference_dir.join(text_name, text_name + ".gold.xml").write(xml, ensure=True)
+        predicted_dir.join(text_name, text_name + ".system.xml").write(xml, ensure=True)
+
+    loaded_paths = []
+    load = anafora.evaluate._load
+
+    def _load(xml_path, *args):
+        loaded_paths.append(xml_path)
+        return load(xml_path, *args)
+    monkeypatch.setattr(anafora.evaluate, "_load", _load)
+
+    def score():
+        del loaded_paths[:]
+        file_named_scores = anafora.evaluate.score_dirs(str(reference_dir), str(predicted_dir), cache_dir=cache_dir)
+        return {file_name: named_scores["X"].correct for file_name, named_scores in file_named_scores}
+
+    # the first run scores everything, the second nothing, and the third only the changed document
+    assert score() == {"doc1": 1, "doc2": 1}
+    assert len(loaded_paths) == 4
+    assert score() == {"doc1": 1, "doc2": 1}
+    assert len(loaded_paths) == 0
+    predicted_dir.join("doc2", "doc2.system.xml").write("<data></data>")
+    assert score() == {"doc1": 1, "doc2": 0}
+    assert sorted(os.path.basename(path) for path in loaded_paths) == ["doc2.gold.xml", "doc2.system.xml"]
+
+    # the reference is hashed only once per document, however many systems are scored against it
+    hashed_paths = []
+    file_hash = anafora.evaluate._file_hash
+
+    def _file_hash(path):
+        hashed_paths.append(path)
+        return file_hash(path)
+    monkeypatch.setattr(anafora.evaluate, "_file_hash", _file_hash)
+    predicted_dir.copy(tmpdir.join("predicted2"))
+    predicted_dirs = [str(predicted_dir), str(tmpdir.join("predicted2"))]
+    list(anafora.evaluate.score_systems(str(reference_dir), predicted_dirs, cache_dir=cache_dir))
+    assert sorted(os.path.basename(path) for path in hashed_paths if path.endswith(".gold.xml")) == [
+        "doc1.gold.xml", "doc2.gold.xml"]
+
+    # scores that keep track of errors cannot be cached
+    with pytest.raises(ValueError):
+        list(anafora.evaluate.score_dirs(str(reference_dir), str(predicted_dir), cache_dir=cache_dir,
+                                         scores_type=anafora.evaluate.DebuggingScores))
+
+
+def test_score_dirs_unmatched_predictions(tmpdir, caplog):
+    reference_dir = tmpdir.mkdir("reference")
+    predicted_dir = tmpdir.mkdir("predicted")
+    xml = to_xml(["X:0,5"])
+    reference_dir.join("doc[1]", "doc[1].gold.xml").write(xml, ensure=True)
+    predicted_dir.join("doc[1]", "doc[1].system.xml").write(xml, ensure=True)
+    predicted_dir.join("doc[1]", "notes.txt").write("")
+    predicted_dir.join("doc2", "doc2.system.xml").write(xml, ensure=True)
+
+    [(file_name, named_scores)] = anafora.evaluate.score_dirs(str(reference_dir), str(predicted_dir))
+    assert file_name == "doc[1]"
+    assert named_scores["X"].correct == 1
+    assert [r.getMessage() for r in caplog.records] == [
+        "{0}: no matching reference document".format(predicted_dir.join("doc2", "doc2.system.xml"))]
+
+
+def test_lazy_text(tmpdir):
+    ascii_path = tmpdir.join("ascii.txt")
+    ascii_path.write("aaa bbb ccc ddd")
+    text = anafora.evaluate._LazyText(str(ascii_path))
+    assert text.span_text(((0, 3),)) == "aaa"
+    assert text.span_text(((4, 7), (12, 15))) == "bbb...ddd"
+    assert text.span_text((((8, 11),), ((0, 3),))) == "ccc...aaa"
+    text.close()
+
+    unicode_path = tmpdir.join("unicode.txt")
+    unicode_path.write_text(u"éé bbb\r\nccc", encoding="utf-8")
+    text = anafora.evaluate._LazyText(str(unicode_path))
+    assert text.span_text(((3, 6), (7, 10))) == "bbb...ccc"
+    text.close()
+
+    crlf_path = tmpdir.join("crlf.txt")
+    crlf_path.write_binary(b"aa bbb\r\nccc")
+    text = anafora.evaluate._LazyText(str(crlf_path))
+    assert text.span_text(((3, 6), (7, 10))) == "bbb...ccc"
+    text.close()
+
+    text = anafora.evaluate._LazyText(str(tmpdir.join("missing.txt")))
+    with pytest.raises(RuntimeError):
+        text.span_text(((0, 1),))
+
+
+def test_shards(tmpdir):
+    reference_dir = tmpdir.mkdir("reference")
+    predicted_dir = tmpdir.mkdir("predicted")
+    for i in range(10):
+        text_name = "doc{0}".format(i)
+        for annotations_dir, annotations in [(reference_dir, [(0, 5), (5, 10)]), (predicted_dir, [(0, 5), (i, 20)])]:
+            annotations_dir.join(text_name, text_name + ".xml").write(
+                to_xml(["X:{0},{1}".format(*span) for span in annotations]), ensure=True)
+
+    # each document belongs to exactly one shard
+    shard_file_names = []
+    for index in range(3):
+        shard = (index, 3)
+        file_named_scores = anafora.evaluate.score_dirs(str(reference_dir), str(predicted_dir), shard=shard)
+        file_named_scores = list(file_named_scores)
+        shard_file_names.extend(file_name for file_name, _ in file_named_scores)
+        anafora.evaluate.write_partial_results(
+            str(tmpdir.join("shard{0}.jsonl".format(index))),
+            ((file_name, {None: named_scores}) for file_name, named_scores in file_named_scores), shard=shard)
+    assert sorted(shard_file_names) == ["doc{0}".format(i) for i in range(10)]
+
+    # merging the shards gives the same scores as evaluating everything at once
+    partial_results_paths = [str(tmpdir.join("shard{0}.jsonl".format(index))) for index in range(3)]
+    scores_type, file_system_named_scores = anafora.evaluate.merge_partial_results(partial_results_paths)
+    assert scores_type is anafora.evaluate.Scores
+    merged = dict((file_name, system_named_scores[None]) for file_name, system_named_scores in file_system_named_scores)
+    for file_name, named_scores in anafora.evaluate.score_dirs(str(reference_dir), str(predicted_dir)):
+        assert set(named_scores) == set(merged[file_name])
+        for name, scores in named_scores.items():
+            assert repr(scores) == repr(merged[file_name][name])
+
+    # the same shard cannot be merged twice
+    with pytest.raises(ValueError):
+        anafora.evaluate.merge_partial_results(partial_results_paths[:1] * 2)
+
+    # scores of an unknown type are not silently read as some other type
+    unknown_path = tmpdir.join("unknown.jsonl")
+    with open(partial_results_paths[0]) as partial_results_file:
+        header = json.loads(next(partial_results_file))
+        header["scores_type"] = "UnknownScores"
+        unknown_path.write(json.dumps(header) + "\n" + partial_results_file.read())
+    with pytest.raises(ValueError):
+        anafora.evaluate.merge_partial_results([str(unknown_path)])
+
+
+def test_bootstrap_scores():
+    file_system_named_scores = []
+    for i in range(20):
+        system_named_scores = collections.OrderedDict()
+        for system_name, correct in [("system1", i % 3), ("system2", i % 3), ("system3", 5)]:
+            scores = anafora.evaluate.Scores()
+            scores.reference, scores.predicted, scores.correct = 5, 5, correct
+            system_named_scores[system_name] = {"X": scores}
+        file_system_named_scores.append(("doc{0}".format(i), system_named_scores))
+
+    system_named_intervals, pair_named_differences = anafora.evaluate.bootstrap_scores(
+        file_system_named_scores, n_samples=200, seed=42)
+    assert list(system_named_intervals) == ["system1", "system2", "system3"]
+    for metric_name in ["precision", "recall", "f1"]:
+        value, lower, upper = system_named_intervals["system1"]["X"][metric_name]
+        assert value == pytest.approx(19 / 100.0)
+        assert lower <= value <= upper
+        assert lower < upper
+        assert system_named_intervals["system3"]["X"][metric_name] == (1.0, 1.0, 1.0)
+
+        # identical systems are not significantly different, while a perfect system is
+        assert pair_named_differences["system1", "system2"]["X"][metric_name] == (0.0, 1.0)
+        difference, p_value = pair_named_differences["system1", "system3"]["X"][metric_name]
+        assert difference == pytest.approx(81 / 100.0)
+        assert p_value < 0.01
+
+    # the same seed gives the same results
+    assert anafora.evaluate.bootstrap_scores(file_system_named_scores, n_samples=200, seed=42) == (
+        system_named_intervals, pair_named_differences)
+
+
+def test_error_report(tmpdir):
+    reference_dir = tmpdir.mkdir("reference")
+    predicted_dir = tmpdir.mkdir("predicted")
+    reference_dir.join("doc", "doc").write("aaa bbb ccc ddd", ensure=True)
+    for annotations_dir, spans in [(reference_dir, [(0, 3), (4, 7), (8, 11)]), (predicted_dir, [(0, 3), (12, 15)])]:
+        annotations_dir.join("doc", "doc.xml").write(
+            to_xml(["X:{0},{1}".format(*span) for span in spans]), ensure=True)
+
+    # errors are written as they are found, and are not kept in the scores
+    report_file = io.StringIO()
+    error_report = anafora.evaluate.ErrorReport(report_file)
+    file_named_scores = list(anafora.evaluate.score_dirs(
+        str(reference_dir), str(predicted_dir), scores_type=anafora.evaluate.DebuggingScores,
+        error_report=error_report))
+    assert all(not scores.errors for _, named_scores in file_named_scores for scores in named_scores.values())
+    errors = [json.loads(line) for line in report_file.getvalue().splitlines()]
+    assert [(e["view"], e["message"], e["text"]) for e in errors if e["view"] in ["*", "X"]] == [
+        ("*", "not in predicted", "bbb"),
+        ("*", "not in predicted", "ccc"),
+        ("*", "not in reference", "ddd"),
+        ("X", "not in predicted", "bbb"),
+        ("X", "not in predicted", "ccc"),
+        ("X", "not in reference", "ddd"),
+    ]
+
+    # with a limit, only the first errors of each view are written
+    report_file = io.StringIO()
+    error_report = anafora.evaluate.ErrorReport(report_file, "tsv", first_errors_per_view=1)
+    list(anafora.evaluate.score_dirs(
+        str(reference_dir), str(predicted_dir), scores_type=anafora.evaluate.DebuggingScores,
+        error_report=error_report))
+    lines = report_file.getvalue().splitlines()
+    assert [line.split("\t")[2:5] for line in lines] == [
+        ["view", "message", "text"],
+        ["*", "not in predicted", "bbb"],
+        ["*:<span>", "not in predicted", "bbb"],
+        ["X", "not in predicted", "bbb"],
+        ["X:<span>", "not in predicted", "bbb"],
+    ]
+    assert sum(error_report.omitted.values()) == 8
+
+
+def test_interned_keys():
+    rng = random.Random(42)
+
+    def random_data():
+        data = anafora.AnaforaData()
+        entities = []
+        for i in range(20):
+            entity = anafora.AnaforaEntity()
+            entity.id = "{0}@e".format(i)
+            start = rng.randrange(10)
+            entity.spans = ((start, start + rng.randrange(1, 3)),)
+            entity.type = rng.choice(["X", "Y"])
+            entity.properties["A"] = rng.choice(["a", "b"])
+            data.annotations.append(entity)
+            entities.append(entity)
+        for i in range(20):
+            relation = anafora.AnaforaRelation()
+            relation.id = "{0}@r".format(i)
+            relation.type = "Z"
+            data.annotations.append(relation)
+            relation.properties["Source"] = rng.choice(entities)
+            relation.properties["Target"] = rng.choice(entities)
+            relation.properties["B"] = rng.choice(["c", "d"])
+        return data
+
+    # the same annotations always get the same id
+    interner = anafora.evaluate._KeyInterner()
+    assert [interner(key) for key in ["a", ("b", 1), "a", ("b", 1), "c"]] == [0, 1, 0, 1, 2]
+
+    # looking up keys does not add them to the interner
+    lookup = anafora.evaluate._KeyLookup(interner)
+    assert [lookup(key) for key in ["c", "d", "a", "d"]] == [2, -1, 0, -1]
+    assert (interner.lookup("a"), interner.lookup("d")) == (0, None)
+
+    # comparing integer ids gives the same counts as comparing annotation keys
+    for _ in range(10):
+        reference = random_data()
+        predicted = random_data()
+        interned_named_scores = anafora.evaluate.score_data(reference, predicted)
+        named_scores = anafora.evaluate.score_data(reference, predicted,
+                                                   scores_type=anafora.evaluate.DebuggingScores)
+        assert set(interned_named_scores) == set(named_scores)
+        for name in named_scores:
+            scores = named_scores[name]
+            interned_scores = interned_named_scores[name]
+            assert (interned_scores.reference, interned_scores.predicted, interned_scores.correct) == \
+                   (scores.reference, scores.predicted, scores.correct)
+
+    # keys with overlapping spans are not interned, since overlap is not transitive: two predictions that both
+    # overlap the same reference are still two predictions
+    def overlap_data(spans):
+        data = anafora.AnaforaData()
+        for i, span in enumerate(spans):
+            entity = anafora.AnaforaEntity()
+            entity.id = "{0}@e".format(i)
+            entity.spans = (span,)
+            entity.type = "X"
+            data.annotations.append(entity)
+        return data
+
+    named_scores = anafora.evaluate.score_data(overlap_data([(0, 10)]), overlap_data([(0, 3), (5, 8)]),
+                                               spans_type=anafora.evaluate._OverlappingSpans)
+    assert repr(named_scores["X"]) == "Scores(reference=1, predicted=2, correct=1)"
+
+
+def test_corpus_scores():
+    def to_data(annotations):
+        return anafora.AnaforaData(anafora.ElementTree.fromstring(to_xml(annotations)))
+
+    documents = [
+        ("doc1", to_data(["X:0,5", "Y:5,10"]), to_data(["X:0,5"])),
+        ("doc2", to_data(["X:1,2", "X:3,4"]), to_data(["X:1,2", "X:3,4", "X:5,6", "Z:7,8"])),
+    ]
+    select = anafora.select.Select()
+    corpus_scores = anafora.evaluate.CorpusScores()
+    for document_name, reference, predicted in documents:
+        corpus_scores.add_sets(document_name,
+                               anafora.evaluate._AnnotationSets(reference.annotations, select),
+                               anafora.evaluate._AnnotationSets(predicted.annotations, select))
+
+    # the merged counts are the same as merging Scores objects
+    updated_corpus_scores = anafora.evaluate.CorpusScores()
+    merged_named_scores = collections.defaultdict(anafora.evaluate.Scores)
+    for document_name, reference, predicted in documents:
+        named_scores = anafora.evaluate.score_data(reference, predicted)
+        updated_corpus_scores.update(document_name, named_scores)
+        for name, scores in named_scores.items():
+            merged_named_scores[name].update(scores)
+    for named_scores in [corpus_scores.micro(), updated_corpus_scores.micro()]:
+        assert set(named_scores) == set(merged_named_scores)
+        for name, scores in named_scores.items():
+            assert repr(scores) == repr(merged_named_scores[name])
+
+    # macro-averages are over the documents that have annotations in the view
+    precision, recall, f1 = corpus_scores.macro()["X"]
+    assert precision == pytest.approx((1.0 + 2.0 / 3.0) / 2)
+    assert recall == pytest.approx(1.0)
+    assert corpus_scores.macro()["Z"] == (0.0, 1.0, 0.0)
+
+    # the per-document counts can be read as a documents x views matrix
+    assert corpus_scores.document_names == ["doc1", "doc2"]
+    x_index = corpus_scores.view_names.index("X")
+    z_index = corpus_scores.view_names.index("Z")
+    predicted_matrix = corpus_scores.matrix("predicted")
+    assert [row[x_index] for row in predicted_matrix] == [1, 3]
+    assert [row[z_index] for row in predicted_matrix] == [0, 1]
+
+    # without the counts of each document, only the micro-averages are available
+    micro_corpus_scores = anafora.evaluate.CorpusScores(keep_documents=False)
+    for document_name, reference, predicted in documents:
+        micro_corpus_scores.add_sets(document_name,
+                                     anafora.evaluate._AnnotationSets(reference.annotations, select),
+                                     anafora.evaluate._AnnotationSets(predicted.annotations, select))
+    assert {name: repr(scores) for name, scores in micro_corpus_scores.micro().items()} == \
+           {name: repr(scores) for name, scores in corpus_scores.micro().items()}
+    with pytest.raises(ValueError):
+        micro_corpus_scores.macro()
+    with pytest.raises(ValueError):
+        micro_corpus_scores.matrix("predicted")
+
+    # scores that keep track of errors cannot be accumulated as counts
+    with pytest.raises(ValueError):
+        anafora.evaluate.CorpusScores(anafora.evaluate.DebuggingScores)
+
+
+def test_schema_and_views():
+    reference = anafora.AnaforaData(anafora.ElementTree.fromstring("""
+    <data>
+        <annotations>
+            <entity><id>1</id><span>0,5</span><type>X</type><properties><A>a</A><B>some text</B></properties></entity>
+            <entity><id>2</id><span>5,10</span><type>X</type><properties><A>b</A><B>more text</B></properties></entity>
+        </annotations>
+    </data>
+    """))
+    predicted = anafora.AnaforaData(anafora.ElementTree.fromstring("""
+    <data>
+        <annotations>
+            <entity><id>1</id><span>0,5</span><type>X</type><properties><A>a</A><B>other</B></properties></entity>
+        </annotations>
+    </data>
+    """))
+    schema = anafora.validate.Schema(anafora.ElementTree.fromstring("""
+    <schema>
+        <definition>
+            <entities type="entities">
+                <entity type="X">
+                    <properties>
+                        <property type="A" input="choice">a,b</property>
+                        <property type="B" input="text"/>
+                    </properties>
+                </entity>
+            </entities>
+        </definition>
+    </schema>
+    """))
+
+    # without a schema, every distinct value of a free-text property is a view
+    named_scores = anafora.evaluate.score_data(reference, predicted)
+    assert ("X", "B", "some text") in named_scores
+    assert ("X", "B", "other") in named_scores
+
+    # with a schema, only the values of choice properties are views
+    schema_named_scores = anafora.evaluate.score_data(reference, predicted, schema=schema)
+    assert set(schema_named_scores) == {name for name in named_scores if not (len(name) == 3 and name[1] == "B")}
+    for name, scores in schema_named_scores.items():
+        assert repr(scores) == repr(named_scores[name])
+
+    # with explicit views, only those views are scored
+    views_named_scores = anafora.evaluate.score_data(reference, predicted, views=["*", ("X", "A"), ("X", "A", "c")])
+    assert set(views_named_scores) == {"*", ("X", "A"), ("X", "A", "c")}
+    assert repr(views_named_scores["*"]) == repr(named_scores["*"])
+    assert repr(views_named_scores["X", "A"]) == repr(named_scores["X", "A"])
+    scores = views_named_scores["X", "A", "c"]
+    assert (scores.reference, scores.predicted, scores.correct) == (0, 0, 0)
+
+
+def test_score_annotators(tmpdir):
+    anafora_dir = tmpdir.mkdir("annotations")
+    annotator_spans = {
+        "gold": ["0,5", "5,10", "10,15"],
+        "ann1": ["0,5", "5,10"],
+        "ann2": ["0,5", "10,15", "15,20"],
+        "ann3": ["5,10"],
+    }
+    annotator_data = {}
+    for annotator, spans in annotator_spans.items():
+        xml = to_xml(["X:" + span for span in spans])
+        anafora_dir.join("doc", "doc.X.{0}.completed.xml".format(annotator)).write(xml, ensure=True)
+        annotator_data[annotator] = anafora.AnaforaData(anafora.ElementTree.fromstring(xml))
+
+    [(file_name, named_scores)] = anafora.evaluate.score_annotators(str(anafora_dir), "[.]xml$")
+    assert file_name == "doc"
+
+    # each pair of annotators is scored as if by score_data (where either may be treated as the reference)
+    for annotator1, annotator2 in [("ann1", "gold"), ("ann1", "ann2"), ("ann2", "ann3")]:
+        pair_named_scores = anafora.evaluate.score_data(annotator_data[annotator1], annotator_data[annotator2])
+        prefix = "{0}-vs-{1}".format(annotator1, annotator2)
+        for name, scores in pair_named_scores.items():
+            if not isinstance(name, tuple):
+                name = name,
+            pair_scores = named_scores[(prefix,) + name]
+            assert pair_scores.correct == scores.correct
+            assert {pair_scores.reference, pair_scores.predicted} == {scores.reference, scores.predicted}
+    scores = named_scores["annotator-vs-annotator", "X"]
+    assert (scores.reference + scores.predicted, scores.correct) == (12, 2)
+
+    # the same scores are produced by a pool of processes
+    [(_, pool_named_scores)] = anafora.evaluate.score_annotators(str(anafora_dir), "[.]xml$", processes=2)
+    assert set(pool_named_scores) == set(named_scores)
+    for name, scores in named_scores.items():
+        assert repr(pool_named_scores[name]) == repr(scores)
+
+
+def test_agreement_scores(tmpdir):
+    agreement = anafora.evaluate.AgreementScores()
+    agreement.add([{1, 2, 3, 4}, {1, 2, 3}])
+    assert agreement.items == 4
+    assert agreement.vote_counts == {(2, 2): 3, (2, 1): 1}
+    assert agreement.fleiss_kappa() == pytest.approx(-1.0 / 7.0)
+    assert agreement.krippendorff_alpha() == pytest.approx(0.0)
+
+    # perfect agreement
+    perfect_agreement = anafora.evaluate.AgreementScores()
+    perfect_agreement.add([{1, 2}, {1, 2}, {1, 2}])
+    assert perfect_agreement.fleiss_kappa() == 1.0
+    assert perfect_agreement.krippendorff_alpha() == 1.0
+    perfect_agreement.update(agreement)
+    assert perfect_agreement.vote_counts == {(3, 3): 2, (2, 2): 3, (2, 1): 1}
+
+    # all annotators of a document are pooled
+    anafora_dir = tmpdir.mkdir("annotations")
+    for annotator, spans in [("ann1", ["0,5", "5,10"]), ("ann2", ["0,5", "10,15"]), ("ann3", ["0,5"])]:
+        xml = to_xml(["X:" + span for span in spans])
+        anafora_dir.join("doc", "doc.X.{0}.completed.xml".format(annotator)).write(xml, ensure=True)
+    [(file_name, named_agreement)] = anafora.evaluate.score_agreement(str(anafora_dir), "[.]xml$")
+    assert file_name == "doc"
+    assert named_agreement["X"].vote_counts == {(3, 3): 1, (3, 1): 2}
+
+
+def test_score_corpus():
+    rng = random.Random(42)
+
+    def random_records():
+        entities = []
+        for i in range(10):
+            start = rng.randrange(10)
+            entities.append(([(start, start + rng.randrange(1, 3))], rng.choice(["X", "Y"]),
+                             {"A": rng.choice(["a", "b"])}))
+        relations = [(None, "Z", {"Source": rng.choice(entities), "Target": rng.choice(entities),
+                                  "B": rng.choice(["c", "d"])})
+                     for _ in range(10)]
+        return entities + relations
+
+    def to_data(records):
+        data = anafora.AnaforaData()
+        record_ids = {}
+        for i, (spans, type_name, properties) in enumerate(records):
+            annotation = anafora.AnaforaEntity() if spans is not None else anafora.AnaforaRelation()
+            annotation.id = record_ids[id(records[i])] = "{0}@a".format(i)
+            annotation.type = type_name
+            if spans is not None:
+                annotation.spans = tuple(spans)
+            data.annotations.append(annotation)
+            for name, value in properties.items():
+                if isinstance(value, tuple):
+                    value = data.annotations.select_id(record_ids[id(value)])
+                annotation.properties[name] = value
+        return data
+
+    # scoring records gives the same merged scores as scoring the equivalent AnaforaData one document at a time
+    references = [random_records() for _ in range(5)]
+    scorer = anafora.evaluate.CorpusScorer()
+    for _ in range(3):
+        predictions = [random_records() for _ in range(5)]
+        merged_named_scores = collections.defaultdict(anafora.evaluate.Scores)
+        for reference, predicted in zip(references, predictions):
+            for name, scores in anafora.evaluate.score_data(to_data(reference), to_data(predicted)).items():
+                merged_named_scores[name].update(scores)
+        for named_scores in [anafora.evaluate.score_corpus(zip(references, predictions)),
+                             anafora.evaluate.score_corpus(zip(references, predictions), scorer=scorer)]:
+            assert set(named_scores) == set(merged_named_scores)
+            for name, scores in named_scores.items():
+                assert repr(scores) == repr(merged_named_scores[name])
+
+    # the reference sets are calculated once, and new predictions do not grow the reference interners
+    reference_sets = [scorer.reference_sets(reference) for reference in references]
+    interner_sizes = [len(sets.interner._ids) for sets in reference_sets]
+    scorer.score((reference, random_records()) for reference in references)
+    assert [scorer.reference_sets(reference) for reference in references] == reference_sets
+    assert [len(sets.interner._ids) for sets in reference_sets] == interner_sizes
+
+    # AnaforaData and missing predictions can also be scored, with the other scores types
+    data = to_data(references[0])
+    named_scores = anafora.evaluate.score_corpus([(data, data), (data, None)],
+                                                 scores_type=anafora.evaluate.DebuggingScores)
+    assert named_scores["X"].reference == 2 * named_scores["X"].correct
+    assert all(error == "not in predicted" for _, error in named_scores["X"].errors)
+
+
+def test_phase_profile(tmpdir):
+    # the phases of score_data are recorded in the totals
+    reference = anafora.AnaforaData(anafora.ElementTree.fromstring(to_xml(["X:0,5", "Y:5,10"])))
+    predicted = anafora.AnaforaData(anafora.ElementTree.fromstring(to_xml(["X:0,5"])))
+    profile = anafora.evaluate.PhaseProfile()
+    named_scores = anafora.evaluate.score_data(reference, predicted, profile=profile)
+    assert list(profile.totals) == ["view discovery", "key construction", "set intersection"]
+    wall_time, cpu_time, calls, items = profile.totals["view discovery"]
+    assert wall_time >= 0.0 and cpu_time >= 0.0 and calls == 2 and items == 6 + 4
+    assert profile.totals["set intersection"][2:] == [len(named_scores), (2 + 1) * 2 + (1 + 1) * 2 + (1 + 0) * 2]
+
+    # the phases of score_dirs are also recorded for each document
+    reference_dir = tmpdir.mkdir("reference")
+    predicted_dir = tmpdir.mkdir("predicted")
+    for text_name in ["doc1", "doc2"]:
+        reference_dir.join(text_name, text_name + ".xml").write(to_xml(["X:0,5", "Y:5,10"]), ensure=True)
+        predicted_dir.join(text_name, text_name + ".xml").write(to_xml(["X:0,5"]), ensure=True)
+    profile = anafora.evaluate.PhaseProfile()
+    list(anafora.evaluate.score_dirs(str(reference_dir), str(predicted_dir), profile=profile))
+    assert sorted(profile.documents) == ["doc1", "doc2"]
+    assert profile.totals["xml parsing"][2:] == [4, 6]
+    assert profile.documents["doc1"]["xml parsing"][2:] == [2, 3]
+    profile_json = json.loads(json.dumps(profile.to_json()))
+    assert list(profile_json["total"])[:3] == ["xml parsing", "self-reference check", "view discovery"]
+    assert profile_json["documents"]["doc2"]["self-reference check"]["items"] == 3
+    output = io.StringIO()
+    profile.print_table(output)
+    assert output.getvalue().splitlines()[1].startswith("xml parsing")
+
+
+def test_character_scores(monkeypatch):
+    scores = anafora.evaluate.CharacterScores()
+    reference = {(((0, 10),), "X", None), (((20, 30),), "X", None), (((5, 8),), "Y", None)}
+    predicted = {(((5, 15),), "X", None), (((8, 12),), "X", None), (((25, 30), (40, 42)), "X", None),
+                 (((0, 10),), "Y", None)}
+    scores.add(reference, predicted)
+    assert (scores.reference, scores.predicted, scores.correct) == (10 + 10 + 3, 10 + 5 + 2 + 10, 5 + 5 + 3)
+
+    # relation spans are flattened, and the counts are the same with or without numpy
+    rng = random.Random(42)
+    for _ in range(20):
+        def random_keys():
+            keys = set()
+            for _ in range(rng.randrange(200)):
+                spans = []
+                for _ in range(rng.randrange(1, 3)):
+                    start = rng.randrange(100)
+                    spans.append((start, start + rng.randrange(10)))
+                keys.add(((tuple(spans),), rng.choice("XY"), rng.choice([None, ("A", "a")])))
+            return keys
+
+        def covered(keys):
+            return {(type_name, props, i) for spans, type_name, props in keys
+                    for start, end in anafora.evaluate._flatten_spans(spans) for i in range(start, end)}
+
+        reference = random_keys()
+        predicted = random_keys()
+        expected = (len(covered(reference)), len(covered(predicted)), len(covered(reference) & covered(predicted)))
+        for numpy_min_spans in [0, 1 << 30]:
+            monkeypatch.setattr(anafora.evaluate, "_character_overlap_numpy_min_spans", numpy_min_spans)
+            scores = anafora.evaluate.CharacterScores()
+            scores.add(reference, predicted)
+            assert (scores.reference, scores.predicted, scores.correct) == expected
+
+
+def test_span_iou_scores():
+    scores = anafora.evaluate.SpanIoUScores(thresholds=[1.0, 0.0, 0.5])
+    reference = {(((0, 10),), "X", None), (((20, 30),), "X", None), (((40, 50),), "X", None), (((5, 5),), "Y", None)}
+    predicted = {(((0, 10),), "X", None), (((0, 4),), "X", None), (((22, 30),), "X", None), (((45, 60),), "X", None),
+                 (((40, 50),), "Y", None), (((5, 5),), "Y", None)}
+    scores.add(reference, predicted)
+    assert scores.thresholds == (0.0, 0.5, 1.0)
+    assert (scores.reference, scores.predicted) == (4, 6)
+
+    # [0, 4) overlaps [0, 10) but that is matched (with IoU 1.0) to the identical [0, 10); [22, 30) has IoU 0.8;
+    # [45, 60) has IoU 0.25; [40, 50) has the wrong type; and the empty Y spans are identical
+    assert scores.correct == [4, 3, 2]
+    assert repr(scores.scores(0.5)) == "Scores(reference=4, predicted=6, correct=3)"
+
+    # relation arguments only overlap with the same argument
+    scores = anafora.evaluate.SpanIoUScores(thresholds=[0.0])
+    scores.add({((((0, 5),), ((10, 15),)), "R", None)}, {((((10, 15),), ((0, 5),)), "R", None)})
+    assert scores.correct == [0]
+
+    # the scores for threshold 1.0 are the same as for exact matching
+    reference = anafora.AnaforaData(anafora.ElementTree.fromstring(to_xml(["X:0,5", "X:3,8", "Y:10,20", "Y:30,32"])))
+    predicted = anafora.AnaforaData(anafora.ElementTree.fromstring(to_xml(["X:0,5", "X:0,6", "Y:10,20", "Y:31,40"])))
+    iou_named_scores = anafora.evaluate.score_data(
+        reference, predicted, scores_type=lambda: anafora.evaluate.SpanIoUScores([0.0, 1.0]))
+    named_scores = anafora.evaluate.score_data(reference, predicted)
+    for name, scores in named_scores.items():
+        assert repr(iou_named_scores[name].scores(1.0)) == repr(scores)
+
+    # relations whose arguments are slightly misaligned are matched by the IoU of their argument spans
+    tlinks = ["TLINK:Source=0@e:Target=1@e:Type=BEFORE"]
+    reference_tlinks = anafora.AnaforaData(anafora.ElementTree.fromstring(to_xml(["X:0,5", "X:10,15"], tlinks)))
+    predicted_tlinks = anafora.AnaforaData(anafora.ElementTree.fromstring(to_xml(["X:0,5", "X:10,16"], tlinks)))
+    tlink_iou_named_scores = anafora.evaluate.score_data(
+        reference_tlinks, predicted_tlinks, scores_type=lambda: anafora.evaluate.SpanIoUScores([0.5, 0.95, 1.0]))
+    tlink_named_scores = anafora.evaluate.score_data(reference_tlinks, predicted_tlinks)
+    for name in ["TLINK", ("TLINK", "Source"), ("TLINK", "Target"), ("TLINK", "Type", "BEFORE")]:
+        assert tlink_named_scores[name].correct == 0
+        assert tlink_iou_named_scores[name].correct == [1, 0, 0]
+    assert iou_named_scores["X"].correct == [2, 1]
+    assert iou_named_scores["Y"].correct == [2, 1]
+    with pytest.raises(ValueError):
+        iou_named_scores["X"].update(anafora.evaluate.SpanIoUScores([0.5]))
+
+
+def test_confusion_matrices(tmpdir, caplog):
+    reference_xml = to_xml(["X:0,5:A=a:B=c", "X:5,10:A=a", "X:10,15:A=b", "X:20,25:A=b"])
+    predicted_xml = to_xml(["X:0,5:A=b:B=c", "X:5,10:A=a:B=d", "X:10,15:A=b", "X:30,35"])
+    reference = anafora.AnaforaData(anafora.ElementTree.fromstring(reference_xml))
+    predicted = anafora.AnaforaData(anafora.ElementTree.fromstring(predicted_xml))
+    confusion_matrices = anafora.evaluate.confusion_data(reference, predicted)
+    assert confusion_matrices.matrices["X", "A"] == {("a", "b"): 1, ("a", "a"): 1, ("b", "b"): 1}
+    assert confusion_matrices.matrices["X", "B"] == {("c", "c"): 1, (None, "d"): 1}
+    assert confusion_matrices.unaligned == {("X", "reference"): 1, ("X", "predicted"): 1}
+    assert confusion_matrices.values("X", "B") == (["c", None], ["c", "d"])
+
+    # the diagonal is the same as the correct counts of the type:property:value views
+    named_scores = anafora.evaluate.score_data(reference, predicted)
+    for (type_name, prop_name), matrix in confusion_matrices.matrices.items():
+        for (reference_value, predicted_value), count in matrix.items():
+            if reference_value == predicted_value:
+                assert named_scores[type_name, prop_name, reference_value].correct == count
+
+    # properties can be selected, and matrices of several documents are merged like scores
+    reference_dir = tmpdir.mkdir("reference")
+    predicted_dir = tmpdir.mkdir("predicted")
+    for text_name in ["doc1", "doc2"]:
+        reference_dir.join(text_name, text_name + ".xml").write(reference_xml, ensure=True)
+        predicted_dir.join(text_name, text_name + ".xml").write(predicted_xml, ensure=True)
+    merged = anafora.evaluate.ConfusionMatrices()
+    for _, document_matrices in anafora.evaluate.confusion_dirs(
+            str(reference_dir), str(predicted_dir), include=[("X", "A")]):
+        merged.update(document_matrices)
+    assert list(merged.matrices) == [("X", "A")]
+    assert merged.matrices["X", "A"] == {("a", "b"): 2, ("a", "a"): 2, ("b", "b"): 2}
+
+    # documents are selected as when scoring, and predictions without a reference are reported
+    predicted_dir.join("doc3", "doc3.xml").write(predicted_xml, ensure=True)
+    file_names = [file_name for file_name, _ in anafora.evaluate.confusion_dirs(
+        str(reference_dir), str(predicted_dir), sample={"doc2"})]
+    assert file_names == ["doc2"]
+    assert not caplog.records
+    file_names = [file_name for file_name, _ in anafora.evaluate.confusion_dirs(str(reference_dir), str(predicted_dir))]
+    assert file_names == ["doc1", "doc2"]
+    assert [r.getMessage() for r in caplog.records] == [
+        "{0}: no matching reference document".format(predicted_dir.join("doc3", "doc3.xml"))]
+    answer_key_path = str(tmpdir.join("answer-key.jsonl.gz"))
+    anafora.evaluate.compile_answer_key(str(reference_dir), answer_key_path)
+    with pytest.raises(ValueError):
+        list(anafora.evaluate.confusion_dirs(answer_key_path, str(predicted_dir)))
+
+    # overlapping spans cannot be grouped consistently (overlap is not transitive), so they are rejected
+    with pytest.raises(ValueError):
+        anafora.evaluate.confusion_data(reference, predicted, spans_type=anafora.evaluate._OverlappingSpans)
+    with pytest.raises(ValueError):
+        list(anafora.evaluate.confusion_dirs(str(reference_dir), str(predicted_dir),
+                                             spans_type=anafora.evaluate._OverlappingSpans))
+
+
+def test_align_arguments(tmpdir):
+    def to_tlinks(arguments):
+        return ["TLINK:Source={0}@e:Target={1}@e:Type=BEFORE".format(*pair) for pair in arguments]
+
+    # the predicted 12,14 overlaps 10,15 but 10,16 is aligned to it (with a higher IoU); 30,35 is aligned to nothing
+    reference_xml = to_xml(["X:0,5", "X:10,15"], to_tlinks([(0, 1)]))
+    predicted_xml = to_xml(["X:0,4", "X:12,14", "X:10,16", "X:30,35"], to_tlinks([(0, 2), (0, 1), (0, 3)]))
+    reference = anafora.AnaforaData(anafora.ElementTree.fromstring(reference_xml))
+    predicted = anafora.AnaforaData(anafora.ElementTree.fromstring(predicted_xml))
+    named_scores = anafora.evaluate.score_data(reference, predicted)
+    aligned_named_scores = anafora.evaluate.score_data(reference, predicted, align_arguments=True)
+    assert named_scores["TLINK"].correct == 0
+    assert repr(aligned_named_scores["TLINK"]) == "Scores(reference=1, predicted=3, correct=1)"
+    assert repr(aligned_named_scores["TLINK", "Type", "BEFORE"]) == "Scores(reference=1, predicted=3, correct=1)"
+
+    # the entities themselves are scored as before
+    assert repr(aligned_named_scores["X"]) == repr(named_scores["X"])
+
+    # the same alignment is used when scoring directories
+    reference_dir = tmpdir.mkdir("reference")
+    predicted_dir = tmpdir.mkdir("predicted")
+    reference_dir.join("doc1", "doc1.xml").write(reference_xml, ensure=True)
+    predicted_dir.join("doc1", "doc1.xml").write(predicted_xml, ensure=True)
+    [(_, dir_named_scores)] = anafora.evaluate.score_dirs(str(reference_dir), str(predicted_dir),
+                                                          align_arguments=True)
+    assert repr(dir_named_scores["TLINK"]) == repr(aligned_named_scores["TLINK"])
+
+
+def test_sample_documents(tmpdir):
+    reference_dir = tmpdir.mkdir("reference")
+    predicted_dir = tmpdir.mkdir("predicted")
+    for i in range(20):
+        text_name = "doc{0}".format(i)
+        xml = to_xml(["X:0,5"])
+        reference_dir.join(text_name, text_name + ".xml").write(xml, ensure=True)
+        predicted_dir.join(text_name, text_name + ".xml").write(xml, ensure=True)
+
+    # the sample has the requested size, and is the same for the same seed
+    sample = anafora.evaluate.sample_documents(str(reference_dir), size=5)
+    assert len(sample) == 5
+    assert sample == anafora.evaluate.sample_documents(str(reference_dir), size=5, seed=0)
+    assert sample != anafora.evaluate.sample_documents(str(reference_dir), size=5, seed=1)
+    assert len(anafora.evaluate.sample_documents(str(reference_dir), size=50)) == 20
+    assert 0 < len(anafora.evaluate.sample_documents(str(reference_dir), fraction=0.5)) < 20
+    with pytest.raises(ValueError):
+        anafora.evaluate.sample_documents(str(reference_dir))
+
+    # only the sampled documents are scored
+    file_named_scores = list(anafora.evaluate.score_dirs(str(reference_dir), str(predicted_dir), sample=sample))
+    assert {file_name for file_name, _ in file_named_scores} == sample
+    system_named_intervals, _ = anafora.evaluate.bootstrap_scores(
+        ((file_name, {None: named_scores}) for file_name, named_scores in file_named_scores), n_samples=10, seed=0)
+    assert system_named_intervals[None]["X"]["f1"] == (1.0, 1.0, 1.0)
+
+
+def test_labelstudio_formats(tmpdir):
+    import xml.etree.cElementTree as ET
+    import anafora.labelstudio
+
+    documents = [
+        ("doc1", to_xml(["X:0,5:A=a", "X:10,15;20,25:A=b"], ["R:Source=0@e:Target=1@e"]),
+         to_xml(["X:0,5:A=a", "X:10,15:A=b"], ["R:Source=0@e:Target=1@e"])),
+        ("doc2", to_xml(["X:1,2:A=a"]),
+         to_xml(["X:1,2:A=b", "X:3,4:A=a"], ["R:Source=1@e:Target=0@e"])),
+    ]
+    property_types = {"X-A": "choices", "R-Source": "relation", "R-Target": "relation"}
+    for side_index, side in enumerate(["reference", "predicted"]):
+        side_dir = tmpdir.mkdir(side)
+        tasks = []
+        for document in documents:
+            text_name, xml = document[0], document[1 + side_index]
+            side_dir.join(text_name, text_name + ".xml").write(xml, ensure=True)
+            tasks.append(anafora.labelstudio.anafora_annotations_to_labelstudio_annotations(
+                ET.ElementTree(ET.fromstring(xml)), "x" * 30, text_name, property_types))
+        tmpdir.join(side + ".json").write(json.dumps(tasks))
+
+    # a Label Studio export of either side gives the same scores as the Anafora XML directories
+    def scores(reference_format, predicted_format):
+        reference = str(tmpdir.join("reference" + (".json" if reference_format == "labelstudio" else "")))
+        predicted = str(tmpdir.join("predicted" + (".json" if predicted_format == "labelstudio" else "")))
+        return {text_name: {name: repr(scores) for name, scores in named_scores.items()}
+                for text_name, named_scores in anafora.evaluate.score_dirs(
+                    reference, predicted, reference_format=reference_format, predicted_format=predicted_format)}
+
+    expected = scores("anafora", "anafora")
+    assert expected["doc1"]["R"] == "Scores(reference=1, predicted=1, correct=0)"
+    for formats in [("labelstudio", "anafora"), ("anafora", "labelstudio"), ("labelstudio", "labelstudio")]:
+        assert scores(*formats) == expected
+
+    # a prediction that refers to itself is skipped (as for Anafora XML) rather than crashing the scoring
+    regions = [{"id": region_id, "type": "labels", "value": {"start": 0, "end": 5, "labels": ["X"]}}
+               for region_id in ["a", "b"]]
+    links = [{"from_id": from_id, "to_id": to_id, "type": "relation", "labels": ["B"]}
+             for from_id, to_id in [("a", "b"), ("b", "a")]]
+    task = {"data": {"meta_info": {"source": "doc1"}}, "annotations": [{"result": regions + links}]}
+    tmpdir.join("cyclic.json").write(json.dumps([task]))
+    file_named_scores = dict(anafora.evaluate.score_dirs(
+        str(tmpdir.join("reference")), str(tmpdir.join("cyclic.json")), predicted_format="labelstudio"))
+    assert file_named_scores["doc1"]["X"].predicted == 0
@@ -0,0 +1,54 @@
+import json
+import xml.etree.cElementTree as ET
+
+import anafora.labelstudio
+
+
+def test_labelstudio_to_anafora_records(tmpdir):
+    anafora_xml = """
+        <data>
+            <info><savetime>now</savetime></info>
+            <annotations>
+                <entity>
+                    <id>1@e</id><type>EVENT</type><parentsType>E</parentsType><span>0,5;10,12</span>
+                    <properties><Class>A</Class><Arg>2@e</Arg></properties>
+                </entity>
+                <entity>
+                    <id>2@e</id><type>TIMEX</type><parentsType>E</parentsType><span>20,25</span>
+                    <properties></properties>
+                </entity>
+                <relation>
+                    <id>3@r</id><type>TLINK</type><parentsType>R</parentsType>
+                    <properties><Source>1@e</Source><Type>BEFORE</Type><Target>2@e</Target></properties>
+                </relation>
+                <relation>
+                    <id>4@r</id><type>ALINK</type><parentsType>R</parentsType>
+                    <properties><Source>2@e</Source><Target>1@e</Target><Extra>1@e</Extra></properties>
+                </relation>
+            </annotations>
+        </data>"""
+    property_types = {"EVENT-Class": "choices", "EVENT-Arg": "relation", "TLINK-Source": "relation",
+                      "TLINK-Type": "choices", "TLINK-Target": "relation", "ALINK-Source": "relation",
+                      "ALINK-Target": "relation", "ALINK-Extra": "relation"}
+    task = anafora.labelstudio.anafora_annotations_to_labelstudio_annotations(
+        anafora_tree=ET.ElementTree(ET.fromstring(anafora_xml)),
+        text="x" * 30,
+        source="doc1",
+        labelstudio_property_types=property_types)
+
+    # the export is streamed even when tasks are split across many chunks
+    path = tmpdir.join("export.json")
+    path.write(json.dumps([task, dict(task, data={"text": "", "meta_info": {"source": "doc2"}})], indent=2))
+    tasks = list(anafora.labelstudio.iter_labelstudio_tasks(str(path), chunk_size=7))
+    assert tasks[0] == task
+    tmpdir.join("empty.json").write(" [ ] ")
+    assert list(anafora.labelstudio.iter_labelstudio_tasks(str(tmpdir.join("empty.json")))) == []
+
+    # the spans of an entity, its properties, and the arguments of each relation are put back together
+    [(source, records), (source2, _)] = anafora.labelstudio.labelstudio_to_anafora_records(str(path))
+    assert (source, source2) == ("doc1", "doc2")
+    event, timex, tlink, alink = records
+    assert event == ([(0, 5), (10, 12)], "EVENT", {"Class": "A", "Arg": timex})
+    assert timex == ([(20, 25)], "TIMEX", {})
+    assert tlink == (None, "TLINK", {"Type": "BEFORE", "Source": event, "Target": timex})
+    assert alink == (None, "ALINK", {"Source": timex, "Target": event, "Extra": event})
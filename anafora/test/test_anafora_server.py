@@ -0,0 +1,101 @@
+import io
+import json
+import threading
+import urllib.error
+import urllib.request
+import zipfile
+
+import pytest
+
+import anafora.evaluate
+import anafora.server
+from anafora.test import to_xml
+
+
+def test_reference_corpus(tmpdir):
+    reference_dir = tmpdir.mkdir("reference")
+    predicted_dir = tmpdir.mkdir("predicted")
+    documents = [
+        ("doc1", ["X:0,5", "Y:5,10"], ["X:0,5"]),
+        ("doc2", ["X:1,2", "X:3,4"], ["X:1,2", "X:3,4", "X:5,6", "Z:7,8"]),
+        ("doc3", ["Y:1,2"], None),
+    ]
+    archive_bytes = io.BytesIO()
+    jsonl_lines = []
+    with zipfile.ZipFile(archive_bytes, "w") as archive:
+        for text_name, reference, predicted in documents:
+            reference_dir.join(text_name, text_name + ".xml").write(to_xml(reference), ensure=True)
+            if predicted is not None:
+                predicted_dir.join(text_name, text_name + ".xml").write(to_xml(predicted), ensure=True)
+                archive.writestr("submission/{0}/{0}.xml".format(text_name), to_xml(predicted))
+                records = [[[[int(offset) for offset in span.split(",")]], type_name, {}]
+                           for type_name, span in (a.split(":") for a in predicted)]
+                jsonl_lines.append(json.dumps({"text_name": text_name, "annotations": records}))
+    jsonl_lines.append(json.dumps({"text_name": "doc4", "xml": to_xml(["X:0,1"])}))
+
+    # the expected scores are those of score_dirs
+    expected = anafora.evaluate.CorpusScores()
+    for text_name, named_scores in anafora.evaluate.score_dirs(str(reference_dir), str(predicted_dir)):
+        expected.update(text_name, named_scores)
+    expected_scores = anafora.server._scores_to_json(expected.micro())
+
+    # all the forms of predictions give the same scores, no matter how many times the corpus is used
+    corpus = anafora.server.ReferenceCorpus(str(reference_dir))
+    assert len(corpus) == 3
+    for _ in range(2):
+        result = corpus.score_dir(str(predicted_dir))
+        assert result["scores"] == expected_scores
+        assert result["unmatched"] == []
+        result = corpus.score_archive(archive_bytes.getvalue(), per_document=True)
+        assert result["scores"] == expected_scores
+        assert [scores["view"] for scores in result["per_document"]["doc1"]] == ["*", "*:<span>", "X", "X:<span>",
+                                                                                 "Y", "Y:<span>"]
+        result = corpus.score_jsonl(jsonl_lines)
+        assert result["scores"] == expected_scores
+        assert result["unmatched"] == ["doc4"]
+
+    # the corpus can be served over HTTP
+    server = anafora.server.make_server(anafora.server.EvaluationService(reference_dir=str(reference_dir)), port=0)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        url = "http://127.0.0.1:{0}".format(server.server_address[1])
+        with urllib.request.urlopen(url + "/health") as response:
+            assert json.load(response) == {"documents": 3}
+        request = urllib.request.Request(url + "/score/archive", data=archive_bytes.getvalue())
+        with urllib.request.urlopen(request) as response:
+            assert json.load(response)["scores"] == expected_scores
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def test_invalid_requests(tmpdir):
+    reference_dir = tmpdir.mkdir("reference")
+    reference_dir.join("doc1", "doc1.xml").write(to_xml(["X:0,5"]), ensure=True)
+    corpus = anafora.server.ReferenceCorpus(str(reference_dir))
+
+    # records that refer to themselves, or to annotations that do not exist, are rejected
+    for references in [(1, 0), (-1, 0), (2, 0)]:
+        records = [[None, "R", {"Arg": {"annotation": index}}] for index in references]
+        with pytest.raises(ValueError):
+            corpus.score_jsonl([json.dumps({"text_name": "doc1", "annotations": records})])
+
+    # over HTTP, invalid requests get errors rather than dropped connections
+    service = anafora.server.EvaluationService(reference_dir=str(reference_dir))
+    server = anafora.server.make_server(service, port=0, max_body_size=1000)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        url = "http://127.0.0.1:{0}".format(server.server_address[1])
+        records = [[None, "R", {"Arg": {"annotation": 1}}], [None, "R", {"Arg": {"annotation": 0}}]]
+        for body, status in [(json.dumps({"text_name": "doc1", "annotations": records}), 400), ("x" * 1001, 413)]:
+            request = urllib.request.Request(url + "/score/jsonl", data=body.encode("utf-8"))
+            with pytest.raises(urllib.error.HTTPError) as error_info:
+                urllib.request.urlopen(request)
+            assert error_info.value.code == status
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
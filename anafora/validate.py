@@ -168,6 +168,31 @@ def log_entities_with_identical_spans(anafora_dir, xml_name_regex):
                                  xml_path, span, "\n".join(str(ann).rstrip() for ann in annotations))
 
 
+def log_temporal_contradictions(anafora_dir, xml_name_regex, type_name="TLINK", prop_name="Type"):
+    """
+    :param string anafora_dir: the Anafora directory containing directories to check
+    :param str xml_name_regex: regular expression identifying .xml files to include
+    :param str type_name: the type of the binary temporal relation annotations
+    :param str prop_name: the property holding the temporal relation (BEFORE, AFTER, INCLUDES, etc.)
+    """
+    # imported here, since the rest of validation does not need the (much larger) evaluation module
+    import anafora.evaluate
+
+    for sub_dir, text_name, xml_names in anafora.walk(anafora_dir, xml_name_regex):
+        for xml_name in xml_names:
+            xml_path = os.path.join(anafora_dir, sub_dir, xml_name)
+            try:
+                data = anafora.AnaforaData.from_file(xml_path)
+            except anafora.ElementTree.ParseError:
+                pass
+            else:
+                if data.annotations.find_self_referential() is not None:
+                    continue
+                for annotations in anafora.evaluate.find_temporal_contradictions(data, type_name, prop_name):
+                    logging.warn("%s: contradictory temporal relations:\n%s",
+                                 xml_path, "\n".join(str(ann).rstrip() for ann in annotations))
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="""%(prog)s validates Anafora XML files against an Anafora schema and
         logs any errors. It can also identify other potential errors such as the presence of distinct entities with
@@ -182,9 +207,15 @@ if __name__ == "__main__":
                              "to a subset of the available files (default: %(default)r)")
     parser.add_argument("--identical-spans", action='store_true',
                         help="Also log any pairs of entities that span the exact same text offsets.")
+    parser.add_argument("--temporal-contradictions", metavar="TYPE:PROPERTY", nargs="?", const="TLINK:Type",
+                        help="Also log any sets of temporal relations that contradict each other (e.g., A BEFORE B " +
+                             "and B BEFORE A). The relations are identified by their annotation type and the " +
+                             "property holding the temporal relation (default: %(const)s).")
     args = parser.parse_args()
     logging.basicConfig(format="%(levelname)s:%(message)s")
 
     log_schema_errors(Schema.from_file(args.schema), args.anafora_dir, args.xml_name_regex)
     if args.identical_spans:
         log_entities_with_identical_spans(args.anafora_dir, args.xml_name_regex)
+    if args.temporal_contradictions:
+        log_temporal_contradictions(args.anafora_dir, args.xml_name_regex, *args.temporal_contradictions.split(":"))